@@ -0,0 +1,226 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from collections.abc import Callable
+from typing import NamedTuple
+
+import fastapi
+
+
+class Budget(NamedTuple):
+    """Token bucket refilling `rate` tokens per second up to `burst` tokens. Most requests cost one token."""
+    rate: float
+    burst: float
+
+
+BUDGETS = {
+    # Every token and user request hashes or verifies a password with argon2
+    "token": Budget(rate=5 / 60, burst=10),
+    "users": Budget(rate=1 / 60, burst=5),
+
+    "feed": Budget(rate=10, burst=50),
+    "default": Budget(rate=20, burst=100),
+}
+
+# Budgets guarding logins and sign-ups are kept per address, as a client could otherwise switch between the tokens
+#  of several accounts
+ADDRESS_BUDGETS = ("token", "users")
+
+# count is capped per request, and every started COUNT_COST items cost another token
+MAX_COUNT = 100
+COUNT_COST = 10
+
+# Expensive routes are shed with 503 while the event loop lags or sessions wait for a pooled connection this long
+LAG_THRESHOLD = 0.25
+DB_WAIT_THRESHOLD = 0.5
+
+LAG_INTERVAL = 0.1
+
+# Weight of the newest measurement in the moving averages of the loop lag and the pool wait
+SMOOTHING = 0.2
+
+REDIS_URL_VARIABLE = "RATE_LIMIT_REDIS_URL"
+
+# Buckets which have refilled completely are dropped this often, as a new bucket starts full anyway
+SWEEP_INTERVAL = 60
+
+
+class MemoryStore:
+    """Token buckets of the current process, kept in a dict keyed by client and budget name."""
+
+    def __init__(self):
+        # (tokens, updated, time at which the bucket is full again) by key
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+        self.swept = time.monotonic()
+
+    def sweep(self, now: float) -> None:
+        """Drops all buckets full by now, must be called holding the lock."""
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if bucket[2] > now}
+        self.swept = now
+
+    def take(self, key: str, cost: float, budget: Budget) -> float:
+        """Takes `cost` tokens if available and returns 0, otherwise the seconds until they will be."""
+        now = time.monotonic()
+
+        with self.lock:
+            if now - self.swept > SWEEP_INTERVAL:
+                self.sweep(now)
+
+            tokens, updated, _ = self.buckets.get(key, (budget.burst, now, now))
+            tokens = min(budget.burst, tokens + (now - updated) * budget.rate)
+
+            wait = 0
+
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / budget.rate
+
+            self.buckets[key] = (tokens, now, now + (budget.burst - tokens) / budget.rate)
+            return wait
+
+
+class RedisStore:
+    """Token buckets shared by all worker processes, in Redis or any server speaking its protocol and EVAL.
+
+    The bucket update runs as one Lua script, so concurrent requests of one client can not both take the last token.
+    """
+
+    SCRIPT = """
+        local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+        local rate, burst, cost, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+
+        local tokens = tonumber(bucket[1]) or burst
+        local updated = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+
+        local wait = 0
+        if tokens >= cost then
+            tokens = tokens - cost
+        else
+            wait = (cost - tokens) / rate
+        end
+
+        redis.call("HSET", KEYS[1], "tokens", tokens, "updated", now)
+        redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+
+        return tostring(wait)
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def take(self, key: str, cost: float, budget: Budget) -> float:
+        return float(self.client.eval(self.SCRIPT, 1, f"rate_limit:{key}", budget.rate, budget.burst, cost,
+                                      time.time()))
+
+
+def get_store() -> MemoryStore | RedisStore:
+    """Uses Redis if RATE_LIMIT_REDIS_URL is set, the redis package is only needed in that case."""
+    url = os.environ.get(REDIS_URL_VARIABLE)
+
+    if not url:
+        return MemoryStore()
+
+    import redis
+
+    return RedisStore(redis.Redis.from_url(url))
+
+
+class LoadMonitor:
+    """Tracks the moving averages of the event loop lag and of the time sessions wait for a database connection."""
+
+    def __init__(self):
+        self.loop_lag = 0.0
+        self.db_wait = 0.0
+
+        self.task: asyncio.Task | None = None
+
+    async def measure_loop_lag(self) -> None:
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(LAG_INTERVAL)
+
+            lag = time.perf_counter() - start - LAG_INTERVAL
+            self.loop_lag += SMOOTHING * (lag - self.loop_lag)
+
+    def start(self) -> None:
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.measure_loop_lag())
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def record_db_wait(self, seconds: float) -> None:
+        self.db_wait += SMOOTHING * (seconds - self.db_wait)
+
+    def get_overload(self) -> str | None:
+        if self.loop_lag > LAG_THRESHOLD:
+            return f"event loop lags by {self.loop_lag * 1000:.0f}ms"
+
+        if self.db_wait > DB_WAIT_THRESHOLD:
+            return f"database connections are awaited for {self.db_wait * 1000:.0f}ms"
+
+
+def get_client_key(request: fastapi.Request, user_id: int | None) -> str:
+    """Identifies clients by the id of their verified token, and anonymous or unverified clients by their address."""
+    if user_id is not None:
+        return f"user:{user_id}"
+
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
+
+def get_cost(request: fastapi.Request) -> float:
+    count = request.query_params.get("count")
+
+    if count is None or not count.isdigit():
+        return 1
+
+    if int(count) > MAX_COUNT:
+        raise fastapi.HTTPException(status_code=400, detail=f"count must not exceed {MAX_COUNT}")
+
+    return 1 + math.ceil(int(count) / COUNT_COST)
+
+
+class RateLimiter:
+    """Takes tokens from per-client buckets, identifying clients by the user id `identify` verifies from a request."""
+
+    def __init__(self, store: MemoryStore | RedisStore, monitor: LoadMonitor,
+                 identify: Callable[[fastapi.Request], int | None]):
+        self.store = store
+        self.monitor = monitor
+        self.identify = identify
+        self.enabled = True
+
+    def limit(self, budget_name: str = "default", shed: bool = False):
+        """Returns a route dependency taking tokens from the client's bucket of `budget_name`.
+
+        Routes with `shed` are refused with 503 while the server is overloaded, before taking any tokens.
+        """
+        budget = BUDGETS[budget_name]
+
+        async def dependency(request: fastapi.Request) -> None:
+            if not self.enabled:
+                return
+
+            cost = get_cost(request)
+
+            if shed and (overload := self.monitor.get_overload()):
+                raise fastapi.HTTPException(status_code=503, detail=f"Server overloaded, {overload}",
+                                            headers={"Retry-After": "1"})
+
+            user_id = self.identify(request) if budget_name not in ADDRESS_BUDGETS else None
+
+            retry_after = self.store.take(f"{budget_name}:{get_client_key(request, user_id)}", cost, budget)
+
+            if retry_after:
+                raise fastapi.HTTPException(status_code=429, detail="Too many requests",
+                                            headers={"Retry-After": str(math.ceil(retry_after))})
+
+        return dependency
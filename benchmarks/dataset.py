@@ -0,0 +1,237 @@
+"""Deterministic generator for synthetic databases matching models.py, for benchmarks and capacity planning.
+
+    python -m benchmarks.dataset benchmarks/data/posts_1000000.db --posts 1000000
+    python -m benchmarks.dataset big.db --posts 5000000 --users 20000 --favorites-per-user 100
+
+The same arguments and seed always produce the same rows, apart from the salt of the shared password hash. Rows are
+inserted with executemany on a single sqlite3 connection with journaling disabled, and indexes are only created once
+all rows are written.
+"""
+import argparse
+import bisect
+import itertools
+import math
+import os
+import random
+import sqlite3
+import time
+
+import argon2
+import sqlalchemy as sql
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+import database
+import models
+
+
+WORDS = ("the", "a", "hero", "villain", "adventure", "magic", "forest", "castle", "friend", "enemy", "journey",
+         "treasure", "power", "night", "day", "king", "queen", "wolf", "storm", "dream", "secret", "battle")
+
+SYLLABLES = ("ka", "lo", "mi", "ra", "te", "zu", "no", "shi", "ve", "da", "po", "qui", "ren", "sa", "tor", "um",
+             "bel", "cor", "fin", "gal")
+
+BENCHMARK_PASSWORD = "benchmark"
+
+BATCH_SIZE = 100_000
+
+
+def create_engine(path: str) -> sql.Engine:
+    return sql.create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+
+
+def get_name(number: int) -> str:
+    """Unique pronounceable name for every non-negative number, used for tags and bot usernames."""
+    name = ""
+
+    while True:
+        number, remainder = divmod(number, len(SYLLABLES))
+        name += SYLLABLES[remainder]
+
+        if number == 0:
+            return name
+
+
+class Zipf:
+    """Draws ids with a probability proportional to 1 / rank ** exponent.
+
+    Ranks are assigned to ids in a shuffled order, so popularity does not correlate with ids (or insertion order).
+    Every draw is a binary search over the precomputed cumulative weights.
+    """
+
+    def __init__(self, ids: range, exponent: float, rng: random.Random):
+        self.ids = list(ids)
+        rng.shuffle(self.ids)
+
+        self.cumulative_weights = list(itertools.accumulate(1 / (rank + 1) ** exponent for rank in range(len(ids))))
+        self.total = self.cumulative_weights[-1]
+        self.rng = rng
+
+    def draw(self) -> int:
+        return self.ids[bisect.bisect(self.cumulative_weights, self.rng.random() * self.total)]
+
+    def draw_distinct(self, count: int) -> set[int]:
+        """Up to `count` distinct ids, fewer if popular ids are drawn repeatedly."""
+        return {self.draw() for _ in range(min(count, len(self.ids)))}
+
+
+def poisson(rng: random.Random, mean: float) -> int:
+    """Knuth's algorithm, fast enough for the small means used per post."""
+    limit, count, product = math.exp(-mean), 0, rng.random()
+
+    while product > limit:
+        count += 1
+        product *= rng.random()
+
+    return count
+
+
+def build_database(path: str, post_count: int, seed: int = 0, bot_count: int = None, tag_count: int = None,
+                   user_count: int = None, tags_per_post: float = 1.5, mentions_per_post: float = 0.6,
+                   favorites_per_user: float = 50, follows_per_user: float = 10, exponent: float = 1.1) -> dict:
+    """Creates a database with `post_count` posts, sizing the other tables relative to it unless given.
+
+    Bot activity, bot mentions, tag usage and post favourites follow Zipf distributions. The number of favourites and
+    follows per user is exponentially distributed around the given means. Returns the number of rows per table.
+    """
+    bot_count = bot_count if bot_count is not None else max(40, post_count // 100)
+    tag_count = tag_count if tag_count is not None else max(50, post_count // 20)
+    user_count = user_count if user_count is not None else max(10, post_count // 1000)
+
+    rng = random.Random(seed)
+
+    bots = Zipf(range(1, bot_count + 1), exponent, rng)
+    mentioned_bots = Zipf(range(1, bot_count + 1), exponent, rng)
+    tags = Zipf(range(1, tag_count + 1), exponent, rng)
+
+    # Built under a temporary name, so an interrupted run never leaves a partial database behind
+    temporary_path = f"{path}.tmp"
+
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+
+    connection = sqlite3.connect(temporary_path)
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    connection.execute("PRAGMA cache_size = -262144")
+
+    for table in database.Base.metadata.sorted_tables:
+        connection.execute(str(CreateTable(table).compile(dialect=sqlite.dialect())))
+
+    row_counts = {}
+
+    def insert(table: sql.Table, rows) -> None:
+        statement = (f"INSERT INTO {table.name} ({', '.join(table.columns.keys())}) "
+                     f"VALUES ({', '.join('?' for _ in table.columns)})")
+
+        rows = iter(rows)
+        while batch := list(itertools.islice(rows, BATCH_SIZE)):
+            connection.executemany(statement, batch)
+            row_counts[table.name] = row_counts.get(table.name, 0) + len(batch)
+
+    insert(models.Organisation.__table__, [(1, "Benchmark")])
+
+    insert(models.Bot.__table__, (
+        (i, 1, get_name(i), get_name(i).capitalize(), f"https://example.com/{i}.jpg", "bg-navy-800")
+        for i in range(1, bot_count + 1)
+    ))
+
+    insert(models.Tag.__table__, ((i, get_name(i)) for i in range(1, tag_count + 1)))
+
+    tag_maps, mention_maps = [], []
+
+    def generate_posts():
+        for post_id in range(1, post_count + 1):
+            post_tags = tags.draw_distinct(poisson(rng, tags_per_post))
+            post_mentions = mentioned_bots.draw_distinct(poisson(rng, mentions_per_post))
+
+            content = " ".join(rng.choices(WORDS, k=rng.randint(8, 24)))
+            content += "".join(f" #{get_name(i)}" for i in post_tags)
+            content += "".join(f" @{get_name(i)}" for i in post_mentions)
+
+            tag_maps.extend((post_id, i) for i in post_tags)
+            mention_maps.extend((post_id, i) for i in post_mentions)
+
+            yield post_id, bots.draw(), content
+
+    posts = generate_posts()
+
+    while batch := list(itertools.islice(posts, BATCH_SIZE)):
+        insert(models.Post.__table__, batch)
+
+        insert(models.TagMap.__table__, ((None, post_id, tag_id) for post_id, tag_id in tag_maps))
+        insert(models.MentionMap.__table__, ((None, post_id, bot_id) for post_id, bot_id in mention_maps))
+        tag_maps.clear()
+        mention_maps.clear()
+
+    # Every user shares the same password, so benchmarks can log in as any of them
+    password_hash = argon2.PasswordHasher().hash(BENCHMARK_PASSWORD)
+
+    insert(models.User.__table__, (
+        (i, f"user{i}@example.com", password_hash, f"user{i}") for i in range(1, user_count + 1)
+    ))
+
+    if post_count:
+        favorited_posts = Zipf(range(1, post_count + 1), exponent, rng)
+
+        insert(models.FavoriteMap.__table__, (
+            (None, user_id, post_id)
+            for user_id in range(1, user_count + 1)
+            for post_id in favorited_posts.draw_distinct(int(rng.expovariate(1 / favorites_per_user)))
+        ))
+
+    # Half of the follows of a user go to bots, the other half to tags
+    insert(models.FollowingMap.__table__, itertools.chain.from_iterable(
+        itertools.chain(
+            [(None, None, bot_id, user_id)
+             for bot_id in bots.draw_distinct(int(rng.expovariate(2 / follows_per_user)))],
+            [(None, tag_id, None, user_id)
+             for tag_id in tags.draw_distinct(int(rng.expovariate(2 / follows_per_user)))],
+        )
+        for user_id in range(1, user_count + 1)
+    ))
+
+    for table in database.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            connection.execute(str(CreateIndex(index).compile(dialect=sqlite.dialect())))
+
+    connection.commit()
+    connection.execute("ANALYZE")
+    connection.close()
+
+    os.replace(temporary_path, path)
+
+    return row_counts
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Generates a synthetic database matching models.py")
+    parser.add_argument("path")
+    parser.add_argument("--posts", type=int, required=True)
+    parser.add_argument("--bots", type=int, default=None, help="defaults to posts / 100")
+    parser.add_argument("--tags", type=int, default=None, help="defaults to posts / 20")
+    parser.add_argument("--users", type=int, default=None, help="defaults to posts / 1000")
+    parser.add_argument("--tags-per-post", type=float, default=1.5)
+    parser.add_argument("--mentions-per-post", type=float, default=0.6)
+    parser.add_argument("--favorites-per-user", type=float, default=50)
+    parser.add_argument("--follows-per-user", type=float, default=10)
+    parser.add_argument("--exponent", type=float, default=1.1, help="Zipf exponent of all popularity distributions")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+
+    row_counts = build_database(args.path, args.posts, seed=args.seed, bot_count=args.bots, tag_count=args.tags,
+                                user_count=args.users, tags_per_post=args.tags_per_post,
+                                mentions_per_post=args.mentions_per_post,
+                                favorites_per_user=args.favorites_per_user, follows_per_user=args.follows_per_user,
+                                exponent=args.exponent)
+
+    for table, count in row_counts.items():
+        print(f"{table:<16} {count:>12,}")
+
+    print(f"{'total':<16} {sum(row_counts.values()):>12,} rows in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Reports where the import time of the API process goes, based on `python -X importtime`.
+
+    python -m benchmarks.import_profile                    # profile of `import main`
+    python -m benchmarks.import_profile --module services --top 30
+    python -m benchmarks.import_profile --budget 1500      # fails if importing takes longer than 1.5s
+
+Every import runs in a fresh interpreter, so nothing is cached in sys.modules. The slowest modules are listed by
+cumulative time (including the modules they import), the packages by the sum of their own modules' self time.
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+from benchmarks.run import DATA_DIRECTORY, ROOT, prepare_working_directory
+
+
+LINE_PATTERN = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def profile_import(module: str) -> list[tuple[str, int, int, int]]:
+    """Returns `(name, depth, self µs, cumulative µs)` of every module imported by `import module`."""
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.environ.get("PYTHONPATH", "")]))
+
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=DATA_DIRECTORY,
+                            env=environment, capture_output=True, text=True, check=True)
+
+    modules = []
+
+    for line in result.stderr.splitlines():
+        match = LINE_PATTERN.match(line)
+
+        if match is not None:
+            self_time, cumulative_time, indentation, name = match.groups()
+            modules.append((name, len(indentation) // 2, int(self_time), int(cumulative_time)))
+
+    return modules
+
+
+def is_local(name: str) -> bool:
+    top_level = name.split(".")[0]
+    return os.path.isfile(os.path.join(ROOT, f"{top_level}.py")) or os.path.isdir(os.path.join(ROOT, top_level))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Reports the import time of the API process")
+    parser.add_argument("--module", default="main", help="module to import, defaults to the app")
+    parser.add_argument("--top", type=int, default=20, help="number of modules and packages to list")
+    parser.add_argument("--budget", type=float, default=None, help="fail if the import takes longer, in ms")
+    args = parser.parse_args()
+
+    prepare_working_directory()
+
+    modules = profile_import(args.module)
+
+    total = next((cumulative for name, _, _, cumulative in modules if name == args.module), 0) / 1000
+
+    packages = {}
+    for name, _, self_time, _ in modules:
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_time
+
+    print("Slowest modules by cumulative import time (* = part of this repository):")
+    for name, depth, self_time, cumulative_time in sorted(modules, key=lambda i: -i[3])[:args.top]:
+        print(f"  {cumulative_time / 1000:>9.1f}ms  {self_time / 1000:>9.1f}ms self  "
+              f"{'*' if is_local(name) else ' '} {'  ' * depth}{name}")
+
+    print("\nSlowest packages by total self time:")
+    for package, self_time in sorted(packages.items(), key=lambda i: -i[1])[:args.top]:
+        print(f"  {self_time / 1000:>9.1f}ms  {'*' if is_local(package) else ' '} {package}")
+
+    print(f"\nimport {args.module}: {total:.1f}ms, {len(modules)} modules")
+
+    if args.budget is not None and total > args.budget:
+        print(f"Exceeds the budget of {args.budget:.0f}ms")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
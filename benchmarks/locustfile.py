@@ -0,0 +1,112 @@
+"""Locust scenario for a running server, e.g. one serving a database built by benchmarks/run.py:
+
+    locust -f benchmarks/locustfile.py --host http://127.0.0.1:8000
+
+BENCHMARK_USERNAME and BENCHMARK_PASSWORD select the account the simulated users log in with, the synthetic databases
+contain the users user1, user2, ... with the password "benchmark".
+"""
+import os
+import random
+
+from locust import HttpUser, between, task
+
+
+USERNAME = os.environ.get("BENCHMARK_USERNAME", "user1")
+PASSWORD = os.environ.get("BENCHMARK_PASSWORD", "benchmark")
+
+
+class FeedUser(HttpUser):
+    """Browses the feed like the frontend does: loads random posts, then the info and owner of each of them."""
+
+    wait_time = between(0.5, 2)
+
+    def on_start(self):
+        response = self.client.post("/api/token", data={"username": USERNAME, "password": PASSWORD})
+        response.raise_for_status()
+
+        self.client.headers["Authorization"] = f"Bearer {response.json()['access_token']}"
+
+        self.seen_posts = []
+
+    def load_posts(self, name: str, **params) -> list[dict]:
+        response = self.client.get("/api/posts/random", params={"count": 5, "x": self.seen_posts[-50:], **params},
+                                   name=name)
+
+        if not response.ok:
+            return []
+
+        posts = response.json()
+        self.seen_posts += [post["id"] for post in posts]
+
+        for post in posts:
+            self.client.get(f"/api/posts/{post['id']}/info", name="/api/posts/[id]/info")
+            self.client.get(f"/api/bots/{post['owner_id']}", name="/api/bots/[id]")
+
+        return posts
+
+    @task(10)
+    def feed(self):
+        self.load_posts("/api/posts/random")
+
+    @task(2)
+    def favorites_feed(self):
+        self.load_posts("/api/posts/random?favorites_only", favorites_only=True)
+
+    @task(2)
+    def search(self):
+        self.load_posts("/api/posts/random?use_filter", use_filter=random.choice(("hero", "magic", "castle")))
+
+    @task(3)
+    def bot_page(self):
+        response = self.client.get("/api/bots/random", params={"count": 1}, name="/api/bots/random")
+
+        if not response.ok or not response.json():
+            return
+
+        bot_id = response.json()[0]["id"]
+
+        self.client.get(f"/api/bots/{bot_id}/info", name="/api/bots/[id]/info")
+        self.load_posts("/api/posts/random?by_bot", by_bot=bot_id)
+
+    @task(2)
+    def tag_page(self):
+        response = self.client.get("/api/tags/random", params={"count": 1}, name="/api/tags/random")
+
+        if not response.ok or not response.json():
+            return
+
+        tag_id = response.json()[0]["id"]
+
+        self.client.get(f"/api/tags/{tag_id}/info", name="/api/tags/[id]/info")
+        self.load_posts("/api/posts/random?by_tag", by_tag=tag_id)
+
+    @task(1)
+    def toggle_favorite(self):
+        if not self.seen_posts:
+            return
+
+        post_id = random.choice(self.seen_posts)
+
+        with self.client.post(f"/api/posts/{post_id}/favorite", name="/api/posts/[id]/favorite",
+                              catch_response=True) as response:
+            # Favouriting an already favourited post is answered with 404, which is expected here
+            if response.status_code == 404:
+                response.success()
+
+        self.client.post(f"/api/posts/{post_id}/unfavorite", name="/api/posts/[id]/unfavorite")
+
+    @task(1)
+    def toggle_follow(self):
+        response = self.client.get("/api/bots/random", params={"count": 1}, name="/api/bots/random")
+
+        if not response.ok or not response.json():
+            return
+
+        bot_id = response.json()[0]["id"]
+
+        with self.client.post(f"/api/bots/{bot_id}/follow", name="/api/bots/[id]/follow",
+                              catch_response=True) as response:
+            if response.status_code == 409:
+                response.success()
+
+        self.client.post(f"/api/bots/{bot_id}/unfollow", name="/api/bots/[id]/unfollow")
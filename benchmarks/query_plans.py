@@ -0,0 +1,206 @@
+"""Captures the SQL emitted by every service function and checks its query plan against a synthetic database.
+
+    python -m benchmarks.query_plans                  # fails on full table scans or temp B-trees not allowed yet
+    python -m benchmarks.query_plans --update         # accepts the current plans
+    python -m benchmarks.query_plans --scale 1000000 --verbose
+
+Some scans are inherent to the current queries (e.g. random sampling with OFFSET), so accepted plan steps are stored
+per service function in benchmarks/query_plans.json. The check fails when a function starts scanning a table or
+building a temporary B-tree it did not before, which usually means an index is missing or no longer used.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+from collections.abc import Callable, Coroutine
+
+import sqlalchemy as sql
+
+import database
+import models
+from benchmarks import dataset
+from benchmarks.run import ROOT, get_database_path, get_ids, prepare_working_directory
+
+
+ALLOWED_PATH = os.path.join(ROOT, "benchmarks", "query_plans.json")
+
+# Scans of subquery results or through an index ("SCAN posts USING COVERING INDEX ...") do not read whole tables
+FULL_SCAN_PATTERN = re.compile(r"^SCAN (?!CONSTANT ROW|\()(?!.* USING (COVERING )?INDEX)")
+TEMP_B_TREE_PATTERN = re.compile(r"USE TEMP B-TREE")
+
+
+class StatementRecorder:
+    def __init__(self):
+        self.statements = []
+
+    def __call__(self, connection, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith("SELECT"):
+            self.statements.append((statement, parameters))
+
+
+def get_service_calls(services, user, ids: dict) -> list[tuple[str, Callable[[sql.orm.Session], Coroutine]]]:
+    """Returns `(name, call)` tuples invoking every read and follow/favourite service function once."""
+    post, bot, tag = ids["post"][len(ids["post"]) // 2], ids["bot"][0], ids["tag"][0]
+    unused_post, unused_bot, unused_tag = ids["unused_post"][0], ids["unused_bot"][0], ids["unused_tag"][0]
+
+    def random_posts(**kwargs):
+        return lambda db: services.get_random_posts(5, user, db, exclude=[], **kwargs)
+
+    async def current_user(db):
+        return services.get_current_user((await services.create_token(user))["access_token"], db)
+
+    return [
+        ("get_current_user", current_user),
+        ("get_user_by_email_or_username", lambda db: services.get_user_by_email_or_username(ids["username"], db)),
+        ("get_favorite_posts_count", lambda db: services.get_favorite_posts_count(user, db)),
+        ("get_followed_bot_count", lambda db: services.get_followed_bot_count(user, db)),
+        ("get_followed_tag_count", lambda db: services.get_followed_tag_count(user, db)),
+
+        ("get_post", lambda db: services.get_post(post, db)),
+        ("get_random_posts", random_posts()),
+        ("get_random_posts(by_tag)", random_posts(by_tag=tag)),
+        ("get_random_posts(by_tag, expand_tag)", random_posts(by_tag=tag, expand_tag=True)),
+        ("get_random_posts(by_bot)", random_posts(by_bot=bot)),
+        ("get_random_posts(by_or_mentioned)", random_posts(by_or_mentioned=bot)),
+        ("get_random_posts(favorites_only)", random_posts(favorites_only=True)),
+        ("get_random_posts(use_filter)", random_posts(use_filter="hero")),
+        ("get_random_posts(strategy=weighted)", random_posts(strategy="weighted")),
+        ("get_random_posts(strategy=trending, by_tag)", random_posts(strategy="trending", by_tag=tag)),
+        ("get_random_posts(any_tag, exclude_bot)", random_posts(any_tag=[tag, ids["tag"][-1]], exclude_bot=[bot])),
+        ("get_random_posts(exclude_tag, exclude_filter)", random_posts(exclude_tag=[tag], exclude_filter="hero")),
+        ("get_similar_posts", lambda db: services.get_similar_posts(post, 10, db)),
+        ("get_post_info", lambda db: services.get_post_info(post, db, user=user)),
+        ("favorite_post", lambda db: services.favorite_post(unused_post, user, db)),
+        ("unfavorite_post", lambda db: services.unfavorite_post(unused_post, user, db)),
+
+        ("get_bot(id)", lambda db: services.get_bot(str(bot), db)),
+        ("get_bot(username)", lambda db: services.get_bot(dataset.get_name(bot), db)),
+        ("get_bot(username, ignoring case)", lambda db: services.get_bot(dataset.get_name(bot).upper(), db)),
+        ("suggest_bots", lambda db: services.suggest_bots(dataset.get_name(bot)[:2], 10, db)),
+        ("get_random_bots", lambda db: services.get_random_bots(5, user, db)),
+        ("get_random_bots(following_only)", lambda db: services.get_random_bots(5, user, db, following_only=True)),
+        ("get_bot_info", lambda db: services.get_bot_info(str(bot), db, user=user)),
+        ("get_bot_page", lambda db: services.get_bot_page(str(bot), 5, user, db)),
+        ("get_bot_connections", lambda db: services.get_bot_connections(str(bot), 10, db)),
+        ("follow_bot", lambda db: services.follow_bot(str(unused_bot), user, db)),
+        ("unfollow_bot", lambda db: services.unfollow_bot(str(unused_bot), user, db)),
+
+        ("get_tag(id)", lambda db: services.get_tag(str(tag), db)),
+        ("get_tag(name)", lambda db: services.get_tag(dataset.get_name(tag), db)),
+        ("get_tag(name, ignoring case)", lambda db: services.get_tag(dataset.get_name(tag).upper(), db)),
+        ("suggest_tags", lambda db: services.suggest_tags(dataset.get_name(tag)[:2], 10, db)),
+        ("get_random_tags", lambda db: services.get_random_tags(5, user, db)),
+        ("get_random_tags(following_only)", lambda db: services.get_random_tags(5, user, db, following_only=True)),
+        ("get_tag_info", lambda db: services.get_tag_info(str(tag), db, user=user)),
+        ("get_tag_page", lambda db: services.get_tag_page(str(tag), 5, user, db)),
+        ("get_related_tags", lambda db: services.get_related_tags(str(tag), 10, db)),
+        ("follow_tag", lambda db: services.follow_tag(str(unused_tag), user, db)),
+        ("unfollow_tag", lambda db: services.unfollow_tag(str(unused_tag), user, db)),
+    ]
+
+
+def get_problems(connection, statement: str, parameters) -> list[str]:
+    """Returns the plan steps of the statement which scan a whole table or build a temporary B-tree."""
+    cursor = connection.cursor()
+    cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+
+    return sorted({detail for _, _, _, detail in cursor.fetchall()
+                   if FULL_SCAN_PATTERN.match(detail) or TEMP_B_TREE_PATTERN.search(detail)})
+
+
+def collect_plans(scale: int, rebuild: bool, verbose: bool) -> dict[str, list[str]]:
+    # Imported late, because services reads the jwt_secret from the working directory set up beforehand
+    import services
+
+    engine = dataset.create_engine(get_database_path(scale, rebuild))
+    database.SessionLocal.configure(bind=engine)
+
+    recorder = StatementRecorder()
+    sql.event.listen(engine, "before_cursor_execute", recorder)
+
+    ids = get_ids(engine, 1, 1)
+
+    db = database.SessionLocal()
+    services.similar_posts.build(db)
+
+    user = services.schemas.User.model_validate(db.get(models.User, 1))
+    db.close()
+
+    plans = {}
+
+    raw_connection = engine.raw_connection()
+
+    for name, call in get_service_calls(services, user, ids):
+        recorder.statements.clear()
+
+        db = database.SessionLocal()
+        try:
+            asyncio.run(call(db))
+        finally:
+            db.close()
+
+        problems = set()
+
+        for statement, parameters in recorder.statements:
+            statement_problems = get_problems(raw_connection, statement, parameters)
+            problems.update(statement_problems)
+
+            if verbose and statement_problems:
+                print(f"{name}: {' '.join(statement.split())[:200]}\n    {', '.join(statement_problems)}")
+
+        plans[name] = sorted(problems)
+
+    raw_connection.close()
+    engine.dispose()
+
+    return plans
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Checks the query plans of all service functions")
+    parser.add_argument("--scale", type=int, default=100_000, help="number of posts of the synthetic database")
+    parser.add_argument("--rebuild", action="store_true", help="regenerate the synthetic database")
+    parser.add_argument("--update", action="store_true", help=f"store the current plans in {ALLOWED_PATH}")
+    parser.add_argument("--verbose", action="store_true", help="print every offending statement")
+    args = parser.parse_args()
+
+    prepare_working_directory()
+
+    plans = collect_plans(args.scale, args.rebuild, args.verbose)
+
+    if args.update:
+        with open(ALLOWED_PATH, "w") as file:
+            json.dump(plans, file, indent=2)
+
+        print(f"Stored the plans of {len(plans)} service functions in {ALLOWED_PATH}")
+        return
+
+    allowed = {}
+
+    if os.path.exists(ALLOWED_PATH):
+        with open(ALLOWED_PATH) as file:
+            allowed = json.load(file)
+
+    regressions = 0
+
+    for name, problems in plans.items():
+        new_problems = [i for i in problems if i not in allowed.get(name, [])]
+        resolved_problems = [i for i in allowed.get(name, []) if i not in problems]
+
+        for problem in new_problems:
+            print(f"REGRESSION {name}: {problem}")
+        for problem in resolved_problems:
+            print(f"resolved   {name}: {problem} (run with --update to accept)")
+
+        regressions += len(new_problems)
+
+    print(f"{len(plans)} service functions checked, {regressions} new full scans or temp B-trees")
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,349 @@
+"""Benchmarks every route of main.py in-process against synthetic databases of several sizes.
+
+Run from the repository root:
+
+    python -m benchmarks.run                              # 1k, 100k and 1M posts
+    python -m benchmarks.run --scales 1000 --requests 20
+    python -m benchmarks.run --scales 1000 --save-baseline
+    python -m benchmarks.run --scales 1000 --compare      # exits with 1 on regressions
+
+The baseline is not part of the repository, as latencies depend on the machine: record one with --save-baseline
+on the machine comparing against it, before the change to compare, and again after adding or changing routes.
+More --requests per route make the p95 less noisy.
+
+Generated databases and the jwt_secret used by the benchmark are kept in benchmarks/data/.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import random
+import secrets
+import statistics
+import sys
+import time
+from collections.abc import Callable
+
+import httpx
+import sqlalchemy as sql
+
+import database
+import models
+from benchmarks import dataset
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIRECTORY = os.path.join(ROOT, "benchmarks", "data")
+BASELINE_PATH = os.path.join(ROOT, "benchmarks", "baseline.json")
+
+SCALES = [1_000, 100_000, 1_000_000]
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+
+
+def get_routes(ids: dict, requests: int) -> list[tuple[str, str, Callable[[int], tuple[str, dict]], int]]:
+    """Returns `(name, method, request_factory, count)` tuples for every route.
+
+    The factories take the iteration number and return the url and keyword arguments of the request. Favourite and
+    follow routes are listed before their counterparts, so every unfavourite/unfollow undoes an earlier request. They
+    are limited to as many requests as there are distinct posts, bots or tags left to favourite or follow.
+    """
+    rng = random.Random(1)
+
+    post, bot, tag = ids["post"], ids["bot"], ids["tag"]
+    unused_post, unused_bot, unused_tag = ids["unused_post"], ids["unused_bot"], ids["unused_tag"]
+
+    return [
+        ("GET /api", "GET", lambda i: ("/api", {}), requests),
+        ("POST /api/token", "POST", lambda i: ("/api/token", {"data": {
+            "username": ids["username"], "password": dataset.BENCHMARK_PASSWORD}}), requests),
+        ("GET /api/users/me", "GET", lambda i: ("/api/users/me", {}), requests),
+
+        ("GET /api/posts/random", "GET", lambda i: ("/api/posts/random", {"params": {"count": 5}}), requests),
+        ("GET /api/posts/random?by_tag", "GET", lambda i: (
+            "/api/posts/random", {"params": {"count": 5, "by_tag": rng.choice(tag)}}), requests),
+        ("GET /api/posts/random?by_tag&expand_tag", "GET", lambda i: (
+            "/api/posts/random", {"params": {"count": 5, "by_tag": rng.choice(tag), "expand_tag": True}}), requests),
+        ("GET /api/posts/random?by_bot", "GET", lambda i: (
+            "/api/posts/random", {"params": {"count": 5, "by_bot": rng.choice(bot)}}), requests),
+        ("GET /api/posts/random?by_or_mentioned", "GET", lambda i: (
+            "/api/posts/random", {"params": {"count": 5, "by_or_mentioned": rng.choice(bot)}}), requests),
+        ("GET /api/posts/random?favorites_only", "GET", lambda i: (
+            "/api/posts/random", {"params": {"count": 5, "favorites_only": True}}), requests),
+        ("GET /api/posts/random?use_filter", "GET", lambda i: (
+            "/api/posts/random", {"params": {"count": 5, "use_filter": rng.choice(dataset.WORDS)}}), requests),
+        ("GET /api/posts/random?any_tag&exclude_tag", "GET", lambda i: (
+            "/api/posts/random", {"params": {"count": 5, "any_tag": rng.sample(tag, min(len(tag), 3)),
+                                             "exclude_tag": rng.choice(tag)}}), requests),
+        ("GET /api/posts/random?fields", "GET", lambda i: (
+            "/api/posts/random", {"params": {"count": 20, "fields": "id,owner_id"}}), requests),
+        ("GET /api/posts/random?x", "GET", lambda i: (
+            "/api/posts/random", {"params": {"count": 5, "x": rng.sample(post, min(len(post), 20))}}), requests),
+        ("GET /api/posts/random?strategy=weighted", "GET", lambda i: (
+            "/api/posts/random", {"params": {"count": 5, "strategy": "weighted"}}), requests),
+        ("GET /api/posts/random?strategy=trending", "GET", lambda i: (
+            "/api/posts/random", {"params": {"count": 5, "strategy": "trending"}}), requests),
+        ("GET /api/posts/random?strategy=trending&by_tag", "GET", lambda i: (
+            "/api/posts/random", {"params": {"count": 5, "strategy": "trending", "by_tag": rng.choice(tag)}}), requests),
+        ("GET /api/posts/random/info", "GET", lambda i: ("/api/posts/random/info", {}), requests),
+        ("GET /api/posts/{id}", "GET", lambda i: (f"/api/posts/{rng.choice(post)}", {}), requests),
+        ("GET /api/posts/{id}/info", "GET", lambda i: (f"/api/posts/{rng.choice(post)}/info", {}), requests),
+        ("GET /api/posts/{id}/similar", "GET", lambda i: (
+            f"/api/posts/{rng.choice(post)}/similar", {"params": {"count": 10}}), requests),
+        ("POST /api/posts/{id}/favorite", "POST", lambda i: (
+            f"/api/posts/{unused_post[i]}/favorite", {}), len(unused_post)),
+        ("POST /api/posts/{id}/unfavorite", "POST", lambda i: (
+            f"/api/posts/{unused_post[i]}/unfavorite", {}), len(unused_post)),
+
+        ("GET /api/bots/random", "GET", lambda i: ("/api/bots/random", {"params": {"count": 5}}), requests),
+        ("GET /api/bots/random?following_only", "GET", lambda i: (
+            "/api/bots/random", {"params": {"count": 5, "following_only": True}}), requests),
+        ("GET /api/bots/random/info", "GET", lambda i: ("/api/bots/random/info", {}), requests),
+        ("GET /api/bots/suggest", "GET", lambda i: (
+            "/api/bots/suggest", {"params": {"q": dataset.get_name(rng.choice(bot))[:2]}}), requests),
+        ("GET /api/bots/{id}", "GET", lambda i: (f"/api/bots/{rng.choice(bot)}", {}), requests),
+        ("GET /api/bots/{username}", "GET", lambda i: (
+            f"/api/bots/@{dataset.get_name(rng.choice(bot))}", {}), requests),
+        ("GET /api/bots/{id}/info", "GET", lambda i: (f"/api/bots/{rng.choice(bot)}/info", {}), requests),
+        ("GET /api/bots/{id}/page", "GET", lambda i: (f"/api/bots/{rng.choice(bot)}/page", {}), requests),
+        ("GET /api/bots/{id}/connections", "GET", lambda i: (f"/api/bots/{rng.choice(bot)}/connections", {}), requests),
+        ("POST /api/bots/{id}/follow", "POST", lambda i: (
+            f"/api/bots/{unused_bot[i]}/follow", {}), len(unused_bot)),
+        ("POST /api/bots/{id}/unfollow", "POST", lambda i: (
+            f"/api/bots/{unused_bot[i]}/unfollow", {}), len(unused_bot)),
+
+        ("GET /api/tags/random", "GET", lambda i: ("/api/tags/random", {"params": {"count": 5}}), requests),
+        ("GET /api/tags/random?following_only", "GET", lambda i: (
+            "/api/tags/random", {"params": {"count": 5, "following_only": True}}), requests),
+        ("GET /api/tags/random/info", "GET", lambda i: ("/api/tags/random/info", {}), requests),
+        ("GET /api/tags/suggest", "GET", lambda i: (
+            "/api/tags/suggest", {"params": {"q": dataset.get_name(rng.choice(tag))[:2]}}), requests),
+        ("GET /api/tags/{id}", "GET", lambda i: (f"/api/tags/{rng.choice(tag)}", {}), requests),
+        ("GET /api/tags/{name}", "GET", lambda i: (
+            f"/api/tags/%23{dataset.get_name(rng.choice(tag))}", {}), requests),
+        ("GET /api/tags/{id}/info", "GET", lambda i: (f"/api/tags/{rng.choice(tag)}/info", {}), requests),
+        ("GET /api/tags/{id}/page", "GET", lambda i: (f"/api/tags/{rng.choice(tag)}/page", {}), requests),
+        ("GET /api/tags/{id}/related", "GET", lambda i: (f"/api/tags/{rng.choice(tag)}/related", {}), requests),
+        ("POST /api/tags/{id}/follow", "POST", lambda i: (
+            f"/api/tags/{unused_tag[i]}/follow", {}), len(unused_tag)),
+        ("POST /api/tags/{id}/unfollow", "POST", lambda i: (
+            f"/api/tags/{unused_tag[i]}/unfollow", {}), len(unused_tag)),
+    ]
+
+
+def get_ids(engine: sql.Engine, user_id: int, requests: int) -> dict:
+    """Collects existing ids and, for the mutating routes, ids the benchmark user has not favourited or followed."""
+    rng = random.Random(0)
+
+    with engine.connect() as connection:
+        def column(statement: str) -> list[int]:
+            return [i for (i,) in connection.execute(sql.text(statement), {"user_id": user_id})]
+
+        post = column("SELECT id FROM posts")
+        bot = column("SELECT id FROM bots")
+        tag = column("SELECT id FROM tags")
+
+        favorites = set(column("SELECT post_id FROM favoritemap WHERE user_id = :user_id"))
+        followed_bots = set(column("SELECT bot_id FROM followingmap WHERE follower_id = :user_id"))
+        followed_tags = set(column("SELECT tag_id FROM followingmap WHERE follower_id = :user_id"))
+
+        username = connection.execute(sql.text("SELECT username FROM users WHERE id = :user_id"),
+                                      {"user_id": user_id}).scalar()
+
+    def unused(ids: list[int], used: set[int]) -> list[int]:
+        candidates = [i for i in ids if i not in used]
+        return rng.sample(candidates, min(requests, len(candidates)))
+
+    return dict(post=post, bot=bot, tag=tag, username=username,
+                unused_post=unused(post, favorites), unused_bot=unused(bot, followed_bots),
+                unused_tag=unused(tag, followed_tags))
+
+
+def summarise(latencies: list[float], queries: list[int], errors: int, duration: float) -> dict:
+    cut_points = statistics.quantiles(latencies, n=100, method="inclusive")
+
+    return {
+        "p50": round(cut_points[49], 3),
+        "p95": round(cut_points[94], 3),
+        "p99": round(cut_points[98], 3),
+        "queries": round(statistics.mean(queries), 2),
+        "throughput": round(len(latencies) / duration, 2),
+        "errors": errors,
+    }
+
+
+def prepare_working_directory() -> None:
+    """Switches to the data directory, because services reads the jwt_secret from the working directory on import."""
+    os.makedirs(DATA_DIRECTORY, exist_ok=True)
+    os.chdir(DATA_DIRECTORY)
+    sys.path.insert(0, ROOT)
+
+    if not os.path.exists("jwt_secret"):
+        with open("jwt_secret", "w") as file:
+            file.write(secrets.token_hex(32))
+
+
+def get_database_path(scale: int, rebuild: bool = False) -> str:
+    path = os.path.join(DATA_DIRECTORY, f"posts_{scale}.db")
+
+    if rebuild or not os.path.exists(path):
+        print(f"Building database with {scale} posts...")
+        dataset.build_database(path, scale)
+
+    return path
+
+
+async def benchmark_scale(app, scale: int, requests: int, rebuild: bool) -> dict[str, dict]:
+    # Imported late, because services reads the jwt_secret from the working directory set up beforehand
+    import services
+
+    engine = dataset.create_engine(get_database_path(scale, rebuild))
+    database.SessionLocal.configure(bind=engine)
+
+    # A single client sends all requests, which would exhaust its rate limits within the first routes
+    services.rate_limiter.enabled = False
+
+    # Built offline in production, here for the database of each scale
+    db = database.SessionLocal()
+    services.similar_posts.build(db)
+    db.close()
+
+    counter = QueryCounter()
+    sql.event.listen(engine, "before_cursor_execute", counter)
+
+    user_id = 1
+    ids = get_ids(engine, user_id, requests)
+
+    db = database.SessionLocal()
+    token = (await services.create_token(db.get(models.User, user_id)))["access_token"]
+    db.close()
+
+    results = {}
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark",
+                                 headers={"Authorization": f"Bearer {token}"}) as client:
+        for name, method, request_factory, count in get_routes(ids, requests):
+            latencies, queries, errors = [], [], 0
+
+            start = time.perf_counter()
+
+            for i in range(count):
+                url, kwargs = request_factory(i)
+
+                counter.count = 0
+                request_start = time.perf_counter()
+
+                response = await client.request(method, url, **kwargs)
+
+                latencies.append((time.perf_counter() - request_start) * 1000)
+                queries.append(counter.count)
+
+                if response.status_code >= 400:
+                    errors += 1
+
+            results[name] = summarise(latencies, queries, errors, time.perf_counter() - start)
+
+            print_result(name, results[name])
+
+    engine.dispose()
+
+    return results
+
+
+def print_result(name: str, result: dict) -> None:
+    print(f"{name:<50} p50 {result['p50']:>9.2f}ms  p95 {result['p95']:>9.2f}ms  p99 {result['p99']:>9.2f}ms  "
+          f"{result['queries']:>8.1f} queries  {result['throughput']:>8.1f} req/s"
+          f"{'  ' + str(result['errors']) + ' errors' if result['errors'] else ''}")
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+    """Prints the change of every route against the baseline and returns whether any route regressed."""
+    regressed = False
+
+    for scale, routes in results.items():
+        if scale not in baseline:
+            print(f"No baseline for {scale} posts")
+            continue
+
+        print(f"\nCompared to baseline ({scale} posts):")
+
+        for name, result in routes.items():
+            if name not in baseline[scale]:
+                print(f"{name:<50} no baseline")
+                continue
+
+            reference = baseline[scale][name]
+            change = (result["p95"] - reference["p95"]) / reference["p95"] if reference["p95"] else 0
+
+            slower = change > tolerance
+            more_queries = result["queries"] > reference["queries"]
+
+            regressed |= slower or more_queries
+
+            print(f"{name:<50} p95 {change:>+8.1%}  queries {reference['queries']:>8.1f} -> {result['queries']:<8.1f}"
+                  f"{'  REGRESSION' if slower or more_queries else ''}")
+
+    return regressed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks the API routes against synthetic databases")
+    parser.add_argument("--scales", type=int, nargs="+", default=SCALES, help="numbers of posts")
+    parser.add_argument("--requests", type=int, default=50, help="requests per route")
+    parser.add_argument("--rebuild", action="store_true", help="regenerate existing databases")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true", help="compare against the stored baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative p95 increase")
+    parser.add_argument("--output", default=None, help="write the results as JSON")
+    args = parser.parse_args()
+
+    prepare_working_directory()
+
+    app = importlib.import_module("main").app
+
+    results = {}
+
+    for scale in args.scales:
+        print(f"\n{scale} posts:")
+        results[str(scale)] = asyncio.run(benchmark_scale(app, scale, args.requests, args.rebuild))
+
+    if args.output:
+        with open(os.path.join(ROOT, args.output), "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.save_baseline:
+        baseline = {}
+
+        if os.path.exists(BASELINE_PATH):
+            with open(BASELINE_PATH) as file:
+                baseline = json.load(file)
+
+        baseline.update(results)
+
+        with open(BASELINE_PATH, "w") as file:
+            json.dump(baseline, file, indent=2)
+
+        print(f"\nSaved baseline to {BASELINE_PATH}")
+
+    if args.compare:
+        if not os.path.exists(BASELINE_PATH):
+            print(f"\nNo baseline recorded in {BASELINE_PATH}, record one with --save-baseline first")
+            sys.exit(1)
+
+        with open(BASELINE_PATH) as file:
+            baseline = json.load(file)
+
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+import threading
+
+import numpy as np
+import sqlalchemy as sql
+import sqlalchemy.orm
+
+import models
+
+
+# PageRank damping factor, and the iteration limits of its power method
+DAMPING = 0.85
+MAX_ITERATIONS = 100
+TOLERANCE = 1e-9
+
+MAX_CONNECTIONS = 50
+
+
+def to_csr(rows: np.ndarray, columns: np.ndarray, weights: np.ndarray, size: int,
+           by_weight: bool = False) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Returns `(indptr, indices, weights)` of the edges, the edges of row r are indptr[r]:indptr[r + 1].
+
+    Edges of one row are ordered by ascending column, or by descending weight first if `by_weight` is set.
+    """
+    order = np.lexsort((columns, -weights, rows) if by_weight else (columns, rows))
+
+    indptr = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=size), out=indptr[1:])
+
+    return indptr, columns[order], weights[order]
+
+
+class BotGraph:
+    """Weighted graph of which bots mention which, loaded with one grouped query and kept as CSR arrays.
+
+    An edge from a to b weighs the number of posts of a mentioning b, mentions of a bot in its own posts are left
+    out. Bots are the rows of the arrays in ascending id order, positions are found by binary search.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+
+        # Held while building, by one thread at a time. Only the first build is waited for, requests during later
+        #  ones use the previous graph
+        self.build_lock = threading.Lock()
+        self.built = False
+
+        # Incremented by every invalidation, so a graph built from older rows is built again
+        self.generation = 0
+
+        self.bot_ids = np.empty(0, dtype=np.int64)
+
+        # Mentions by a bot, mentions of a bot, and both summed up per pair of bots
+        self.outgoing = (np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+        self.incoming = self.outgoing
+        self.interactions = self.outgoing
+
+        self.centrality = np.empty(0)
+        self.ranks = np.empty(0, dtype=np.int64)
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.loaded = False
+            self.generation += 1
+
+    def ensure_loaded(self, db: sqlalchemy.orm.Session) -> None:
+        """Queries and builds the arrays without holding the lock, so lookups wait only for the swap."""
+        if self.loaded or not self.build_lock.acquire(blocking=not self.built):
+            return
+
+        try:
+            if self.loaded:
+                return
+
+            with self.lock:
+                generation = self.generation
+
+            bot_ids = np.array([i for i, in db.query(models.Bot.id).order_by(models.Bot.id)], dtype=np.int64)
+
+            edges = np.array(db.execute(
+                sql.select(models.Post.owner_id, models.MentionMap.mention_id, sql.func.count())
+                .join(models.Post, models.Post.id == models.MentionMap.post_id)
+                .where(models.Post.owner_id != models.MentionMap.mention_id)
+                .group_by(models.Post.owner_id, models.MentionMap.mention_id)
+            ).all(), dtype=np.int64).reshape(-1, 3)
+
+            sources = np.searchsorted(bot_ids, edges[:, 0])
+            targets = np.searchsorted(bot_ids, edges[:, 1])
+
+            # Mentions of deleted bots, or by posts of them, are left out
+            known = ((sources < len(bot_ids)) & (bot_ids[np.minimum(sources, len(bot_ids) - 1)] == edges[:, 0])
+                     & (targets < len(bot_ids)) & (bot_ids[np.minimum(targets, len(bot_ids) - 1)] == edges[:, 1]))
+            sources, targets, weights = sources[known], targets[known], edges[known, 2]
+
+            size = len(bot_ids)
+
+            outgoing = to_csr(sources, targets, weights, size)
+            incoming = to_csr(targets, sources, weights, size)
+
+            # Summing both directions per unordered pair
+            pairs, inverse = np.unique(np.concatenate([sources * size + targets, targets * size + sources]),
+                                       return_inverse=True)
+            pair_weights = np.bincount(inverse, weights=np.concatenate([weights, weights])).astype(np.int64)
+            interactions = to_csr(pairs // max(size, 1), pairs % max(size, 1), pair_weights, size, by_weight=True)
+
+            centrality = get_pagerank(sources, targets, weights, size)
+
+            # 1 for the most central bot
+            ranks = np.empty(size, dtype=np.int64)
+            ranks[np.argsort(-centrality, kind="stable")] = np.arange(1, size + 1)
+
+            with self.lock:
+                self.bot_ids, self.outgoing, self.incoming = bot_ids, outgoing, incoming
+                self.interactions, self.centrality, self.ranks = interactions, centrality, ranks
+
+                # Posts created while building are missing, so the next lookup builds again
+                self.loaded = generation == self.generation
+                self.built = True
+        finally:
+            self.build_lock.release()
+
+    def get_position(self, bot_id: int) -> int | None:
+        position = int(np.searchsorted(self.bot_ids, bot_id))
+
+        if position == len(self.bot_ids) or self.bot_ids[position] != bot_id:
+            return None
+
+        return position
+
+    def get_weight(self, csr: tuple[np.ndarray, np.ndarray, np.ndarray], position: int) -> int:
+        indptr, _, weights = csr
+        return int(weights[indptr[position]:indptr[position + 1]].sum())
+
+    def get_degree(self, csr: tuple[np.ndarray, np.ndarray, np.ndarray], position: int) -> int:
+        indptr, _, _ = csr
+        return int(indptr[position + 1] - indptr[position])
+
+    def get_pair_weight(self, csr: tuple[np.ndarray, np.ndarray, np.ndarray], row: int, column: int) -> int:
+        indptr, indices, weights = csr
+        i = indptr[row] + int(np.searchsorted(indices[indptr[row]:indptr[row + 1]], column))
+
+        return int(weights[i]) if i < indptr[row + 1] and indices[i] == column else 0
+
+    def get_mention_count(self, db: sqlalchemy.orm.Session, bot_id: int) -> int:
+        """Returns how often the bot is mentioned in posts of other bots."""
+        self.ensure_loaded(db)
+
+        with self.lock:
+            position = self.get_position(bot_id)
+            return 0 if position is None else self.get_weight(self.incoming, position)
+
+    def get_connections(self, db: sqlalchemy.orm.Session, bot_id: int, count: int) -> dict | None:
+        """Returns the degrees and centrality of the bot and the `count` bots it interacts with most.
+
+        Interactions are `(bot_id, mentions, mentioned_by)` tuples, ordered by mentions in both directions.
+        Returns None for bots created after the graph was loaded.
+        """
+        self.ensure_loaded(db)
+
+        with self.lock:
+            position = self.get_position(bot_id)
+
+            if position is None:
+                return None
+
+            indptr, indices, _ = self.interactions
+            others = indices[indptr[position]:min(indptr[position] + count, indptr[position + 1])]
+
+            return dict(
+                mentions_count=self.get_weight(self.outgoing, position),
+                mentioned_count=self.get_weight(self.incoming, position),
+                mentions_degree=self.get_degree(self.outgoing, position),
+                mentioned_degree=self.get_degree(self.incoming, position),
+                centrality=float(self.centrality[position]),
+                rank=int(self.ranks[position]),
+                interactions=[(int(self.bot_ids[i]), self.get_pair_weight(self.outgoing, position, i),
+                               self.get_pair_weight(self.incoming, position, i)) for i in others],
+            )
+
+
+def get_pagerank(sources: np.ndarray, targets: np.ndarray, weights: np.ndarray, size: int) -> np.ndarray:
+    """Returns the PageRank of every bot in the mention graph, summing up to 1.
+
+    Mentions pass rank on proportional to their weight, the rank of bots mentioning nobody is spread evenly.
+    """
+    if not size:
+        return np.empty(0)
+
+    out_weights = np.bincount(sources, weights=weights, minlength=size)
+    dangling = out_weights == 0
+
+    # Share of the rank of the source passed along every edge
+    shares = weights / np.where(dangling, 1, out_weights)[sources]
+
+    rank = np.full(size, 1 / size)
+
+    for _ in range(MAX_ITERATIONS):
+        following = np.bincount(targets, weights=rank[sources] * shares, minlength=size)
+        following = (1 - DAMPING) / size + DAMPING * (following + rank[dangling].sum() / size)
+
+        converged = np.abs(following - rank).sum() < TOLERANCE
+        rank = following
+
+        if converged:
+            break
+
+    return rank
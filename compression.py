@@ -0,0 +1,106 @@
+import gzip
+
+import brotli
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+# Responses below this size gain less from compression than the headers and CPU time cost
+MINIMUM_SIZE = 500
+
+GZIP_LEVEL = 6
+# Brotli's higher qualities compress slowly, 4 is about as fast as gzip level 6 while producing smaller output
+BROTLI_QUALITY = 4
+
+COMPRESSIBLE_TYPES = ("application/json", "text/")
+
+
+def get_encoding(accept_encoding: str) -> str | None:
+    """Picks br over gzip if the client accepts both, honouring q=0 exclusions."""
+    accepted = set()
+
+    for item in accept_encoding.split(","):
+        coding, _, parameter = item.partition(";")
+        parameter = parameter.replace(" ", "")
+
+        if parameter.startswith("q="):
+            try:
+                if float(parameter[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+
+        accepted.add(coding.strip().lower())
+
+    for encoding in ("br", "gzip"):
+        if encoding in accepted or "*" in accepted:
+            return encoding
+
+
+class CompressionMiddleware:
+    """Compresses complete JSON and text responses of at least `minimum_size` bytes with brotli or gzip.
+
+    Streamed responses (e.g. media files sent with more_body) and responses which already carry a Content-Encoding
+    are passed through unchanged.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = MINIMUM_SIZE,
+                 gzip_level: int = GZIP_LEVEL, brotli_quality: int = BROTLI_QUALITY):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = get_encoding(Headers(scope=scope).get("accept-encoding", ""))
+
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message: Message | None = None
+        passing_through = False
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start_message, passing_through
+
+            if passing_through:
+                await send(message)
+                return
+
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+
+            headers = MutableHeaders(raw=start_message["headers"])
+            body = message.get("body", b"")
+
+            if (message.get("more_body", False) or len(body) < self.minimum_size or "content-encoding" in headers
+                    or not headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)):
+                passing_through = True
+
+                await send(start_message)
+                await send(message)
+                return
+
+            if encoding == "br":
+                body = brotli.compress(body, quality=self.brotli_quality)
+            else:
+                body = gzip.compress(body, compresslevel=self.gzip_level)
+
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(body))
+            headers.add_vary_header("Accept-Encoding")
+
+            # The ETag of the uncompressed body does not identify the compressed one
+            if "etag" in headers and not headers["etag"].startswith("W/"):
+                headers["ETag"] = f"W/{headers['etag']}"
+
+            await send(start_message)
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_compressed)
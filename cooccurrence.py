@@ -0,0 +1,143 @@
+import heapq
+import itertools
+import math
+import threading
+
+import sqlalchemy as sql
+import sqlalchemy.orm
+
+import models
+import schemas
+
+
+BATCH_SIZE = 10_000
+
+MAX_RELATED = 50
+
+# Search expands a tag by at most this many related tags, of at least this score
+EXPANSION_SIZE = 5
+MIN_EXPANSION_SCORE = 0.1
+
+
+def count_post(rows: dict[int, dict[int, int]], post_counts: dict[int, int], post_tags: list[int]) -> None:
+    post_tags = sorted(set(post_tags))
+
+    for tag_id in post_tags:
+        post_counts[tag_id] = post_counts.get(tag_id, 0) + 1
+
+    for a, b in itertools.combinations(post_tags, 2):
+        row_a, row_b = rows.setdefault(a, {}), rows.setdefault(b, {})
+        row_a[b] = row_a.get(b, 0) + 1
+        row_b[a] = row_b.get(a, 0) + 1
+
+
+class TagCooccurrence:
+    """Sparse matrix of how many posts every pair of tags shares, kept as a dictionary of rows in memory.
+
+    Loaded with one streaming pass over TagMap ordered by post, and extended by `add` for TagMap rows written
+    afterwards, so related tags are found without any SQL. Related tags are ranked by the number of shared posts
+    relative to both tags' post counts (cosine similarity of their post sets), so popular tags do not relate to
+    everything.
+
+    The matrix is built without holding the lock and swapped in. Posts get increasing ids, so rows of posts after the
+    last one loaded are counted by `add`, also while loading, and rows of the others are in the matrix already.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+
+        # Held while loading, by one thread at a time. Only the first load is waited for, requests during later
+        #  ones use the previous matrix
+        self.load_lock = threading.Lock()
+        self.built = False
+
+        self.rows = {}
+        self.post_counts = {}
+        self.tags = {}
+        self.last_post_id = 0
+
+        # Rows and tags passed to `add` while loading, counted once the loaded matrix is swapped in
+        self.added: list[tuple[list[dict], dict]] | None = None
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.loaded = False
+
+    def count_rows(self, tag_rows: list[dict]) -> None:
+        """Counts the rows of posts after the last one loaded, must be called holding the lock."""
+        tag_rows = [row for row in tag_rows if row["post_id"] > self.last_post_id]
+
+        for _, post_rows in itertools.groupby(sorted(tag_rows, key=lambda row: row["post_id"]),
+                                              key=lambda row: row["post_id"]):
+            count_post(self.rows, self.post_counts, [row["tag_id"] for row in post_rows])
+
+    def load(self, db: sqlalchemy.orm.Session) -> None:
+        if self.loaded or not self.load_lock.acquire(blocking=not self.built):
+            return
+
+        try:
+            if self.loaded:
+                return
+
+            with self.lock:
+                self.added = []
+
+            rows, post_counts, last_post_id = {}, {}, 0
+            tags = {tag.id: schemas.Tag.model_validate(tag) for tag in db.query(models.Tag)}
+
+            tag_rows = db.execute(sql.select(models.TagMap.post_id, models.TagMap.tag_id)
+                                  .order_by(models.TagMap.post_id).execution_options(yield_per=BATCH_SIZE))
+
+            # Rows of one post may be split across partitions, so the grouping runs over all rows in order
+            for last_post_id, post_rows in itertools.groupby(itertools.chain.from_iterable(tag_rows.partitions()),
+                                                             key=lambda row: row[0]):
+                count_post(rows, post_counts, [tag_id for _, tag_id in post_rows])
+
+            with self.lock:
+                self.rows, self.post_counts, self.tags, self.last_post_id = rows, post_counts, tags, last_post_id
+
+                for added_rows, added_tags in self.added:
+                    self.tags.update(added_tags)
+                    self.count_rows(added_rows)
+
+                self.loaded = self.built = True
+        finally:
+            with self.lock:
+                self.added = None
+
+            self.load_lock.release()
+
+    def add(self, tag_rows: list[dict], db: sqlalchemy.orm.Session) -> None:
+        """Counts newly committed TagMap rows, given as dicts of post_id and tag_id."""
+        with self.lock:
+            if not self.loaded and self.added is None:
+                return
+
+            missing = {row["tag_id"] for row in tag_rows} - self.tags.keys()
+
+        tags = {tag.id: schemas.Tag.model_validate(tag)
+                for tag in db.query(models.Tag).filter(models.Tag.id.in_(missing))} if missing else {}
+
+        with self.lock:
+            if self.added is not None:
+                self.added.append((tag_rows, tags))
+            elif self.loaded:
+                self.tags.update(tags)
+                self.count_rows(tag_rows)
+
+    def get_related(self, db: sqlalchemy.orm.Session, tag_id: int, count: int,
+                    min_score: float = 0) -> list[tuple[schemas.Tag, int, float]]:
+        """Returns up to `count` `(tag, shared post count, score)` of the tags most related to the tag, best first."""
+        self.load(db)
+
+        with self.lock:
+            row = self.rows.get(tag_id, {})
+            post_count = self.post_counts.get(tag_id, 0)
+
+            scores = ((other, shared, shared / math.sqrt(post_count * self.post_counts[other]))
+                      for other, shared in row.items())
+
+            best = heapq.nlargest(count, (i for i in scores if i[2] >= min_score), key=lambda i: (i[2], i[1], -i[0]))
+
+            return [(self.tags[other], shared, score) for other, shared, score in best if other in self.tags]
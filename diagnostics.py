@@ -0,0 +1,311 @@
+import asyncio
+import collections
+import contextvars
+import functools
+import os
+import sys
+import threading
+import time
+import types
+from collections.abc import Callable
+
+import fastapi
+from starlette.datastructures import QueryParams
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+# Setting this to a number of seconds reports every time the event loop is blocked for longer, with a stack sample
+THRESHOLD_VARIABLE = "BLOCKING_THRESHOLD"
+
+HEARTBEAT_INTERVAL = 0.01
+
+MAX_RECORDS = 100
+STACK_DEPTH = 40
+
+# Samples are taken at most this often, while the sampled thread holds the GIL the sampler may wait up to
+#  sys.getswitchinterval() (5ms by default) for it
+SAMPLE_INTERVAL = 0.001
+MAX_PROFILE_DURATION = 60.0
+
+# Adding ?profile=1 to any request of an admin returns the profile of the request instead of its response
+PROFILE_PARAMETER = "profile"
+
+# The profiler of the current request, which asyncio callbacks and worker threads inherit with the context
+current_profiler = contextvars.ContextVar("current_profiler", default=None)
+
+
+def get_frames(frame: types.FrameType | None) -> list[types.FrameType]:
+    """Returns the frames of a stack, outermost first."""
+    frames = []
+
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+
+    return frames[::-1]
+
+
+def get_route_names(app: fastapi.FastAPI) -> dict[Callable, str]:
+    """Returns "METHODS path" of every route by its endpoint."""
+    return {route.endpoint: f"{','.join(sorted(route.methods))} {route.path}"
+            for route in app.routes if isinstance(route, fastapi.routing.APIRoute)}
+
+
+def describe(frame: types.FrameType) -> str:
+    return f"{frame.f_code.co_filename}:{frame.f_lineno} {frame.f_code.co_name}"
+
+
+@functools.cache
+def name_code(code: types.CodeType) -> str:
+    """Names a function for collapsed stacks, by its path relative to sys.path so site-packages are shortened."""
+    filename = code.co_filename
+
+    for path in sorted(filter(None, sys.path), key=len, reverse=True):
+        if filename.startswith(path + os.sep):
+            filename = filename[len(path) + 1:]
+            break
+
+    return f"{code.co_qualname} ({filename}:{code.co_firstlineno})".replace(";", ",")
+
+
+class BlockingDetector:
+    """Watches the event loop from a separate thread and samples its stack whenever it is blocked too long.
+
+    A task on the loop renews a heartbeat every HEARTBEAT_INTERVAL. Once the heartbeat is older than the threshold,
+    the watching thread takes the stack of the loop thread, which still runs the blocking code at that time. The
+    stall is attributed to the route handler and the innermost service function on that stack, and recorded with
+    its full duration once the loop runs again.
+    """
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+
+        self.lock = threading.Lock()
+
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id: int | None = None
+
+        # Route handler code objects by "METHOD path", set by start()
+        self.routes = {}
+
+        self.records = collections.deque(maxlen=MAX_RECORDS)
+        self.offenders = {}
+
+        self.task: asyncio.Task | None = None
+        self.thread: threading.Thread | None = None
+        self.stopped = threading.Event()
+
+    async def beat(self) -> None:
+        while True:
+            self.heartbeat = time.monotonic()
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    def sample(self) -> dict:
+        frames = get_frames(sys._current_frames().get(self.loop_thread_id))
+
+        route = next((self.routes[i.f_code] for i in frames if i.f_code in self.routes), None)
+        service = next((i.f_code.co_name for i in reversed(frames) if i.f_globals.get("__name__") == "services"), None)
+
+        return dict(
+            started_at=time.time() - (time.monotonic() - self.heartbeat),
+            duration=0.0,
+            route=route,
+            service=service,
+            stack=[describe(i) for i in frames[-STACK_DEPTH:]],
+        )
+
+    def record(self, stall: dict) -> None:
+        stall["duration"] = time.time() - stall["started_at"]
+
+        with self.lock:
+            self.records.append(stall)
+
+            count, total = self.offenders.get((stall["route"], stall["service"]), (0, 0.0))
+            self.offenders[(stall["route"], stall["service"])] = (count + 1, total + stall["duration"])
+
+        print(f"Event loop blocked for {stall['duration'] * 1000:.0f}ms by {stall['route'] or 'no route'} in "
+              f"{stall['service'] or 'no service function'}, at {stall['stack'][-1] if stall['stack'] else '?'}")
+
+    def watch(self) -> None:
+        stall = None
+
+        while not self.stopped.wait(HEARTBEAT_INTERVAL):
+            blocked = time.monotonic() - self.heartbeat - HEARTBEAT_INTERVAL
+
+            if blocked > self.threshold:
+                # Sampled once per stall, while the blocking code is still on the stack
+                if stall is None:
+                    stall = self.sample()
+
+            elif stall is not None:
+                self.record(stall)
+                stall = None
+
+    def start(self, app: fastapi.FastAPI) -> None:
+        if self.task is not None:
+            return
+
+        self.routes = {endpoint.__code__: name for endpoint, name in get_route_names(app).items()}
+
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+
+        self.task = asyncio.get_running_loop().create_task(self.beat())
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.watch, name="blocking-detector", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+    def get_offenders(self) -> list[tuple[str | None, str | None, int, float]]:
+        """Returns `(route, service, count, total duration)` of everything that blocked the loop, worst first."""
+        with self.lock:
+            offenders = [(route, service, count, total) for (route, service), (count, total) in self.offenders.items()]
+
+        return sorted(offenders, key=lambda i: -i[3])
+
+    def get_records(self) -> list[dict]:
+        """Returns the most recent stalls, newest first."""
+        with self.lock:
+            return list(reversed(self.records))
+
+
+def get_context(frames: list[types.FrameType]) -> contextvars.Context | None:
+    """Returns the context a stack runs in, taken from the innermost frame entering one with Context.run.
+
+    asyncio's Handle._run, which runs all callbacks and task steps, keeps it as self._context, anyio's worker threads
+    (running sync routes and dependencies) as a local variable.
+    """
+    for frame in reversed(frames):
+        for value in frame.f_locals.values():
+            if isinstance(value, contextvars.Context):
+                return value
+
+            if isinstance(getattr(value, "_context", None), contextvars.Context):
+                return value._context
+
+
+class SamplingProfiler:
+    """Samples the stacks of all other threads from a separate thread and counts them as collapsed stacks.
+
+    With `own_context`, only stacks running in a context whose `current_profiler` is this profiler are counted, so
+    the profile of a request leaves out concurrent requests. Time spent awaiting is not sampled.
+    """
+
+    def __init__(self, own_context: bool = False, interval: float = SAMPLE_INTERVAL):
+        self.own_context = own_context
+        self.interval = interval
+
+        self.stacks = collections.Counter()
+        self.samples = 0
+
+        self.started_at = 0.0
+        self.duration = 0.0
+
+        self.thread: threading.Thread | None = None
+        self.stopped = threading.Event()
+
+    def sample(self) -> None:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == threading.get_ident():
+                continue
+
+            frames = get_frames(frame)
+
+            if self.own_context:
+                context = get_context(frames)
+
+                if context is None or context.get(current_profiler) is not self:
+                    continue
+
+            self.stacks[";".join([names.get(thread_id, str(thread_id)), *(name_code(i.f_code) for i in frames)])] += 1
+
+        self.samples += 1
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self) -> None:
+        self.started_at = time.perf_counter()
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.thread.join()
+
+        self.duration = time.perf_counter() - self.started_at
+
+    def to_collapsed(self) -> str:
+        """Returns the stacks in the collapsed format of flamegraph.pl and speedscope, one `frames count` per line."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class ProfilingMiddleware:
+    """Replaces the response of requests with ?profile=1 by the collapsed stacks of the request, for admins.
+
+    `authorize(scope)` decides who may profile. The original status code, the duration and the number of samples
+    are sent as X-Profile-* headers.
+    """
+
+    def __init__(self, app: ASGIApp, authorize: Callable[[Scope], bool]):
+        self.app = app
+        self.authorize = authorize
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or QueryParams(scope["query_string"]).get(PROFILE_PARAMETER) not in ("1", "true"):
+            await self.app(scope, receive, send)
+            return
+
+        if not self.authorize(scope):
+            await fastapi.responses.JSONResponse({"detail": "Only admins may profile requests"},
+                                                 status_code=403)(scope, receive, send)
+            return
+
+        status_code = None
+
+        async def discard(message: Message) -> None:
+            nonlocal status_code
+
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+
+        profiler = SamplingProfiler(own_context=True)
+        token = current_profiler.set(profiler)
+        profiler.start()
+
+        try:
+            await self.app(scope, receive, discard)
+        finally:
+            profiler.stop()
+            current_profiler.reset(token)
+
+        response = fastapi.responses.PlainTextResponse(profiler.to_collapsed(), headers={
+            "X-Profile-Status": str(status_code),
+            "X-Profile-Duration": f"{profiler.duration:.6f}",
+            "X-Profile-Samples": str(profiler.samples),
+        })
+        await response(scope, receive, send)
+
+
+def get_blocking_detector() -> BlockingDetector | None:
+    threshold = os.environ.get(THRESHOLD_VARIABLE)
+
+    if not threshold:
+        return None
+
+    return BlockingDetector(float(threshold))
@@ -0,0 +1,148 @@
+"""Extracts #tags and @mentions from post contents into TagMap and MentionMap rows.
+
+    python extraction.py                       # rebuilds TagMap and MentionMap for all posts in database.db
+    python extraction.py --batch-size 50000
+"""
+import argparse
+import re
+import threading
+import time
+
+import sqlalchemy as sql
+import sqlalchemy.orm
+
+import database
+import models
+
+
+# A tag or mention starts with # or @ which must not directly follow a letter, so e.g. e-mail addresses are skipped
+TOKEN_PATTERN = re.compile(r"(?<![a-zA-Z])([@#])(\w+)")
+
+BATCH_SIZE = 10_000
+
+
+def normalise(name: str) -> str:
+    return name.lower()
+
+
+def tokenize(content: str) -> tuple[list[str], list[str]]:
+    """Returns the distinct normalised tag names and mentioned usernames of a post, in order of appearance."""
+    tags, mentions = {}, {}
+
+    for prefix, name in TOKEN_PATTERN.findall(content or ""):
+        (tags if prefix == "#" else mentions)[normalise(name)] = None
+
+    return list(tags), list(mentions)
+
+
+class TokenExtractor:
+    """Maps extracted names to tag and bot ids via in-memory dictionaries, loaded once and extended by new tags.
+
+    Unknown tags are created, unknown mentions are skipped, as bots are never created from post contents.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+
+        self.tag_ids = {}
+        self.bot_ids = {}
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.loaded = False
+
+    def load(self, db: sqlalchemy.orm.Session) -> None:
+        with self.lock:
+            if self.loaded:
+                return
+
+            # Duplicate names resolve to the oldest row, like the .first() lookups did before
+            self.tag_ids = {}
+            for tag_id, name in db.query(models.Tag.id, models.Tag.name).order_by(models.Tag.id.desc()):
+                self.tag_ids[normalise(name)] = tag_id
+
+            self.bot_ids = {}
+            for bot_id, username in db.query(models.Bot.id, models.Bot.username).order_by(models.Bot.id.desc()):
+                self.bot_ids[normalise(username)] = bot_id
+
+            self.loaded = True
+
+    def get_tag_ids(self, names: set[str], db: sqlalchemy.orm.Session) -> dict[str, int]:
+        """Returns the ids of the given tag names, creating all missing tags with a single flush."""
+        with self.lock:
+            missing = sorted(i for i in names if i not in self.tag_ids)
+
+        if missing:
+            tags = [models.Tag(name=i) for i in missing]
+            db.add_all(tags)
+            db.flush()
+
+            with self.lock:
+                self.tag_ids.update((tag.name, tag.id) for tag in tags)
+
+        with self.lock:
+            return {i: self.tag_ids[i] for i in names}
+
+    def extract(self, posts: list[tuple[int, str]], db: sqlalchemy.orm.Session) -> tuple[list[dict], list[dict]]:
+        """Inserts the TagMap and MentionMap rows of `(post_id, content)` pairs, without committing.
+
+        Returns the inserted tag and mention rows, as dicts of their columns.
+        """
+        self.load(db)
+
+        tokens = [(post_id, *tokenize(content)) for post_id, content in posts]
+
+        tag_ids = self.get_tag_ids({name for _, tags, _ in tokens for name in tags}, db)
+
+        tag_rows = [dict(post_id=post_id, tag_id=tag_ids[name]) for post_id, tags, _ in tokens for name in tags]
+        mention_rows = [dict(post_id=post_id, mention_id=self.bot_ids[name])
+                        for post_id, _, mentions in tokens for name in mentions if name in self.bot_ids]
+
+        if tag_rows:
+            db.execute(sql.insert(models.TagMap), tag_rows)
+        if mention_rows:
+            db.execute(sql.insert(models.MentionMap), mention_rows)
+
+        return tag_rows, mention_rows
+
+    def backfill(self, db: sqlalchemy.orm.Session, batch_size: int = BATCH_SIZE) -> tuple[int, int]:
+        """Replaces all TagMap and MentionMap rows with the ones extracted from every post, in one transaction."""
+        self.invalidate()
+
+        db.execute(sql.delete(models.TagMap))
+        db.execute(sql.delete(models.MentionMap))
+
+        tag_count, mention_count = 0, 0
+
+        posts = db.execute(sql.select(models.Post.id, models.Post.content).order_by(models.Post.id)
+                           .execution_options(yield_per=batch_size))
+
+        for batch in posts.partitions():
+            tag_rows, mention_rows = self.extract([tuple(i) for i in batch], db)
+            tag_count += len(tag_rows)
+            mention_count += len(mention_rows)
+
+        db.commit()
+
+        return tag_count, mention_count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Rebuilds TagMap and MentionMap from the contents of all posts")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="posts read and extracted at once")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+
+    db = database.SessionLocal()
+    try:
+        tag_count, mention_count = TokenExtractor().backfill(db, args.batch_size)
+    finally:
+        db.close()
+
+    print(f"Inserted {tag_count} tag and {mention_count} mention rows in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Serves main:app with several worker processes forked from one warmed up master process.
+
+    gunicorn main:app -c gunicorn.conf.py
+    WORKERS=8 BIND=127.0.0.1:8000 gunicorn main:app -c gunicorn.conf.py
+
+The master imports the app and loads all indexes before forking (preload_app), so workers start warm and share the
+loaded pages copy-on-write until they modify them. The caches are per process afterwards, see the TTLs below.
+"""
+import gc
+import multiprocessing
+import os
+
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WORKERS", multiprocessing.cpu_count()))
+worker_class = "uvicorn_worker.UvicornWorker"
+
+preload_app = True
+
+# Favourites and follows written through one worker reach the membership caches of the others after this many seconds
+MEMBERSHIP_TTL = 2
+
+# Favourites written through one worker reach the sampling weights of the others after this many seconds
+WEIGHTS_TTL = 10
+
+# Favourites and follows queued in one worker stop counting towards its counts after this many seconds, so a worker
+#  failing to commit them does not report counts differing from the other workers for longer than that
+COUNT_DELTA_TTL = 2
+
+
+def when_ready(server) -> None:
+    import database
+    import services
+
+    services.warm_up()
+    services.membership_cache.ttl = MEMBERSHIP_TTL
+    services.post_weights.ttl = WEIGHTS_TTL
+    services.write_queue.count_ttl = COUNT_DELTA_TTL
+
+    # Pooled SQLite connections must not be shared with the forked workers
+    database.engine.dispose()
+
+    # Keeps the garbage collector from touching, and thereby copying, the objects loaded so far in every worker
+    gc.freeze()
+
+
+def post_fork(server, worker) -> None:
+    import database
+
+    database.engine.dispose(close=False)
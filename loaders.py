@@ -0,0 +1,112 @@
+import asyncio
+from collections.abc import Callable, Hashable, Iterable
+from typing import Any
+
+import sqlalchemy.orm
+
+import media
+import models
+import schemas
+
+
+class BatchLoader:
+    """Collects the keys looked up within one event loop tick and resolves all of them with one call of `fetch`.
+
+    `fetch(keys, db)` returns a dictionary of the keys it found, missing keys resolve to None. Only lookups issued
+    together are batched, e.g. by `load_many` or asyncio.gather, lookups awaited one after another still cost one
+    query each.
+    """
+
+    def __init__(self, fetch: Callable[[list, sqlalchemy.orm.Session], dict], db: sqlalchemy.orm.Session):
+        self.fetch = fetch
+        self.db = db
+
+        self.pending: dict[Hashable, asyncio.Future] = {}
+
+    def load(self, key: Hashable) -> asyncio.Future:
+        future = self.pending.get(key)
+
+        if future is None:
+            loop = asyncio.get_running_loop()
+
+            # The first lookup of a tick schedules the batch, which runs once the current tasks yield
+            if not self.pending:
+                loop.call_soon(self.dispatch)
+
+            future = self.pending[key] = loop.create_future()
+
+        return future
+
+    async def load_many(self, keys: Iterable[Hashable]) -> list[Any]:
+        return list(await asyncio.gather(*(self.load(i) for i in keys)))
+
+    def dispatch(self) -> None:
+        pending, self.pending = self.pending, {}
+
+        try:
+            found = self.fetch(list(pending), self.db)
+        except Exception as error:
+            # Raised in every lookup of the batch instead of in the event loop
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        for key, future in pending.items():
+            if not future.done():
+                future.set_result(found.get(key))
+
+
+def get_loader(db: sqlalchemy.orm.Session, fetch: Callable[[list, sqlalchemy.orm.Session], dict]) -> BatchLoader:
+    """Returns the loader of `fetch` for the session, so all lookups of one request are batched together."""
+    session_loaders = db.info.setdefault("loaders", {})
+
+    if fetch not in session_loaders:
+        session_loaders[fetch] = BatchLoader(fetch, db)
+
+    return session_loaders[fetch]
+
+
+def fetch_posts(post_ids: list[int], db: sqlalchemy.orm.Session) -> dict[int, schemas.Post]:
+    return {post.id: schemas.Post.model_validate(post)
+            for post in db.query(models.Post).filter(models.Post.id.in_(post_ids))}
+
+
+def fetch_bots(bot_ids: list[int], db: sqlalchemy.orm.Session) -> dict[int, schemas.Bot]:
+    bots = media.add_bot_images([schemas.Bot.model_validate(bot)
+                                 for bot in db.query(models.Bot).filter(models.Bot.id.in_(bot_ids))], db)
+
+    return {bot.id: bot for bot in bots}
+
+
+def fetch_tags(tag_ids: list[int], db: sqlalchemy.orm.Session) -> dict[int, schemas.Tag]:
+    return {tag.id: schemas.Tag.model_validate(tag) for tag in db.query(models.Tag).filter(models.Tag.id.in_(tag_ids))}
+
+
+def fetch_by_name(query: sqlalchemy.orm.Query, column: sqlalchemy.orm.InstrumentedAttribute,
+                  names: list[str]) -> dict[str, Any]:
+    """Returns the row whose `column` equals each of the names ignoring case, preferring an exact match."""
+    rows = query.filter(column.collate("NOCASE").in_(names)).all()
+
+    found = {}
+
+    for name in names:
+        matches = [i for i in rows if getattr(i, column.key).lower() == name.lower()]
+
+        if matches:
+            found[name] = next((i for i in matches if getattr(i, column.key) == name), matches[0])
+
+    return found
+
+
+def fetch_bots_by_username(usernames: list[str], db: sqlalchemy.orm.Session) -> dict[str, schemas.Bot]:
+    found = {name: schemas.Bot.model_validate(bot)
+             for name, bot in fetch_by_name(db.query(models.Bot), models.Bot.username, usernames).items()}
+    media.add_bot_images(list(found.values()), db)
+
+    return found
+
+
+def fetch_tags_by_name(names: list[str], db: sqlalchemy.orm.Session) -> dict[str, schemas.Tag]:
+    return {name: schemas.Tag.model_validate(tag)
+            for name, tag in fetch_by_name(db.query(models.Tag), models.Tag.name, names).items()}
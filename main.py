@@ -1,3 +1,6 @@
+import asyncio
+import contextlib
+
 import fastapi
 import fastapi.security
 
@@ -5,8 +8,15 @@ import sqlalchemy.orm
 from fastapi import Query
 from starlette.middleware.cors import CORSMiddleware
 
+import admission
+import compression
+import diagnostics
+import media
+import query_log
+import replica
 import schemas
 import services
+import similarity
 
 # Database setup script:
 """
@@ -17,9 +27,52 @@ if os.path.exists("database.db"):
 services.create_database()
 
 services.import_comicvine_data(next(services.get_db()))
+media.import_bot_images(next(services.get_db()))
 """
 
-app = fastapi.FastAPI()
+@contextlib.asynccontextmanager
+async def lifespan(_: fastapi.FastAPI):
+    services.load_monitor.start()
+    services.write_queue.start()
+
+    if services.blocking_detector is not None:
+        services.blocking_detector.start(app)
+
+    if services.slow_query_log is not None:
+        services.slow_query_log.start(app)
+
+    if services.read_snapshot is not None:
+        services.read_snapshot.start()
+
+    # Requests are accepted while warming up, /api/ready reports when it is done. Workers forked from a warmed up
+    #  gunicorn master (see gunicorn.conf.py) find everything loaded already
+    warmup = asyncio.create_task(asyncio.to_thread(services.warm_up))
+
+    yield
+
+    await warmup
+    services.load_monitor.stop()
+
+    if services.blocking_detector is not None:
+        services.blocking_detector.stop()
+
+    if services.slow_query_log is not None:
+        services.slow_query_log.stop()
+
+    # Commits the favourites and follows still queued
+    services.write_queue.stop()
+
+    if services.read_snapshot is not None:
+        services.read_snapshot.stop()
+
+
+app = fastapi.FastAPI(lifespan=lifespan, dependencies=[fastapi.Depends(services.rate_limiter.limit())])
+
+
+app.add_middleware(diagnostics.ProfilingMiddleware, authorize=services.is_admin_request)
+
+if services.slow_query_log is not None:
+    app.add_middleware(query_log.ScopeMiddleware)
 
 
 origins = [
@@ -34,6 +87,8 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(compression.CompressionMiddleware, minimum_size=compression.MINIMUM_SIZE)
+
 
 @app.get("/")
 async def root_redirect():
@@ -46,10 +101,37 @@ async def hello_world():
     return {"message": "Hello World"}
 
 
+@app.get("/api/ready", response_model=dict[str, str])
+async def readiness():
+    if not services.warmed_up.is_set():
+        raise fastapi.HTTPException(status_code=503, detail="Warming up")
+
+    return {"message": "Ready"}
+
+
+@app.get("/api/admin/blocking", response_model=schemas.BlockingReport,
+         dependencies=[fastapi.Depends(services.require_admin)])
+async def get_blocking_report():
+    return services.get_blocking_report()
+
+
+@app.get("/api/admin/profile", response_class=fastapi.responses.PlainTextResponse,
+         dependencies=[fastapi.Depends(services.require_admin)])
+async def get_profile(duration: float = Query(5, gt=0, le=diagnostics.MAX_PROFILE_DURATION)):
+    return await services.get_profile(duration)
+
+
+@app.get("/api/admin/queries", response_model=schemas.QueryReport,
+         dependencies=[fastapi.Depends(services.require_admin)])
+async def get_query_report():
+    return services.get_query_report()
+
+
 # -------------------------------------------------------------------------------------------------------------------- #
 
 
-@app.post("/api/users", response_model=dict[str, str])
+@app.post("/api/users", response_model=dict[str, str],
+          dependencies=[fastapi.Depends(services.rate_limiter.limit("users"))])
 async def create_user(
         user: schemas.UserCreate,
         db: sqlalchemy.orm.Session = fastapi.Depends(services.get_db)
@@ -80,7 +162,8 @@ async def get_user(
     return user
 
 
-@app.put("/api/users/me", response_model=dict[str, str])
+@app.put("/api/users/me", response_model=dict[str, str],
+         dependencies=[fastapi.Depends(services.rate_limiter.limit("users"))])
 async def update_user(
         updated_user: schemas.UserUpdate,
         user: schemas.User = fastapi.Depends(services.get_current_user),
@@ -89,7 +172,8 @@ async def update_user(
     return await services.update_user(user.id, updated_user, db)
 
 
-@app.delete("/api/users/me", response_model=dict[str, str])
+@app.delete("/api/users/me", response_model=dict[str, str],
+            dependencies=[fastapi.Depends(services.rate_limiter.limit("users"))])
 async def delete_user(
         updated_user: schemas.UserUpdate,
         user: schemas.User = fastapi.Depends(services.get_current_user),
@@ -98,7 +182,8 @@ async def delete_user(
     return await services.delete_user(user.id, updated_user, db)
 
 
-@app.post("/api/token", response_model=dict[str, str])
+@app.post("/api/token", response_model=dict[str, str],
+          dependencies=[fastapi.Depends(services.rate_limiter.limit("token"))])
 async def generate_token(
         form_data: fastapi.security.OAuth2PasswordRequestForm = fastapi.Depends(),
         db: sqlalchemy.orm.Session = fastapi.Depends(services.get_db)
@@ -115,13 +200,14 @@ async def generate_token(
 
 
 @app.get("/api/posts/random", response_model=list[schemas.Post],
-         dependencies=[fastapi.Depends(services.require_authentication)])
+         dependencies=[fastapi.Depends(services.require_authentication),
+                       fastapi.Depends(services.rate_limiter.limit("feed", shed=True))])
 async def get_random_posts(
-        count: int = 5,
+        count: int = Query(5, ge=0, le=admission.MAX_COUNT),
 
         user: schemas.User = fastapi.Depends(services.get_current_user),
 
-        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_db),
+        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_read_db(replica.FEED_STALENESS)),
 
         by_tag: int | None = Query(default=None),
         by_bot: int | None = Query(default=None),
@@ -131,23 +217,40 @@ async def get_random_posts(
 
         use_filter: str | None = Query(default=None),
         x: list[int] | None = Query(default=None),
+
+        strategy: str | None = Query(default=None),
+
+        any_tag: list[int] | None = Query(default=None),
+        exclude_tag: list[int] | None = Query(default=None),
+        exclude_bot: list[int] | None = Query(default=None),
+        exclude_filter: str | None = Query(default=None),
+
+        expand_tag: bool | None = Query(default=None),
+
+        fields: str | None = Query(default=None),
 ):
     if x is None:
         x = []
 
-    return await services.get_random_posts(
+    posts = await services.get_random_posts(
         count, user, db,
         by_tag=by_tag, by_bot=by_bot, by_or_mentioned=by_or_mentioned,
         favorites_only=favorites_only,
         use_filter=use_filter,
-        exclude=x
+        exclude=x,
+        strategy=strategy,
+        any_tag=any_tag, exclude_tag=exclude_tag, exclude_bot=exclude_bot,
+        exclude_filter=exclude_filter,
+        expand_tag=expand_tag,
     )
 
+    return services.select_fields(posts, fields, schemas.Post)
+
 
 @app.get("/api/posts/random/info", response_model=schemas.FavoriteCount)
 async def get_favorite_posts_count(
         user: schemas.User = fastapi.Depends(services.get_current_user),
-        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_db)
+        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_read_db(replica.INFO_STALENESS))
 ):
     return await services.get_favorite_posts_count(user, db)
 
@@ -156,7 +259,7 @@ async def get_favorite_posts_count(
          dependencies=[fastapi.Depends(services.require_authentication)])
 async def get_post(
         post_id: int,
-        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_db)
+        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_read_db(replica.ENTITY_STALENESS))
 ):
     return await services.get_post(post_id, db)
 
@@ -166,11 +269,24 @@ async def get_post(
 async def get_post_info(
         post_id: int,
         user: schemas.User = fastapi.Depends(services.get_current_user),
-        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_db)
+        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_read_db(replica.INFO_STALENESS))
 ):
     return await services.get_post_info(post_id, db, user=user)
 
 
+@app.get("/api/posts/{post_id}/similar", response_model=list[schemas.Post],
+         dependencies=[fastapi.Depends(services.require_authentication)])
+async def get_similar_posts(
+        post_id: int,
+        count: int = Query(5, ge=1, le=similarity.MAX_SIMILAR),
+        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_read_db(replica.ENTITY_STALENESS)),
+        fields: str | None = Query(default=None),
+):
+    posts = await services.get_similar_posts(post_id, count, db)
+
+    return services.select_fields(posts, fields, schemas.Post)
+
+
 @app.post("/api/posts/{post_id}/favorite", response_model=schemas.PostInfo)
 async def favorite_post(
         post_id: int,
@@ -193,34 +309,50 @@ async def unfavorite_post(
 
 
 @app.get("/api/bots/random", response_model=list[schemas.Bot],
-         dependencies=[fastapi.Depends(services.require_authentication)])
+         dependencies=[fastapi.Depends(services.require_authentication),
+                       fastapi.Depends(services.rate_limiter.limit("feed", shed=True))])
 async def get_random_bots(
-        count: int = 5,
+        count: int = Query(5, ge=0, le=admission.MAX_COUNT),
 
         user: schemas.User = fastapi.Depends(services.get_current_user),
 
-        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_db),
+        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_read_db(replica.FEED_STALENESS)),
 
         following_only: bool | None = Query(default=None),
 
         x: list[int] | None = Query(default=None),
+
+        fields: str | None = Query(default=None),
 ):
-    return await services.get_random_bots(count, user, db, following_only=following_only, exclude=x)
+    bots = await services.get_random_bots(count, user, db, following_only=following_only, exclude=x)
+
+    return services.select_fields(bots, fields, schemas.Bot)
 
 
 @app.get("/api/bots/random/info", response_model=schemas.FollowingCount)
 async def get_followed_bot_count(
         user: schemas.User = fastapi.Depends(services.get_current_user),
-        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_db)
+        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_read_db(replica.INFO_STALENESS))
 ):
     return await services.get_followed_bot_count(user, db)
 
 
+@app.get("/api/bots/suggest", response_model=list[schemas.Bot],
+         dependencies=[fastapi.Depends(services.require_authentication)])
+async def suggest_bots(
+        q: str,
+        count: int = 10,
+        fields: str | None = Query(default=None),
+        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_read_db(replica.ENTITY_STALENESS))
+):
+    return services.select_fields(await services.suggest_bots(q, count, db), fields, schemas.Bot)
+
+
 @app.get("/api/bots/{bot_id_or_username}", response_model=schemas.Bot,
          dependencies=[fastapi.Depends(services.require_authentication)])
 async def get_bot(
         bot_id_or_username: int | str,
-        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_db)
+        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_read_db(replica.ENTITY_STALENESS))
 ):
     return await services.get_bot(bot_id_or_username, db)
 
@@ -230,11 +362,32 @@ async def get_bot(
 async def get_bot_info(
         bot_id_or_username: int | str,
         user: schemas.User = fastapi.Depends(services.get_current_user),
-        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_db)
+        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_read_db(replica.INFO_STALENESS))
 ):
     return await services.get_bot_info(bot_id_or_username, db, user=user)
 
 
+@app.get("/api/bots/{bot_id_or_username}/page", response_model=schemas.BotPage,
+         dependencies=[fastapi.Depends(services.rate_limiter.limit("feed", shed=True))])
+async def get_bot_page(
+        bot_id_or_username: int | str,
+        count: int = Query(5, ge=0, le=admission.MAX_COUNT),
+        user: schemas.User = fastapi.Depends(services.get_current_user),
+        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_read_db(replica.INFO_STALENESS))
+):
+    return await services.get_bot_page(bot_id_or_username, count, user, db)
+
+
+@app.get("/api/bots/{bot_id_or_username}/connections", response_model=schemas.BotConnections,
+         dependencies=[fastapi.Depends(services.require_authentication)])
+async def get_bot_connections(
+        bot_id_or_username: int | str,
+        count: int = 10,
+        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_read_db(replica.ENTITY_STALENESS))
+):
+    return await services.get_bot_connections(bot_id_or_username, count, db)
+
+
 @app.post("/api/bots/{bot_id_or_username}/follow", response_model=schemas.BotInfo)
 async def follow_bot(
         bot_id_or_username: int | str,
@@ -257,36 +410,52 @@ async def unfollow_bot(
 
 
 @app.get("/api/tags/random", response_model=list[schemas.Tag],
-         dependencies=[fastapi.Depends(services.require_authentication)])
+         dependencies=[fastapi.Depends(services.require_authentication),
+                       fastapi.Depends(services.rate_limiter.limit("feed", shed=True))])
 async def get_random_tags(
-        count: int = 5,
+        count: int = Query(5, ge=0, le=admission.MAX_COUNT),
 
         user: schemas.User = fastapi.Depends(services.get_current_user),
 
-        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_db),
+        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_read_db(replica.FEED_STALENESS)),
 
         following_only: bool | None = Query(default=None),
 
         x: list[int] | None = Query(default=None),
+
+        fields: str | None = Query(default=None),
 ):
     if x is None:
         x = []
-    return await services.get_random_tags(count, user, db, following_only=following_only, exclude=x)
+    tags = await services.get_random_tags(count, user, db, following_only=following_only, exclude=x)
+
+    return services.select_fields(tags, fields, schemas.Tag)
 
 
 @app.get("/api/tags/random/info", response_model=schemas.FollowingCount)
 async def get_followed_tag_count(
         user: schemas.User = fastapi.Depends(services.get_current_user),
-        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_db)
+        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_read_db(replica.INFO_STALENESS))
 ):
     return await services.get_followed_tag_count(user, db)
 
 
+@app.get("/api/tags/suggest", response_model=list[schemas.Tag],
+         dependencies=[fastapi.Depends(services.require_authentication)])
+async def suggest_tags(
+        q: str,
+        count: int = 10,
+        fields: str | None = Query(default=None),
+        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_read_db(replica.ENTITY_STALENESS))
+):
+    return services.select_fields(await services.suggest_tags(q, count, db), fields, schemas.Tag)
+
+
 @app.get("/api/tags/{tag_id_or_name}", response_model=schemas.Tag,
          dependencies=[fastapi.Depends(services.require_authentication)])
 async def get_tag(
         tag_id_or_name: int | str,
-        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_db)
+        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_read_db(replica.ENTITY_STALENESS))
 ):
     return await services.get_tag(tag_id_or_name, db)
 
@@ -296,11 +465,32 @@ async def get_tag(
 async def get_tag_info(
         tag_id_or_name: int | str,
         user: schemas.User = fastapi.Depends(services.get_current_user),
-        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_db)
+        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_read_db(replica.INFO_STALENESS))
 ):
     return await services.get_tag_info(tag_id_or_name, db, user=user)
 
 
+@app.get("/api/tags/{tag_id_or_name}/page", response_model=schemas.TagPage,
+         dependencies=[fastapi.Depends(services.rate_limiter.limit("feed", shed=True))])
+async def get_tag_page(
+        tag_id_or_name: int | str,
+        count: int = Query(5, ge=0, le=admission.MAX_COUNT),
+        user: schemas.User = fastapi.Depends(services.get_current_user),
+        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_read_db(replica.INFO_STALENESS))
+):
+    return await services.get_tag_page(tag_id_or_name, count, user, db)
+
+
+@app.get("/api/tags/{tag_id_or_name}/related", response_model=list[schemas.RelatedTag],
+         dependencies=[fastapi.Depends(services.require_authentication)])
+async def get_related_tags(
+        tag_id_or_name: int | str,
+        count: int = 10,
+        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_read_db(replica.ENTITY_STALENESS))
+):
+    return await services.get_related_tags(tag_id_or_name, count, db)
+
+
 @app.post("/api/tags/{tag_id_or_name}/follow", response_model=schemas.TagInfo)
 async def follow_tag(
         tag_id_or_name: int | str,
@@ -317,3 +507,32 @@ async def unfollow_tag(
         db: sqlalchemy.orm.Session = fastapi.Depends(services.get_db)
 ):
     return await services.unfollow_tag(tag_id_or_name, user, db)
+
+
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+@app.get("/api/media/bots/{bot_id_or_username}/{variant}")
+async def get_bot_image(
+        request: fastapi.Request,
+        bot_id_or_username: int | str,
+        variant: str,
+        db: sqlalchemy.orm.Session = fastapi.Depends(services.get_read_db(replica.ENTITY_STALENESS))
+):
+    bot = await services.get_bot(bot_id_or_username, db)
+
+    path, media_type = media.get_bot_media_file(bot, variant, request.headers.get("accept", ""), db)
+
+    return media.file_response(request, path, media_type, media.BOT_CACHE_CONTROL, vary="Accept")
+
+
+@app.get("/api/media/{digest}/{variant}.{extension}")
+async def get_media(
+        request: fastapi.Request,
+        digest: str,
+        variant: str,
+        extension: str
+):
+    path, media_type = media.get_media_file(digest, variant, extension)
+
+    return media.file_response(request, path, media_type, media.IMMUTABLE_CACHE_CONTROL)
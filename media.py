@@ -0,0 +1,244 @@
+import hashlib
+import io
+import os
+import re
+
+import fastapi
+import fastapi.responses
+import sqlalchemy.exc
+import sqlalchemy.orm
+
+import models
+import schemas
+
+
+MEDIA_DIRECTORY = "./media"
+
+# Longest side in pixels of every generated variant, smaller images are never upscaled
+VARIANTS = {
+    "thumbnail": 96,
+    "card": 320,
+    "full": 1024,
+}
+
+MEDIA_TYPES = {
+    "jpg": "image/jpeg",
+    "png": "image/png",
+    "webp": "image/webp",
+}
+
+# Files addressed by their digest never change, files addressed by bot may point to a new image after a re-import
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+BOT_CACHE_CONTROL = "public, max-age=86400"
+
+DIGEST_PATTERN = re.compile(r"[0-9a-f]{64}")
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+# <editor-fold desc="Storage">
+# Pillow and urllib are only needed to import images, they are imported there to keep them out of the API process
+def get_directory(digest: str) -> str:
+    return os.path.join(MEDIA_DIRECTORY, digest[:2], digest)
+
+
+def get_path(digest: str, variant: str, extension: str) -> str:
+    return os.path.join(get_directory(digest), f"{variant}.{extension}")
+
+
+def download(url: str) -> bytes:
+    import urllib.request
+
+    request = urllib.request.Request(url, headers={"User-Agent": "api.michelfinley.de media import"})
+
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return response.read()
+
+
+def generate_variants(data: bytes, digest: str) -> None:
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+
+    has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+    image = image.convert("RGBA" if has_alpha else "RGB")
+
+    os.makedirs(get_directory(digest), exist_ok=True)
+
+    for variant, size in VARIANTS.items():
+        resized = image.copy()
+        resized.thumbnail((size, size), Image.Resampling.LANCZOS)
+
+        if has_alpha:
+            save(resized, get_path(digest, variant, "png"), "PNG", optimize=True)
+        else:
+            save(resized, get_path(digest, variant, "jpg"), "JPEG", quality=85, optimize=True, progressive=True)
+
+        save(resized, get_path(digest, variant, "webp"), "WEBP", quality=80, method=6)
+
+
+def save(image, path: str, image_format: str, **params) -> None:
+    # Written to a temporary file first, so a concurrent request never serves a half-written image
+    temporary_path = f"{path}.tmp"
+    image.save(temporary_path, image_format, **params)
+    os.replace(temporary_path, path)
+
+
+def find_file(digest: str, variant: str, extensions: list[str]) -> str | None:
+    for extension in extensions:
+        path = get_path(digest, variant, extension)
+        if os.path.isfile(path):
+            return path
+
+
+def has_variants(digest: str) -> bool:
+    return all(find_file(digest, variant, ["jpg", "png"]) is not None for variant in VARIANTS)
+
+
+def store_image(url: str, db: sqlalchemy.orm.Session) -> models.Media:
+    media = db.query(models.Media).filter_by(url=url).first()
+
+    if media is not None and has_variants(media.digest):
+        return media
+
+    data = download(url)
+    digest = hashlib.sha256(data).hexdigest()
+
+    if not has_variants(digest):
+        generate_variants(data, digest)
+
+    if media is None:
+        media = models.Media(url=url)
+        db.add(media)
+
+    media.digest = digest
+
+    db.commit()
+    db.refresh(media)
+
+    return media
+
+
+def import_bot_images(db: sqlalchemy.orm.Session) -> None:
+    import urllib.error
+    from PIL import UnidentifiedImageError
+
+    models.Media.__table__.create(bind=db.get_bind(), checkfirst=True)
+
+    bots = db.query(models.Bot).all()
+
+    for pos, bot in enumerate(bots):
+        try:
+            media = store_image(bot.image, db)
+        except (urllib.error.URLError, UnidentifiedImageError, OSError) as error:
+            print(f"({pos + 1} / {len(bots)}) Could not store image of bot {bot.username}: {error}")
+            continue
+
+        print(f"({pos + 1} / {len(bots)}) Stored image of bot {bot.username} as {media.digest}")
+# </editor-fold>
+
+
+# <editor-fold desc="Serving">
+def get_media_file(digest: str, variant: str, extension: str) -> tuple[str, str]:
+    if not DIGEST_PATTERN.fullmatch(digest) or variant not in VARIANTS or extension not in MEDIA_TYPES:
+        raise fastapi.HTTPException(status_code=404, detail="Media not found")
+
+    path = get_path(digest, variant, extension)
+
+    if not os.path.isfile(path):
+        raise fastapi.HTTPException(status_code=404, detail="Media not found")
+
+    return path, MEDIA_TYPES[extension]
+
+
+def get_imported(urls: list[str], db: sqlalchemy.orm.Session) -> dict[str, models.Media]:
+    try:
+        return {media.url: media for media in db.query(models.Media).filter(models.Media.url.in_(urls))}
+    except sqlalchemy.exc.OperationalError:
+        # The media table only exists once import_bot_images or create_database ran
+        db.rollback()
+        return {}
+
+
+def add_bot_images(bots: list[schemas.Bot], db: sqlalchemy.orm.Session) -> list[schemas.Bot]:
+    """Points the bots whose image was imported to its variants, so clients load those instead of the original."""
+    imported = get_imported(list({bot.image for bot in bots}), db)
+
+    for bot in bots:
+        if bot.image in imported:
+            bot.images = schemas.BotImages(**{variant: f"/api/media/bots/{bot.id}/{variant}" for variant in VARIANTS})
+
+    return bots
+
+
+def get_bot_media_file(bot: schemas.Bot, variant: str, accept: str,
+                       db: sqlalchemy.orm.Session) -> tuple[str, str]:
+    if variant not in VARIANTS:
+        raise fastapi.HTTPException(status_code=404, detail=f"There is no image variant {variant}")
+
+    media = get_imported([bot.image], db).get(bot.image)
+
+    if media is None:
+        raise fastapi.HTTPException(status_code=404, detail=f"The image of bot {bot.username} has not been imported")
+
+    extensions = ["jpg", "png"]
+
+    if "image/webp" in accept:
+        extensions.insert(0, "webp")
+
+    path = find_file(media.digest, variant, extensions)
+
+    if path is None:
+        raise fastapi.HTTPException(status_code=404, detail=f"The image of bot {bot.username} has not been imported")
+
+    return path, MEDIA_TYPES[path.rsplit(".", 1)[-1]]
+
+
+def file_response(request: fastapi.Request, path: str, media_type: str,
+                  cache_control: str, vary: str | None = None) -> fastapi.Response:
+    """Serves a file with an ETag, conditional requests and single byte-range requests."""
+    stat = os.stat(path)
+    size = stat.st_size
+
+    etag = f'"{os.path.basename(os.path.dirname(path))}-{os.path.basename(path)}"'
+
+    headers = {
+        "Cache-Control": cache_control,
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+    }
+
+    if vary is not None:
+        headers["Vary"] = vary
+
+    if etag in [i.strip() for i in request.headers.get("if-none-match", "").split(",")]:
+        return fastapi.Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+
+    if range_header is not None and (if_range is None or if_range == etag):
+        match = RANGE_PATTERN.fullmatch(range_header.strip())
+
+        # Multiple ranges are not supported, in which case the whole file is sent as permitted by RFC 9110
+        if match is not None and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(size - int(match.group(2)), 0)
+                end = size - 1
+
+            if start > end or start >= size:
+                headers["Content-Range"] = f"bytes */{size}"
+                return fastapi.Response(status_code=416, headers=headers)
+
+            with open(path, "rb") as file:
+                file.seek(start)
+                content = file.read(end - start + 1)
+
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+            return fastapi.Response(content=content, status_code=206, media_type=media_type, headers=headers)
+
+    return fastapi.responses.FileResponse(path, media_type=media_type, headers=headers, stat_result=stat)
+# </editor-fold>
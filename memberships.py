@@ -0,0 +1,119 @@
+import array
+import bisect
+import collections
+import threading
+import time
+from collections.abc import Callable
+
+import sqlalchemy.orm
+
+import models
+
+
+# Number of users whose favourites and follows are kept in memory, the least recently used are evicted first
+CAPACITY = 1024
+
+FAVORITE_POSTS = "favorite_posts"
+FOLLOWED_BOTS = "followed_bots"
+FOLLOWED_TAGS = "followed_tags"
+
+
+class UserMemberships:
+    """Favourited post ids and followed bot and tag ids of one user, each kept as a sorted array of 64-bit ints."""
+
+    def __init__(self, favorite_posts: list[int], followed_bots: list[int], followed_tags: list[int]):
+        self.ids = {
+            FAVORITE_POSTS: array.array("q", sorted(set(favorite_posts))),
+            FOLLOWED_BOTS: array.array("q", sorted(set(followed_bots))),
+            FOLLOWED_TAGS: array.array("q", sorted(set(followed_tags))),
+        }
+
+    def contains(self, kind: str, item_id: int) -> bool:
+        ids = self.ids[kind]
+        position = bisect.bisect_left(ids, item_id)
+        return position < len(ids) and ids[position] == item_id
+
+    def add(self, kind: str, item_id: int) -> None:
+        if not self.contains(kind, item_id):
+            bisect.insort(self.ids[kind], item_id)
+
+    def remove(self, kind: str, item_id: int) -> None:
+        if self.contains(kind, item_id):
+            del self.ids[kind][bisect.bisect_left(self.ids[kind], item_id)]
+
+
+class MembershipCache:
+    """LRU cache of UserMemberships, loaded on first use and updated write-through by the favourite/follow services.
+
+    Updates for users which are not cached are ignored, their memberships are read from the database once needed.
+    With several worker processes, writes only reach the cache of the process handling them, so `ttl` bounds how
+    many seconds other processes may serve outdated memberships.
+    """
+
+    def __init__(self, capacity: int = CAPACITY, ttl: float | None = None):
+        self.capacity = capacity
+        self.ttl = ttl
+
+        # Returns `(kind, item_id, added)` of changes not yet committed, applied on top of what is loaded
+        self.overlay: Callable[[int], list[tuple[str, int, bool]]] | None = None
+
+        self.users = collections.OrderedDict()
+        self.loaded_at = {}
+        self.lock = threading.Lock()
+
+    def get_user(self, user_id: int, db: sqlalchemy.orm.Session) -> UserMemberships:
+        with self.lock:
+            memberships = self.users.get(user_id)
+
+            if memberships is not None and (self.ttl is None or time.monotonic() - self.loaded_at[user_id] < self.ttl):
+                self.users.move_to_end(user_id)
+                return memberships
+
+        # Read first, so changes committed while loading are either in the overlay or already in the database
+        overlay = self.overlay(user_id) if self.overlay is not None else []
+
+        favorite_posts = [i for (i,) in db.query(models.FavoriteMap.post_id).filter_by(user_id=user_id)]
+        follows = db.query(models.FollowingMap.bot_id, models.FollowingMap.tag_id).filter_by(follower_id=user_id).all()
+
+        memberships = UserMemberships(
+            favorite_posts,
+            [bot_id for bot_id, _ in follows if bot_id is not None],
+            [tag_id for _, tag_id in follows if tag_id is not None],
+        )
+
+        for kind, item_id, added in overlay:
+            if added:
+                memberships.add(kind, item_id)
+            else:
+                memberships.remove(kind, item_id)
+
+        with self.lock:
+            self.users[user_id] = memberships
+            self.users.move_to_end(user_id)
+            self.loaded_at[user_id] = time.monotonic()
+
+            while len(self.users) > self.capacity:
+                del self.loaded_at[self.users.popitem(last=False)[0]]
+
+        return memberships
+
+    def get(self, user_id: int, kind: str, db: sqlalchemy.orm.Session) -> array.array:
+        return self.get_user(user_id, db).ids[kind]
+
+    def contains(self, user_id: int, kind: str, item_id: int, db: sqlalchemy.orm.Session) -> bool:
+        return self.get_user(user_id, db).contains(kind, item_id)
+
+    def add(self, user_id: int, kind: str, item_id: int) -> None:
+        with self.lock:
+            if user_id in self.users:
+                self.users[user_id].add(kind, item_id)
+
+    def remove(self, user_id: int, kind: str, item_id: int) -> None:
+        with self.lock:
+            if user_id in self.users:
+                self.users[user_id].remove(kind, item_id)
+
+    def invalidate(self, user_id: int) -> None:
+        with self.lock:
+            self.users.pop(user_id, None)
+            self.loaded_at.pop(user_id, None)
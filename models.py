@@ -39,6 +39,10 @@ class Bot(database.Base):
     owner = orm.relationship("Organisation", back_populates="bots")
 
 
+# Case-insensitive lookups compare with COLLATE NOCASE, which only an index of the same collation can serve
+sql.Index("ix_bots_username_nocase", Bot.username.collate("NOCASE"))
+
+
 class Post(database.Base):
     __tablename__ = "posts"
     id = sql.Column(sql.Integer, primary_key=True, index=True)
@@ -55,6 +59,9 @@ class Tag(database.Base):
     name = sql.Column(sql.String, index=True)
 
 
+sql.Index("ix_tags_name_nocase", Tag.name.collate("NOCASE"))
+
+
 class TagMap(database.Base):
     __tablename__ = "tagmap"
     id = sql.Column(sql.Integer, primary_key=True, index=True)
@@ -82,3 +89,11 @@ class FollowingMap(database.Base):
     tag_id = sql.Column(sql.Integer, index=True)
     bot_id = sql.Column(sql.Integer, index=True)
     follower_id = sql.Column(sql.Integer, index=True)
+
+
+class Media(database.Base):
+    __tablename__ = "media"
+    id = sql.Column(sql.Integer, primary_key=True, index=True)
+
+    url = sql.Column(sql.String, unique=True, index=True)
+    digest = sql.Column(sql.String, index=True)
@@ -1,12 +1,29 @@
+import argparse
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from simyan.comicvine import Comicvine
+from simyan.exceptions import ServiceError
+from simyan.schemas.character import Character as ComicvineCharacter
 from simyan.sqlite_cache import SQLiteCache
 
 from organisations.comicvine import database
 from organisations.comicvine.models import Character
 
 
+DIRECTORY = os.path.join(*os.path.split(os.path.abspath(__file__))[:-1])
+
+CHARACTERS_PATH = os.path.join(DIRECTORY, "characters.txt")
+CACHE_PATH = os.path.join(DIRECTORY, "comicvine_cache.sqlite")
+
+# ComicVine allows 200 requests per resource and hour and additionally blocks clients which send requests too fast,
+#  so we stay at a conservative pace of one request per second
+REQUESTS_PER_PERIOD = 1
+PERIOD = 1.0
+
+
 def get_db():
     db = database.SessionLocal()
     try:
@@ -19,115 +36,189 @@ def create_database():
     return database.Base.metadata.create_all(bind=database.engine)
 
 
-if __name__ == '__main__':
-    db_path = os.path.join(*os.path.split(os.path.abspath(__file__))[:-1], "comicvine_data.db")
-    if os.path.isfile(db_path):
-        print("Removing existing database...")
-        os.remove(db_path)
+def load_character_ids(path: str = CHARACTERS_PATH) -> list[int]:
+    """Reads one ComicVine character ID per line, ignoring blank lines and everything after a "#"."""
+    character_ids = []
 
-    print("Creating database...")
-    create_database()
-    comicvine_db = next(get_db())
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            line = line.split("#", 1)[0].strip()
+
+            if line and int(line) not in character_ids:
+                character_ids.append(int(line))
+
+    return character_ids
+
+
+class RateLimiter:
+    """Thread-safe limiter which spaces out calls so that at most `calls` happen within every `period` seconds."""
+
+    def __init__(self, calls: int = REQUESTS_PER_PERIOD, period: float = PERIOD):
+        self.interval = period / calls
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_call - now
+            self.next_call = max(self.next_call, now) + self.interval
+
+        if wait > 0:
+            time.sleep(wait)
 
-    print("Fetching data...")
 
-    with open("api_key") as file:
-        api_key = file.read()
+class ComicvineSession(Comicvine):
+    """Simyan session which only touches the network through the shared rate limiter.
 
-    session = Comicvine(api_key=api_key, cache=SQLiteCache())
+    Cached responses are answered by simyan before `_perform_get_request` is reached, so they are neither rate
+    limited nor require a connection. With `offline` set, cache misses fail instead of hitting the network.
+    """
 
-    character_ids = [
-        22892,  # Tarzan
-        36802,  # Jane Porter (Frau von Tarzan)
-        35482,  # Korak, Tarzan's Sohn
+    def __init__(self, api_key: str, limiter: RateLimiter, cache: SQLiteCache,
+                 api_url: str | None = None, offline: bool = False):
+        super().__init__(api_key=api_key, cache=cache)
 
-        65186,  # Dracula
-        62851,  # Abraham Van Helsing
+        if api_url is not None:
+            self.API_URL = api_url.rstrip("/")
 
-        38840,  # Frankensteins Monster
+        self.limiter = limiter
+        self.offline = offline
 
-        14335,  # Robin Hood
+    def _perform_get_request(self, url: str, params: dict[str, str] | None = None) -> dict:
+        if self.offline:
+            raise ServiceError(f"No cached response for `{url}` available in offline mode")
 
-        63244,  # Sherlock Holmes
-        27015,  # Dr. Watson
+        self.limiter.acquire()
+        return super()._perform_get_request(url, params)
 
-        9793,   # King Arthur
-        39132,  # Merlin (aus King Arthur)
-        6891,   # Morgan le Fay (aus King Arthur)
-        21095,  # Sir Lancelot (aus King Arthur)
 
-        39859,  # Geppetto (Pinocchio's "Vater")
-        34473,  # Pinocchio
+class CharacterFetcher:
+    """Fetches characters concurrently, giving every worker thread its own session and cache connection.
 
-        37176,  # Schneewittchen
-        36109,  # The Evil Queen (aus Schneewittchen)
+    sqlite3 connections may not be shared between threads, which is why the `SQLiteCache` is opened per thread.
+    All sessions share one `RateLimiter`, so the quota holds regardless of the number of workers.
+    """
 
-        4581,   # Red Riding Hood
-        21010,  # Big Bad Wolf
+    def __init__(self, api_key: str, cache_path: str = CACHE_PATH, limiter: RateLimiter | None = None,
+                 api_url: str | None = None, offline: bool = False, workers: int = 4):
+        self.api_key = api_key
+        self.cache_path = cache_path
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self.api_url = api_url
+        self.offline = offline
+        self.workers = workers
 
-        21451,  # Alice
-        21464,  # White Rabbit (Alice im Wunderland)
-        21460,  # Cheshire Cat (Alice im Wunderland)
+        self.local = threading.local()
 
-        21540,  # Captain Hook
-        7868,   # Tinker Bell
-        39853,  # Peter Pan
+    def get_session(self) -> ComicvineSession:
+        session = getattr(self.local, "session", None)
 
-        34103,  # John Carter
-        34145,  # Dejah Thoris (Princess of Mars, Wife of John Carter)
+        if session is None:
+            session = ComicvineSession(self.api_key, self.limiter, SQLiteCache(path=self.cache_path, expiry=None),
+                                       api_url=self.api_url, offline=self.offline)
+            self.local.session = session
 
-        15216,  # Cisco Kid
+        return session
 
-        9826,   # Cinderella
+    def get_character(self, character_id: int) -> ComicvineCharacter:
+        return self.get_session().get_character(character_id)
 
-        65451,  # Aladdin
+    def fetch(self, character_ids: list[int]):
+        """Yields `(character_id, result_or_exception)` tuples in the order in which the requests finish."""
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.get_character, i): i for i in character_ids}
 
-                # The Wizard of Oz
-        24723,  # Dorothy Gale
-        24728,  # Tin Woodman
-        21478,  # Toto
-        24726,  # Scarecrow
-        24717,  # Cowardly Lion
-        25373,  # Wicked Witch of the West
-        16744,  # Glinda, Good Witch of the North
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result()
+                except ServiceError as error:
+                    yield futures[future], error
 
-        57793,  # Baloo
-        56982,  # Mowgli
 
-        33979,  # Prince Charming
+def upsert_character(db, result: ComicvineCharacter) -> Character:
+    """Inserts the character or updates the existing row with the same ComicVine ID, keeping its primary key."""
+    character = db.query(Character).filter_by(comicvine_id=result.id).first()
 
-        39780,  # Humpty Dumpty
+    if character is None:
+        character = Character(comicvine_id=result.id)
+        db.add(character)
 
-        7264,   # Little Boy Blue
-    ]
+    character.nickname = result.real_name if result.real_name is not None and result.real_name != result.name \
+        else None
 
-    for pos, character_id in enumerate(character_ids):
-        print(f"({pos + 1} / {len(character_ids)}) Character ID: {character_id}")
+    character.username = result.name
 
-        result = session.get_character(character_id)
+    character.image = result.image.original_url
 
-        character = Character()
+    character.summary = result.summary
 
-        character.comicvine_id = result.id
+    character.gender = ["", "Male", "Female", "Other"][result.gender]
 
-        if result.real_name is not None and result.real_name != result.name:
-            character.nickname = result.real_name
+    character.date_of_birth = result.date_of_birth.strftime("%d %b %Y") if result.date_of_birth is not None \
+        else None
 
-        character.username = result.name
+    character.powers = ", ".join([i.name for i in result.powers])
 
-        character.image = result.image.original_url
+    return character
 
-        character.summary = result.summary
 
-        character.gender = ["", "Male", "Female", "Other"][result.gender]
+def collect(fetcher: CharacterFetcher, character_ids: list[int], db) -> list[int]:
+    """Fetches all characters and upserts them into the database. Returns the IDs which could not be fetched.
+
+    Characters are upserted in the order of `character_ids` rather than the order the requests finish in, so new
+    rows, and the bots imported from them, get the same primary keys on every run.
+    """
+    results = {}
+    failed = []
+
+    for pos, (character_id, result) in enumerate(fetcher.fetch(character_ids)):
+        if isinstance(result, Exception):
+            print(f"({pos + 1} / {len(character_ids)}) Failed to fetch character {character_id}: {result}")
+            failed.append(character_id)
+            continue
+
+        results[character_id] = result
+
+        print(f"({pos + 1} / {len(character_ids)}) Finished fetching character {result.id} ({result.name})")
+
+    for character_id in character_ids:
+        if character_id in results:
+            upsert_character(db, results[character_id])
+
+    db.commit()
+
+    return [i for i in character_ids if i in failed]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fetches ComicVine characters into comicvine_data.db")
+    parser.add_argument("--characters", default=CHARACTERS_PATH, help="file with one character ID per line")
+    parser.add_argument("--cache", default=CACHE_PATH, help="path of the simyan SQLiteCache")
+    parser.add_argument("--api-url", default=None, help="alternative API root, e.g. a local fake ComicVine server")
+    parser.add_argument("--api-key", default="api_key", help="file containing the ComicVine API key")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rate", type=int, default=REQUESTS_PER_PERIOD, help="requests per period")
+    parser.add_argument("--period", type=float, default=PERIOD, help="rate limit period in seconds")
+    parser.add_argument("--offline", action="store_true", help="only use cached responses")
+    args = parser.parse_args()
+
+    print("Creating database...")
+    create_database()
+    comicvine_db = next(get_db())
+
+    print("Fetching data...")
 
-        if result.date_of_birth is not None:
-            character.date_of_birth = result.date_of_birth.strftime("%d %b %Y")
+    if os.path.isfile(args.api_key):
+        with open(args.api_key) as file:
+            api_key = file.read().strip()
+    else:
+        api_key = ""
 
-        character.powers = ", ".join([i.name for i in result.powers])
+    character_fetcher = CharacterFetcher(api_key, cache_path=args.cache, limiter=RateLimiter(args.rate, args.period),
+                                         api_url=args.api_url, offline=args.offline, workers=args.workers)
 
-        comicvine_db.add(character)
-        comicvine_db.commit()
-        comicvine_db.refresh(character)
+    failed_ids = collect(character_fetcher, load_character_ids(args.characters), comicvine_db)
 
-        print(f"Finished fetching character {character.comicvine_id} ({character.username})\n")
+    if failed_ids:
+        print(f"\nCould not fetch characters {', '.join(str(i) for i in failed_ids)}")
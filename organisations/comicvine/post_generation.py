@@ -2,8 +2,6 @@ import datetime
 import os
 import random
 
-from ctransformers import AutoModelForCausalLM
-
 from organisations.comicvine import database, models
 
 
@@ -34,46 +32,54 @@ def create_prompt_v2(character: models.Character, character_list: list[str]) ->
     return return_string
 
 
-model = AutoModelForCausalLM.from_pretrained("TheBloke/Llama-2-13b-Chat-GGUF",
-                                             model_file="llama-2-13b-chat.q5_K_M.gguf",
-                                             model_type="llama", gpu_layers=50, context_length=1024)
+def main() -> None:
+    # Loading the 13B model takes minutes and several GB of memory, so it only happens when generating posts
+    from ctransformers import AutoModelForCausalLM
+
+    model = AutoModelForCausalLM.from_pretrained("TheBloke/Llama-2-13b-Chat-GGUF",
+                                                 model_file="llama-2-13b-chat.q5_K_M.gguf",
+                                                 model_type="llama", gpu_layers=50, context_length=1024)
+
+    start_datetime = datetime.datetime.now().strftime("%Y-%m-%d@%H-%M")
+
+    comicvine_db = next(get_db())
 
-start_datetime = datetime.datetime.now().strftime("%Y-%m-%d@%H-%M")
+    characters = [character.username for character in comicvine_db.query(models.Character).all()]
 
-comicvine_db = next(get_db())
+    all_characters = characters.copy()
 
-characters = [character.username for character in comicvine_db.query(models.Character).all()]
+    character_count = len(characters)
 
-all_characters = characters.copy()
+    for i in range(character_count):
+        current_character_name = random.choice(characters)
+        characters.remove(current_character_name)
+        current_character = comicvine_db.query(models.Character).filter_by(username=current_character_name).first()
 
-character_count = len(characters)
+        print(f"({i + 1} / {character_count}): {current_character.username}")
 
-for i in range(character_count):
-    current_character_name = random.choice(characters)
-    characters.remove(current_character_name)
-    current_character = comicvine_db.query(models.Character).filter_by(username=current_character_name).first()
+        other_character_names = all_characters.copy()
+        other_character_names.remove(current_character_name)
+        prompt = create_prompt_v2(current_character, other_character_names)
+        print(f"\nCurrent prompt:\n\n{prompt}")
 
-    print(f"({i + 1} / {character_count}): {current_character.username}")
+        response = model(prompt, max_new_tokens=1024)
 
-    other_character_names = all_characters.copy()
-    other_character_names.remove(current_character_name)
-    prompt = create_prompt_v2(current_character, other_character_names)
-    print(f"\nCurrent prompt:\n\n{prompt}")
+        current_datetime = datetime.datetime.now().strftime("%Y-%m-%d@%H-%M-%S")
 
-    response = model(prompt, max_new_tokens=1024)
+        print(f"Result @{current_datetime}:\n{response}\n\n")
 
-    current_datetime = datetime.datetime.now().strftime("%Y-%m-%d@%H-%M-%S")
+        if not os.path.isdir("posts_test"):
+            os.mkdir("posts_test")
 
-    print(f"Result @{current_datetime}:\n{response}\n\n")
+        if not os.path.isdir(f"posts_test/{start_datetime}"):
+            os.mkdir(f"posts_test/{start_datetime}")
 
-    if not os.path.isdir("posts_test"):
-        os.mkdir("posts_test")
+        with open(f"posts_test/{start_datetime}/{current_datetime}_{current_character.username}.txt", "w+",
+                  encoding="utf-8") as file:
+            file.write(response)
 
-    if not os.path.isdir(f"posts_test/{start_datetime}"):
-        os.mkdir(f"posts_test/{start_datetime}")
+        print(f"\n{'-'*32}\n")
 
-    with open(f"posts_test/{start_datetime}/{current_datetime}_{current_character.username}.txt", "w+",
-              encoding="utf-8") as file:
-        file.write(response)
 
-    print(f"\n{'-'*32}\n")
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+import array
+import collections
+import random
+import threading
+
+import numpy as np
+import sqlalchemy.orm
+
+import models
+
+
+# Number of per-tag, per-bot, per-mention and per-term post sets kept in memory
+CAPACITY = 4096
+
+
+def contains(haystack: np.ndarray, needles: np.ndarray) -> np.ndarray:
+    """Returns which of the needles are in the sorted haystack, in O(len(needles) * log(len(haystack)))."""
+    if not len(haystack):
+        return np.zeros(len(needles), dtype=bool)
+
+    indexes = np.minimum(np.searchsorted(haystack, needles), len(haystack) - 1)
+
+    return haystack[indexes] == needles
+
+
+def intersect(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    if len(first) > len(second):
+        first, second = second, first
+
+    return first[contains(second, first)]
+
+
+def subtract(minuend: np.ndarray, subtrahend: np.ndarray) -> np.ndarray:
+    return minuend[~contains(subtrahend, minuend)]
+
+
+def union(post_sets: list[np.ndarray]) -> np.ndarray:
+    return np.unique(np.concatenate(post_sets))
+
+
+class PostFilterIndex:
+    """Evaluates post filters as set operations over sorted arrays of post ids.
+
+    The post set of every tag, bot, mention and search term is queried once and kept as a sorted array of its post
+    ids in an LRU cache. Requests intersect, unite and subtract the sets they need, which costs O(k log n) for sets
+    of k and n posts and memory only in proportion to the posts matched, so combined filters cost no SQL beyond the
+    first use of each predicate. Only filters that merely exclude posts go through the ids of all posts.
+    """
+
+    def __init__(self, capacity: int = CAPACITY):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.loaded = False
+
+        # Incremented by every invalidation, so sets queried before it are not cached after it
+        self.generation = 0
+
+        self.post_ids = np.zeros(0, dtype=np.int64)
+        self.sets = collections.OrderedDict()
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.loaded = False
+            self.generation += 1
+            self.sets.clear()
+
+    def load(self, db: sqlalchemy.orm.Session) -> None:
+        """Queries the ids of all posts without holding the lock, so evaluations wait only for the swap."""
+        if self.loaded:
+            return
+
+        with self.lock:
+            generation = self.generation
+
+        post_ids = np.fromiter((i for (i,) in db.query(models.Post.id).order_by(models.Post.id)), dtype=np.int64)
+
+        with self.lock:
+            self.post_ids = post_ids
+
+            # Posts created while querying are missing, so the next evaluation loads again
+            self.loaded = generation == self.generation
+
+    def get_state(self, db: sqlalchemy.orm.Session) -> tuple[np.ndarray, int]:
+        """Returns the ids of all posts and the generation of the cached sets, taken together."""
+        self.load(db)
+
+        with self.lock:
+            return self.post_ids, self.generation
+
+    def get_set(self, key: tuple, query: sqlalchemy.orm.Query, generation: int) -> np.ndarray:
+        with self.lock:
+            post_ids = self.sets.get(key) if generation == self.generation else None
+
+            if post_ids is not None:
+                self.sets.move_to_end(key)
+                return post_ids
+
+        post_ids = np.unique(np.fromiter((i for (i,) in query), dtype=np.int64))
+
+        with self.lock:
+            if generation == self.generation:
+                self.sets[key] = post_ids
+
+                while len(self.sets) > self.capacity:
+                    self.sets.popitem(last=False)
+
+        return post_ids
+
+    def tag(self, tag_id: int, db: sqlalchemy.orm.Session, generation: int) -> np.ndarray:
+        return self.get_set(("tag", tag_id), db.query(models.TagMap.post_id).filter_by(tag_id=tag_id), generation)
+
+    def bot(self, bot_id: int, db: sqlalchemy.orm.Session, generation: int) -> np.ndarray:
+        return self.get_set(("bot", bot_id), db.query(models.Post.id).filter_by(owner_id=bot_id), generation)
+
+    def mentioned(self, bot_id: int, db: sqlalchemy.orm.Session, generation: int) -> np.ndarray:
+        return self.get_set(("mention", bot_id), db.query(models.MentionMap.post_id).filter_by(mention_id=bot_id),
+                            generation)
+
+    def term(self, term: str, db: sqlalchemy.orm.Session, generation: int) -> np.ndarray:
+        # Matches the case-insensitive LIKE used by the SQL filter before, hence the lowercase cache key
+        return self.get_set(("term", term.lower()), db.query(models.Post.id).filter(
+            models.Post.content.contains(term, autoescape=True)), generation)
+
+    def evaluate(
+            self,
+
+            db: sqlalchemy.orm.Session,
+
+            by_tag: int = None,
+            related_tags: list[int] = None,
+            by_bot: int = None,
+            by_or_mentioned: int = None,
+
+            favorite_posts: array.array = None,
+
+            use_filter: str = None,
+
+            any_tag: list[int] = None,
+            exclude_tag: list[int] = None,
+            exclude_bot: list[int] = None,
+            exclude_filter: str = None,
+    ) -> np.ndarray | None:
+        """Returns the sorted ids of all posts matching every given filter, or None if no filter is given.
+
+        Posts with any of the `related_tags` match `by_tag` as well.
+        """
+        all_post_ids, generation = self.get_state(db)
+
+        included = []
+        excluded = []
+
+        if by_tag:
+            included.append(union([self.tag(tag_id, db, generation) for tag_id in [by_tag, *(related_tags or [])]]))
+
+        if by_bot:
+            included.append(self.bot(by_bot, db, generation))
+
+        if by_or_mentioned:
+            included.append(union([self.bot(by_or_mentioned, db, generation),
+                                   self.mentioned(by_or_mentioned, db, generation)]))
+
+        if favorite_posts is not None:
+            included.append(np.frombuffer(favorite_posts, dtype=np.int64))
+
+        if use_filter:
+            included += [self.term(term, db, generation) for term in use_filter.split(" ")]
+
+        if any_tag:
+            included.append(union([self.tag(tag_id, db, generation) for tag_id in any_tag]))
+
+        excluded += [self.tag(tag_id, db, generation) for tag_id in exclude_tag or []]
+        excluded += [self.bot(bot_id, db, generation) for bot_id in exclude_bot or []]
+
+        if exclude_filter:
+            excluded += [self.term(term, db, generation) for term in exclude_filter.split(" ")]
+
+        if not included and not excluded:
+            return None
+
+        # Intersecting with all posts drops favourites of deleted posts. Smallest sets go first, so every further
+        #  intersection costs at most the size of the result so far
+        matches = all_post_ids
+
+        for post_ids in sorted(included, key=len):
+            matches = intersect(matches, post_ids)
+
+        for post_ids in excluded:
+            matches = subtract(matches, post_ids)
+
+        return matches
+
+    def sample(self, matches: np.ndarray | None, count: int, exclude: list[int]) -> list[int]:
+        """Draws up to `count` distinct post ids uniformly from `matches` (all posts if None), never from `exclude`."""
+        excluded = set(exclude)
+
+        if matches is not None:
+            candidates = subtract(matches, np.array(sorted(excluded), dtype=np.int64))
+            return [int(candidates[i]) for i in random.sample(range(len(candidates)), min(count, len(candidates)))]
+
+        with self.lock:
+            post_ids = self.post_ids
+
+        drawn = []
+
+        # Rejection sampling over all posts, bounded in case `exclude` covers most of them
+        for _ in range(10 * count + len(excluded)):
+            if len(drawn) >= count or len(drawn) + len(excluded) >= len(post_ids):
+                return drawn
+
+            post_id = int(post_ids[random.randrange(len(post_ids))])
+
+            if post_id not in excluded:
+                drawn.append(post_id)
+                excluded.add(post_id)
+
+        remaining = [i for i in post_ids.tolist() if i not in excluded]
+        return drawn + random.sample(remaining, min(count - len(drawn), len(remaining)))
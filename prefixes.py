@@ -0,0 +1,65 @@
+import bisect
+import threading
+from collections.abc import Callable, Iterable
+from typing import Any
+
+import sqlalchemy.orm
+
+import extraction
+
+
+MAX_SUGGESTIONS = 50
+
+
+class PrefixIndex:
+    """Names kept as a sorted list of normalised keys, so all names with a prefix form one contiguous range.
+
+    Suggestions are a binary search plus a slice, without touching the database once loaded. `loader` returns the
+    `(name, item)` pairs to index, the items are returned as they are.
+    """
+
+    def __init__(self, loader: Callable[[sqlalchemy.orm.Session], Iterable[tuple[str, Any]]]):
+        self.loader = loader
+        self.lock = threading.Lock()
+        self.loaded = False
+
+        self.keys = []
+        self.items = []
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.loaded = False
+
+    def load(self, db: sqlalchemy.orm.Session) -> None:
+        with self.lock:
+            if self.loaded:
+                return
+
+            entries = sorted(((extraction.normalise(name), item) for name, item in self.loader(db)),
+                             key=lambda entry: entry[0])
+
+            self.keys = [key for key, _ in entries]
+            self.items = [item for _, item in entries]
+            self.loaded = True
+
+    def get_items(self, db: sqlalchemy.orm.Session) -> list[Any]:
+        """Returns all items in alphabetical order, the list is replaced rather than changed by later loads."""
+        self.load(db)
+
+        with self.lock:
+            return self.items
+
+    def suggest(self, prefix: str, count: int, db: sqlalchemy.orm.Session) -> list[Any]:
+        """Returns up to `count` items whose name starts with `prefix`, ignoring case, in alphabetical order."""
+        self.load(db)
+
+        prefix = extraction.normalise(prefix)
+
+        with self.lock:
+            start = bisect.bisect_left(self.keys, prefix)
+            end = start
+
+            while end < len(self.keys) and end - start < count and self.keys[end].startswith(prefix):
+                end += 1
+
+            return self.items[start:end]
@@ -0,0 +1,346 @@
+import argparse
+import asyncio
+import collections
+import contextvars
+import functools
+import glob
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+
+import fastapi
+import sqlalchemy as sql
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+import diagnostics
+
+
+# Setting this to a number of seconds times every statement and logs those that take longer
+THRESHOLD_VARIABLE = "SLOW_QUERY_THRESHOLD"
+
+# Every worker process saves its statistics here, so reports and the command line cover all workers
+LOG_PATH = "./query_log.{pid}.json"
+SAVE_INTERVAL = 30
+
+# Statistics cover the last WINDOW seconds, kept in buckets of BUCKET_DURATION seconds
+WINDOW = 300
+BUCKET_DURATION = 60
+
+# Durations are counted in a histogram of bins growing by GROWTH from MIN_DURATION, so the p95 is exact to 10%
+MIN_DURATION = 0.00001
+GROWTH = 1.1
+
+MAX_SLOW = 100
+MAX_ORIGINS = 5
+
+APP_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+STRING_PATTERN = re.compile(r"'(?:[^']|'')*'")
+NUMBER_PATTERN = re.compile(r"(?<![\w.])\d+(?:\.\d+)?(?![\w.])")
+WHITESPACE_PATTERN = re.compile(r"\s+")
+# Parameter lists of IN and VALUES, whose length varies with the number of ids or rows
+LIST_PATTERN = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+REPEATED_LIST_PATTERN = re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+")
+
+# The ASGI scope of the current request, which the router completes with the endpoint in place
+current_scope = contextvars.ContextVar("current_scope", default=None)
+
+
+@functools.lru_cache(maxsize=4096)
+def fingerprint(statement: str) -> str:
+    """Normalizes a statement so all executions of one logical query look the same, whatever their parameters."""
+    statement = STRING_PATTERN.sub("?", statement)
+    statement = NUMBER_PATTERN.sub("?", statement)
+    statement = WHITESPACE_PATTERN.sub(" ", statement).strip()
+    statement = LIST_PATTERN.sub("(...)", statement)
+
+    return REPEATED_LIST_PATTERN.sub("(...)", statement)
+
+
+def get_bin(duration: float) -> int:
+    return max(0, math.ceil(math.log(max(duration, MIN_DURATION) / MIN_DURATION, GROWTH)))
+
+
+def get_percentile(histogram: dict[int, int], fraction: float) -> float:
+    """Returns the upper bound of the histogram bin holding the given fraction of all durations."""
+    target = fraction * sum(histogram.values())
+    seen = 0
+
+    for duration_bin in sorted(histogram):
+        seen += histogram[duration_bin]
+
+        if seen >= target:
+            return MIN_DURATION * GROWTH ** duration_bin
+
+    return 0.0
+
+
+def get_service() -> str | None:
+    """Returns the innermost services function on the stack, or the innermost function of the app outside of them.
+
+    The fallback covers queries of the batch loaders, which run as event loop callbacks without a service caller.
+    """
+    fallback = None
+    frame = sys._getframe(1)
+
+    while frame is not None:
+        module = frame.f_globals.get("__name__")
+
+        # Comprehensions and lambdas run in frames of their own
+        if frame.f_code.co_name.startswith("<"):
+            frame = frame.f_back
+            continue
+
+        if module == "services":
+            return frame.f_code.co_name
+
+        if fallback is None and module != __name__ and os.path.dirname(frame.f_code.co_filename) == APP_DIRECTORY:
+            fallback = f"{module}.{frame.f_code.co_qualname}"
+
+        frame = frame.f_back
+
+    return fallback
+
+
+def merge(logs: list[dict]) -> list[dict]:
+    """Combines saved statistics of any number of processes into one entry per fingerprint, most total time first."""
+    oldest = int(time.time() // BUCKET_DURATION) - WINDOW // BUCKET_DURATION
+    merged = {}
+
+    for log in logs:
+        for bucket, statements in log["buckets"].items():
+            if int(bucket) < oldest:
+                continue
+
+            for statement, stats in statements.items():
+                entry = merged.setdefault(statement, dict(count=0, total=0.0, max=0.0, histogram=collections.Counter(),
+                                                          origins=collections.Counter()))
+
+                entry["count"] += stats["count"]
+                entry["total"] += stats["total"]
+                entry["max"] = max(entry["max"], stats["max"])
+                entry["histogram"].update({int(i): count for i, count in stats["histogram"].items()})
+                entry["origins"].update({(route, service): count for route, service, count in stats["origins"]})
+
+    return sorted((dict(
+        fingerprint=statement,
+        count=entry["count"],
+        total_duration=entry["total"],
+        p95_duration=min(get_percentile(entry["histogram"], 0.95), entry["max"]),
+        max_duration=entry["max"],
+        origins=[dict(route=route, service=service, count=count)
+                 for (route, service), count in entry["origins"].most_common(MAX_ORIGINS)],
+    ) for statement, entry in merged.items()), key=lambda i: -i["total_duration"])
+
+
+def load_saved(exclude_pid: int | None = None) -> list[dict]:
+    logs = []
+
+    for path in glob.glob(LOG_PATH.format(pid="*")):
+        if path == LOG_PATH.format(pid=exclude_pid):
+            continue
+
+        try:
+            with open(path) as file:
+                logs.append(json.load(file))
+        except (OSError, ValueError):
+            # Removed or half written by its worker meanwhile
+            continue
+
+    return logs
+
+
+class QueryLog:
+    """Times every statement executed by any engine and aggregates them by fingerprint over a rolling window.
+
+    Statements are attributed to the route of the request they run for and to the service function issuing them.
+    Statements slower than the threshold are printed and kept individually as well. Durations are measured up to
+    the first row, so they exclude fetching the rest of the result.
+    """
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+
+        self.lock = threading.Lock()
+
+        # Route names by endpoint, set by start()
+        self.routes = {}
+
+        self.buckets = {}
+        self.slow = collections.deque(maxlen=MAX_SLOW)
+
+        self.path: str | None = None
+        self.task: asyncio.Task | None = None
+
+    def attach(self) -> None:
+        sql.event.listen(sql.Engine, "before_cursor_execute", self.before_execute)
+        sql.event.listen(sql.Engine, "after_cursor_execute", self.after_execute)
+        sql.event.listen(sql.Engine, "handle_error", self.handle_error)
+
+    def before_execute(self, connection: sql.Connection, *_) -> None:
+        # Statements of one connection never overlap, so one start time per connection suffices
+        connection.info["query_started_at"] = time.perf_counter()
+
+    def after_execute(self, connection: sql.Connection, _, statement: str, *__) -> None:
+        started_at = connection.info.pop("query_started_at", None)
+
+        if started_at is not None:
+            self.record(statement, time.perf_counter() - started_at)
+
+    def handle_error(self, context: sql.engine.ExceptionContext) -> None:
+        # Failed statements never reach after_cursor_execute
+        if context.connection is not None:
+            context.connection.info.pop("query_started_at", None)
+
+    def get_route(self) -> str | None:
+        scope = current_scope.get()
+
+        return self.routes.get(scope.get("endpoint")) if scope is not None else None
+
+    def record(self, statement: str, duration: float) -> None:
+        statement = fingerprint(statement)
+        route, service = self.get_route(), get_service()
+
+        bucket = int(time.time() // BUCKET_DURATION)
+
+        with self.lock:
+            if bucket not in self.buckets:
+                self.buckets = {i: statements for i, statements in self.buckets.items()
+                                if i >= bucket - WINDOW // BUCKET_DURATION}
+                self.buckets[bucket] = {}
+
+            stats = self.buckets[bucket].get(statement)
+            if stats is None:
+                stats = self.buckets[bucket][statement] = dict(count=0, total=0.0, max=0.0, histogram={}, origins={})
+
+            stats["count"] += 1
+            stats["total"] += duration
+            stats["max"] = max(stats["max"], duration)
+
+            duration_bin = get_bin(duration)
+            stats["histogram"][duration_bin] = stats["histogram"].get(duration_bin, 0) + 1
+            stats["origins"][(route, service)] = stats["origins"].get((route, service), 0) + 1
+
+            if duration >= self.threshold:
+                self.slow.append(dict(started_at=time.time() - duration, duration=duration, fingerprint=statement,
+                                      route=route, service=service))
+
+        if duration >= self.threshold:
+            print(f"Slow query of {duration * 1000:.0f}ms by {route or 'no route'} in {service or 'no service'}: "
+                  f"{statement[:200]}")
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return dict(saved_at=time.time(), buckets={str(bucket): {statement: dict(
+                count=stats["count"],
+                total=stats["total"],
+                max=stats["max"],
+                histogram={str(i): count for i, count in stats["histogram"].items()},
+                origins=[[route, service, count] for (route, service), count in stats["origins"].items()],
+            ) for statement, stats in statements.items()} for bucket, statements in self.buckets.items()})
+
+    def save(self) -> None:
+        # Written under a temporary name and swapped in, so readers never see a partial file
+        temporary_path = f"{self.path}.tmp"
+
+        with open(temporary_path, "w") as file:
+            json.dump(self.to_dict(), file)
+
+        os.replace(temporary_path, self.path)
+
+    async def save_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(SAVE_INTERVAL)
+
+            try:
+                await asyncio.to_thread(self.save)
+            except OSError as error:
+                print(f"Could not save the query log: {error}")
+
+    def get_statistics(self) -> list[dict]:
+        """Returns the statistics of this process merged with those last saved by the other workers."""
+        return merge([self.to_dict(), *load_saved(exclude_pid=os.getpid())])
+
+    def get_slow(self) -> list[dict]:
+        """Returns the most recent slow statements of this process, newest first."""
+        with self.lock:
+            return list(reversed(self.slow))
+
+    def start(self, app: fastapi.FastAPI) -> None:
+        if self.task is None:
+            self.routes = diagnostics.get_route_names(app)
+
+            # Every worker process saves its own statistics, as workers may be forked after this is created
+            self.path = LOG_PATH.format(pid=os.getpid())
+            self.task = asyncio.get_running_loop().create_task(self.save_periodically())
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ScopeMiddleware:
+    """Makes the scope of the current request available to the query log, including event loop callbacks and
+    worker threads of the request."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        token = current_scope.set(scope)
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_scope.reset(token)
+
+
+def get_query_log() -> QueryLog | None:
+    threshold = os.environ.get(THRESHOLD_VARIABLE)
+
+    if not threshold:
+        return None
+
+    query_log = QueryLog(float(threshold))
+    query_log.attach()
+
+    return query_log
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=f"Prints the query statistics saved by all running workers of the "
+                                                 f"last {WINDOW} seconds")
+    parser.add_argument("--limit", type=int, default=20, help="number of fingerprints to print")
+    parser.add_argument("--json", action="store_true", help="print the full statistics as JSON")
+    args = parser.parse_args()
+
+    statistics = merge(load_saved())[:args.limit]
+
+    if args.json:
+        print(json.dumps(statistics, indent=2))
+        return
+
+    if not statistics:
+        print(f"No statistics found, is a server with {THRESHOLD_VARIABLE} set running in this directory?")
+        return
+
+    for entry in statistics:
+        print(f"total {entry['total_duration'] * 1000:10.1f}ms  count {entry['count']:8}  "
+              f"p95 {entry['p95_duration'] * 1000:8.2f}ms  max {entry['max_duration'] * 1000:8.2f}ms")
+        print(f"    {entry['fingerprint'][:300]}")
+
+        for origin in entry["origins"]:
+            print(f"    {origin['count']:8} from {origin['route'] or 'no route'} "
+                  f"in {origin['service'] or 'no service'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+import asyncio
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+
+import sqlalchemy as sql
+import sqlalchemy.orm as orm
+
+
+# Setting this to a number of seconds serves read-only routes from a snapshot refreshed at that interval
+INTERVAL_VARIABLE = "READ_SNAPSHOT_INTERVAL"
+
+# Shared by all worker processes, only the worker holding the lock file refreshes the snapshot
+SNAPSHOT_PATH = "./database.snapshot.db"
+MARKERS_PATH = "./database.snapshot.markers.db"
+LOCK_PATH = "./database.snapshot.lock"
+
+# Workers check this often whether another worker took a new snapshot
+SYNC_INTERVAL = 1
+
+# Maximum age in seconds of the snapshot a route may be served from, older snapshots fall back to the database
+FEED_STALENESS = 60
+ENTITY_STALENESS = 300
+INFO_STALENESS = 10
+
+# Write markers older than any usable snapshot are deleted
+MAX_STALENESS = max(FEED_STALENESS, ENTITY_STALENESS, INFO_STALENESS)
+
+TAKEN_KEY = "taken"
+WRITE_KEY = "write"
+
+
+class ReadSnapshot:
+    """Copy of the database taken with SQLite's online backup API, so long reads never wait for writers or block them.
+
+    A route is only served from the snapshot if it is younger than the route's staleness bound, nothing was written
+    for everyone (e.g. imported posts) since it was taken, and the requesting user did not write since either, so
+    users always read their own favourites and follows.
+
+    All workers share one snapshot, refreshed by whichever worker holds LOCK_PATH, and record the time of every
+    write in a small SQLite database of markers, so a write through one worker keeps all of them from reading the
+    snapshot taken before it. Requests check the markers as read by the last sync, so writes through other workers
+    take effect within SYNC_INTERVAL, writes through this one right away.
+    """
+
+    def __init__(self, source: sql.Engine, interval: float):
+        self.source = source
+        self.interval = interval
+
+        self.started_at = time.time()
+
+        # Set by start(), which runs in every worker process, as workers may be forked after this is created
+        self.engine: sql.Engine | None = None
+        self.SessionLocal = orm.sessionmaker(autocommit=False, autoflush=False)
+        self.markers: sqlite3.Connection | None = None
+        self.lock_file = None
+        self.refreshing = False
+
+        self.lock = threading.Lock()
+        self.taken_at: float | None = None
+
+        # Times of the writes since the snapshot was taken by marker key
+        self.writes = {}
+
+        self.task: asyncio.Task | None = None
+
+    def get_marker(self, key: str) -> float | None:
+        with self.lock:
+            row = self.markers.execute("SELECT time FROM markers WHERE key = ?", (key,)).fetchone()
+
+        return row[0] if row is not None else None
+
+    def set_marker(self, key: str, marked_at: float) -> None:
+        with self.lock:
+            self.markers.execute("INSERT INTO markers (key, time) VALUES (?, ?) "
+                                 "ON CONFLICT (key) DO UPDATE SET time = max(time, excluded.time)", (key, marked_at))
+
+    def refresh(self) -> None:
+        started = time.time()
+
+        # Written under a temporary name and swapped in, open sessions keep reading the previous file until closed
+        temporary_path = f"{SNAPSHOT_PATH}.tmp"
+
+        source = self.source.raw_connection()
+        target = sqlite3.connect(temporary_path)
+        try:
+            source.driver_connection.backup(target)
+        finally:
+            target.close()
+            source.close()
+
+        os.replace(temporary_path, SNAPSHOT_PATH)
+
+        self.set_marker(TAKEN_KEY, started)
+
+        with self.lock:
+            self.markers.execute("DELETE FROM markers WHERE key NOT IN (?, ?) AND time < ?",
+                                 (TAKEN_KEY, WRITE_KEY, started - MAX_STALENESS))
+
+    def sync(self) -> None:
+        """Switches to the latest snapshot, ignoring snapshots taken before this process started, and reads the
+        writes since it was taken."""
+        started = time.time()
+
+        taken_at = self.get_marker(TAKEN_KEY)
+
+        if taken_at is None or taken_at < self.started_at:
+            return
+
+        if taken_at != self.taken_at:
+            # Pooled connections still read the replaced file
+            self.engine.dispose()
+
+        with self.lock:
+            rows = self.markers.execute("SELECT key, time FROM markers WHERE key != ? AND time >= ?",
+                                        (TAKEN_KEY, taken_at)).fetchall()
+
+        with self.lock:
+            writes = dict(rows)
+
+            # Written by this process while reading
+            for key, marked_at in self.writes.items():
+                if marked_at >= started:
+                    writes[key] = max(writes.get(key, marked_at), marked_at)
+
+            self.taken_at, self.writes = taken_at, writes
+
+    def try_lock(self) -> bool:
+        if not self.refreshing:
+            try:
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.refreshing = True
+            except BlockingIOError:
+                pass
+
+        return self.refreshing
+
+    def record_write(self, user_id: int | None = None) -> None:
+        """Marks the snapshot as outdated for the user, or for everyone if no user is given."""
+        if self.markers is None:
+            return
+
+        key, marked_at = WRITE_KEY if user_id is None else f"user:{user_id}", time.time()
+
+        self.set_marker(key, marked_at)
+
+        with self.lock:
+            self.writes[key] = marked_at
+
+    def is_usable(self, max_staleness: float, user_id: int | None) -> bool:
+        with self.lock:
+            taken_at = self.taken_at
+
+            if taken_at is None or time.time() - taken_at > max_staleness:
+                return False
+
+            last_write = max(self.writes.get(WRITE_KEY, 0.0),
+                             self.writes.get(f"user:{user_id}", 0.0) if user_id is not None else 0.0)
+
+        return last_write < taken_at
+
+    async def refresh_periodically(self) -> None:
+        while True:
+            try:
+                if self.try_lock() and (self.taken_at is None or time.time() - self.taken_at >= self.interval):
+                    await asyncio.to_thread(self.refresh)
+
+                await asyncio.to_thread(self.sync)
+            except (sqlite3.Error, OSError) as error:
+                print(f"Could not refresh the read snapshot: {error}")
+
+            await asyncio.sleep(SYNC_INTERVAL)
+
+    def start(self) -> None:
+        if self.task is None:
+            self.engine = sql.create_engine(f"sqlite:///{SNAPSHOT_PATH}", connect_args={"check_same_thread": False})
+            self.SessionLocal.configure(bind=self.engine)
+
+            self.markers = sqlite3.connect(MARKERS_PATH, timeout=5, isolation_level=None, check_same_thread=False)
+            self.markers.execute("PRAGMA journal_mode = WAL")
+            self.markers.execute("CREATE TABLE IF NOT EXISTS markers (key TEXT PRIMARY KEY, time REAL NOT NULL)")
+
+            self.lock_file = open(LOCK_PATH, "a")
+
+            self.task = asyncio.get_running_loop().create_task(self.refresh_periodically())
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+        if self.engine is not None:
+            self.engine.dispose()
+
+        if self.markers is not None:
+            self.markers.close()
+            self.markers = None
+
+        # Releases the lock, so another worker takes over refreshing
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+            self.refreshing = False
+
+
+def get_read_snapshot(source: sql.Engine) -> ReadSnapshot | None:
+    interval = os.environ.get(INTERVAL_VARIABLE)
+
+    if not interval:
+        return None
+
+    return ReadSnapshot(source, float(interval))
@@ -0,0 +1,263 @@
+import random
+import threading
+import time
+from collections.abc import Callable
+
+import sqlalchemy.orm
+
+import models
+
+
+STRATEGIES = ("uniform", "weighted", "trending")
+
+# Favourites lose half of their trending weight after this many newer favourites across all posts. Posts and
+#  favourites carry no timestamps, so the ever-increasing FavoriteMap ids serve as the clock
+TRENDING_HALF_LIFE = 1000
+
+# Share of trending draws that ignore favourites, so posts nobody has favourited recently still show up
+TRENDING_EXPLORATION = 0.1
+
+# Trending weights grow exponentially with the favourite id, they are rebased before leaving the float range
+MAX_EXPONENT = 512
+
+
+def get_trending_weight(favorite_id: int, offset: int) -> float:
+    return 2 ** ((favorite_id - offset) / TRENDING_HALF_LIFE)
+
+
+class FenwickTree:
+    """Binary indexed tree over non-negative weights with O(log n) updates, prefix sums and weighted lookups."""
+
+    def __init__(self, weights: list[float]):
+        self.size = len(weights)
+        self.weights = list(weights)
+
+        self.tree = [0.0] + self.weights
+        for i in range(1, self.size + 1):
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[i]
+
+        self.total = sum(self.weights)
+
+    def add(self, position: int, delta: float) -> None:
+        self.weights[position] += delta
+        self.total += delta
+
+        i = position + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def find(self, value: float) -> int:
+        """Returns the position whose cumulative weight range contains `value`, for 0 <= value < total."""
+        position = 0
+        step = 1 << self.size.bit_length()
+
+        while step:
+            following = position + step
+            if following <= self.size and self.tree[following] <= value:
+                position = following
+                value -= self.tree[following]
+            step >>= 1
+
+        return min(position, self.size - 1)
+
+
+class PostWeights:
+    """Favourite based weights of all posts, loaded lazily and kept up to date by favorite_post/unfavorite_post.
+
+    `weighted` draws posts proportional to 1 + their favourite count, `trending` proportional to the sum of their
+    favourites decayed by TRENDING_HALF_LIFE, mixed with TRENDING_EXPLORATION uniform draws.
+
+    With several worker processes, favourites only reach the weights of the process handling them, so the weights
+    are reloaded in the background once they are `ttl` seconds old, while draws keep using the previous ones.
+    """
+
+    def __init__(self, session_factory: Callable[[], sqlalchemy.orm.Session], ttl: float | None = None):
+        self.session_factory = session_factory
+        self.ttl = ttl
+
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.loaded_at = 0.0
+        self.reloading = False
+
+        self.post_ids = []
+        self.positions = {}
+        self.offset = 0
+
+        self.counts = FenwickTree([])
+        self.trending = FenwickTree([])
+
+    def invalidate(self) -> None:
+        self.loaded = False
+
+    def load(self, db: sqlalchemy.orm.Session) -> None:
+        """Queries and builds the weights without holding the lock, so draws and updates wait only for the swap.
+
+        Favourites written while loading may be missing until the next invalidation, which weighted sampling
+        tolerates.
+        """
+        post_ids = [i for (i,) in db.query(models.Post.id).order_by(models.Post.id)]
+        positions = {post_id: position for position, post_id in enumerate(post_ids)}
+
+        favorites = db.query(models.FavoriteMap.id, models.FavoriteMap.post_id).all()
+
+        offset = max((favorite_id for favorite_id, _ in favorites), default=0)
+
+        counts = [0.0] * len(post_ids)
+        trending = [0.0] * len(post_ids)
+
+        for favorite_id, post_id in favorites:
+            position = positions.get(post_id)
+
+            if position is not None:
+                counts[position] += 1
+                trending[position] += get_trending_weight(favorite_id, offset)
+
+        counts, trending = FenwickTree(counts), FenwickTree(trending)
+
+        with self.lock:
+            self.post_ids, self.positions, self.offset = post_ids, positions, offset
+            self.counts, self.trending = counts, trending
+
+            self.loaded = True
+            self.loaded_at = time.monotonic()
+
+    def reload(self) -> None:
+        db = self.session_factory()
+        try:
+            self.load(db)
+        except Exception as error:
+            print(f"Could not reload the post weights: {error!r}")
+        finally:
+            db.close()
+
+            with self.lock:
+                self.reloading = False
+
+    def ensure_loaded(self, db: sqlalchemy.orm.Session) -> None:
+        if not self.loaded:
+            self.load(db)
+            return
+
+        if self.ttl is None or time.monotonic() - self.loaded_at < self.ttl:
+            return
+
+        with self.lock:
+            if self.reloading:
+                return
+
+            self.reloading = True
+
+        threading.Thread(target=self.reload, daemon=True).start()
+
+    def add_favorite(self, post_id: int, favorite_id: int) -> None:
+        self.update(post_id, favorite_id, 1)
+
+    def remove_favorite(self, post_id: int, favorite_id: int) -> None:
+        self.update(post_id, favorite_id, -1)
+
+    def update(self, post_id: int, favorite_id: int, sign: int) -> None:
+        with self.lock:
+            if not self.loaded:
+                return
+
+            position = self.positions.get(post_id)
+
+            if position is None or (favorite_id - self.offset) / TRENDING_HALF_LIFE > MAX_EXPONENT:
+                # Unknown posts were created after loading, too large exponents need a new offset
+                self.loaded = False
+                return
+
+            self.counts.add(position, sign)
+            self.trending.add(position, sign * get_trending_weight(favorite_id, self.offset))
+
+            # Subtracting floats of very different magnitude may leave tiny negative remainders
+            if self.trending.weights[position] < 0:
+                self.trending.add(position, -self.trending.weights[position])
+
+    def get_uniform_probability(self, strategy: str, total: float, count: int) -> float:
+        if strategy == "weighted":
+            return count / (count + total)
+
+        return TRENDING_EXPLORATION if total > 0 else 1
+
+    def draw(self, db: sqlalchemy.orm.Session, count: int, strategy: str,
+             candidates: list[int] | None = None, exclude: list[int] | None = None) -> list[int]:
+        """Draws up to `count` distinct post ids, restricted to `candidates` if given and never from `exclude`."""
+        exclude = set(exclude or [])
+
+        self.ensure_loaded(db)
+
+        with self.lock:
+            if candidates is None:
+                return self.draw_from_tree(count, strategy, exclude)
+
+            return self.draw_from_candidates(count, strategy, [i for i in candidates if i not in exclude])
+
+    def draw_from_tree(self, count: int, strategy: str, exclude: set[int]) -> list[int]:
+        tree = self.counts if strategy == "weighted" else self.trending
+
+        drawn, removed = [], []
+
+        # Rejection sampling stays cheap while `exclude` is a small part of all posts, the loop is bounded for the rest
+        for _ in range(10 * count + len(exclude)):
+            if len(drawn) >= count or len(drawn) + len(exclude) >= len(self.post_ids):
+                break
+
+            if random.random() < self.get_uniform_probability(strategy, tree.total, len(self.post_ids)):
+                position = random.randrange(len(self.post_ids))
+            else:
+                position = tree.find(random.random() * tree.total)
+
+            post_id = self.post_ids[position]
+
+            if post_id in exclude:
+                continue
+
+            drawn.append(post_id)
+            exclude.add(post_id)
+
+            # Drawn posts are removed from the tree, so they can not be drawn twice, and restored afterwards
+            removed.append((position, tree.weights[position]))
+            tree.add(position, -tree.weights[position])
+
+        for position, weight in removed:
+            tree.add(position, weight)
+
+        if len(drawn) < count:
+            remaining = [i for i in self.post_ids if i not in exclude]
+            drawn += random.sample(remaining, min(count - len(drawn), len(remaining)))
+
+        return drawn
+
+    def draw_from_candidates(self, count: int, strategy: str, candidates: list[int]) -> list[int]:
+        tree = self.counts if strategy == "weighted" else self.trending
+
+        candidates = [i for i in candidates if i in self.positions]
+
+        # Trees over the candidates only, built once in O(n), so every draw costs O(log n). Drawn candidates are
+        #  zeroed in both, the second one draws uniformly from those left
+        weights = FenwickTree([tree.weights[self.positions[i]] for i in candidates])
+        remaining = FenwickTree([1.0] * len(candidates))
+
+        drawn = []
+
+        while len(drawn) < min(count, len(candidates)):
+            if random.random() < self.get_uniform_probability(strategy, weights.total, len(candidates) - len(drawn)):
+                index = remaining.find(random.random() * remaining.total)
+            else:
+                index = weights.find(random.random() * weights.total)
+
+                # Float remainders of zeroed weights may point at a candidate drawn already
+                if remaining.weights[index] == 0:
+                    index = remaining.find(random.random() * remaining.total)
+
+            drawn.append(candidates[index])
+
+            weights.add(index, -weights.weights[index])
+            remaining.add(index, -1.0)
+
+        return drawn
@@ -56,10 +56,19 @@ class _BotBase(pydantic.BaseModel):
     background_color: str
 
 
+class BotImages(pydantic.BaseModel):
+    thumbnail: str
+    card: str
+    full: str
+
+
 class Bot(_BotBase):
     id: int
     owner_id: int
 
+    # Mirrored variants of image, None until media.import_bot_images stored it
+    images: BotImages | None = None
+
     class Config:
         from_attributes = True
 
@@ -103,6 +112,33 @@ class BotInfo(_Info):
     mentioned_count: int
 
 
+class BotConnection(pydantic.BaseModel):
+    bot: Bot
+
+    mentions_count: int
+    mentioned_count: int
+
+
+class BotConnections(_Info):
+    mentions_count: int
+    mentioned_count: int
+
+    mentions_degree: int
+    mentioned_degree: int
+
+    centrality: float
+    rank: int
+
+    connections: list[BotConnection]
+
+
+class RelatedTag(pydantic.BaseModel):
+    tag: Tag
+
+    shared_post_count: int
+    score: float
+
+
 class TagInfo(_Info):
     following: bool | None
 
@@ -112,3 +148,86 @@ class TagInfo(_Info):
 
 class FollowingCount(_Info):
     following_count: int
+
+
+# ------------------------------------------------- #
+
+
+class BotPage(pydantic.BaseModel):
+    bot: Bot
+    info: BotInfo
+    posts: list[Post]
+
+
+class TagPage(pydantic.BaseModel):
+    tag: Tag
+    info: TagInfo
+    posts: list[Post]
+
+
+# ------------------------------------------------- #
+
+
+class BlockingRecord(pydantic.BaseModel):
+    started_at: float
+    duration: float
+
+    route: str | None
+    service: str | None
+
+    stack: list[str]
+
+
+class BlockingOffender(pydantic.BaseModel):
+    route: str | None
+    service: str | None
+
+    count: int
+    total_duration: float
+
+
+class BlockingReport(pydantic.BaseModel):
+    # None while the detector is disabled, the loop lag is measured anyway
+    threshold: float | None
+    loop_lag: float
+
+    offenders: list[BlockingOffender]
+    records: list[BlockingRecord]
+
+
+class QueryOrigin(pydantic.BaseModel):
+    route: str | None
+    service: str | None
+
+    count: int
+
+
+class QueryStatistics(pydantic.BaseModel):
+    fingerprint: str
+
+    count: int
+    total_duration: float
+    p95_duration: float
+    max_duration: float
+
+    origins: list[QueryOrigin]
+
+
+class SlowQuery(pydantic.BaseModel):
+    started_at: float
+    duration: float
+
+    fingerprint: str
+
+    route: str | None
+    service: str | None
+
+
+class QueryReport(pydantic.BaseModel):
+    # None while the query log is disabled
+    threshold: float | None
+    window: int
+
+    # Of all workers, the slow queries only of the worker answering
+    statistics: list[QueryStatistics]
+    slow: list[SlowQuery]
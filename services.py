@@ -1,21 +1,40 @@
+import asyncio
 import random
+import functools
+import os
 import re
+import threading
+import time
 from collections.abc import Generator
 
 import argon2
 import fastapi
 import fastapi.security
 import jwt
+import pydantic
+import pydantic_core
 from pydantic import ValidationError
-from sqlalchemy import func, or_, and_, not_
+from sqlalchemy import func
 import sqlalchemy.orm
 
+import admission
+import bot_graph
+import cooccurrence
 import database
+import diagnostics
+import extraction
+import loaders
+import media
+import memberships
 import models
+import post_filters
+import prefixes
+import query_log
+import replica
+import sampling
 import schemas
-
-from organisations.comicvine import models as comicvine_models
-from organisations.comicvine import database as comicvine_database
+import similarity
+import write_behind
 
 
 oauth2scheme = fastapi.security.OAuth2PasswordBearer(tokenUrl="/api/token")
@@ -25,18 +44,197 @@ with open("jwt_secret") as file:
 
 ph = argon2.PasswordHasher()
 
+# Comma separated ids of the users allowed to use the diagnostic routes. Ids, unlike usernames, can not be chosen
+#  by users, and admins may not delete their accounts, so SQLite never hands their ids to new users
+ADMIN_VARIABLE = "ADMIN_USER_IDS"
+admin_user_ids = {int(i) for i in os.environ.get(ADMIN_VARIABLE, "").split(",") if i.strip()}
+
+load_monitor = admission.LoadMonitor()
+
+# get_token_user_id is defined further down
+rate_limiter = admission.RateLimiter(admission.get_store(), load_monitor, lambda request: get_token_user_id(request))
+
+post_weights = sampling.PostWeights(database.SessionLocal)
+
+membership_cache = memberships.MembershipCache()
+
+read_snapshot = replica.get_read_snapshot(database.engine)
+
+blocking_detector = diagnostics.get_blocking_detector()
+
+slow_query_log = query_log.get_query_log()
+
+# Only one profile of the whole process runs at a time
+profile_lock = threading.Lock()
+
+write_queue = write_behind.WriteQueue(database.SessionLocal)
+membership_cache.overlay = write_queue.get_overlay
+
+post_filter_index = post_filters.PostFilterIndex()
+
+token_extractor = extraction.TokenExtractor()
+
+similar_posts = similarity.PostSimilarityIndex()
+
+mention_graph = bot_graph.BotGraph()
+
+tag_cooccurrence = cooccurrence.TagCooccurrence()
+
+bot_prefix_index = prefixes.PrefixIndex(
+    lambda db: [(bot.username, bot) for bot in media.add_bot_images(
+        [schemas.Bot.model_validate(bot) for bot in db.query(models.Bot).all()], db)])
+tag_prefix_index = prefixes.PrefixIndex(
+    lambda db: [(tag.name, schemas.Tag.model_validate(tag)) for tag in db.query(models.Tag).all()])
+
 
 # <editor-fold desc="Database operations">
 def create_database() -> None:
-    return database.Base.metadata.create_all(bind=database.engine)
+    database.Base.metadata.create_all(bind=database.engine)
+
+    # create_all skips existing tables, so indexes added to them later are created separately
+    for table in database.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=database.engine, checkfirst=True)
+
 
+def get_db(request: fastapi.Request = None) -> Generator[sqlalchemy.orm.Session]:
+    """Yields the session of the request, so authentication, read fallbacks and the route share one unit of work."""
+    if request is not None and getattr(request.state, "db", None) is not None:
+        yield request.state.db
+        return
 
-def get_db() -> Generator[sqlalchemy.orm.Session]:
     db = database.SessionLocal()
     try:
+        # Connecting right away measures how long requests wait for the connection pool, for load shedding
+        start = time.perf_counter()
+        db.connection()
+        load_monitor.record_db_wait(time.perf_counter() - start)
+
+        if request is not None:
+            request.state.db = db
+
         yield db
     finally:
+        if request is not None:
+            request.state.db = None
+
         db.close()
+
+
+def get_token_user_id(request: fastapi.Request) -> int | None:
+    authorization = request.headers.get("authorization", "")
+
+    try:
+        return jwt.decode(authorization[7:], jwt_secret, algorithms=["HS256"])["id"]
+    except (jwt.exceptions.InvalidTokenError, KeyError):
+        return None
+
+
+def get_read_db(max_staleness: float):
+    """Returns a dependency yielding a session of the read snapshot if it may be used, otherwise of the database."""
+    def get_read_db_dependency(request: fastapi.Request) -> Generator[sqlalchemy.orm.Session]:
+        if read_snapshot is None or not read_snapshot.is_usable(max_staleness, get_token_user_id(request)):
+            yield from get_db(request)
+            return
+
+        db = read_snapshot.SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    return get_read_db_dependency
+
+
+def memoized(kind: str):
+    """Caches the results of an async `(key, db)` lookup in the session for its lifetime, which is one request.
+
+    Repeated lookups of the same post, bot or tag within a request, e.g. by a route and the info it returns, are
+    free. Failed lookups are not cached, and commits clear the cache like they expire the session's objects.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(key, db: sqlalchemy.orm.Session):
+            memo = db.info.setdefault("memo", {})
+
+            if (kind, key) not in memo:
+                memo[(kind, key)] = await function(key, db)
+
+            return memo[(kind, key)]
+
+        return wrapper
+
+    return decorator
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_commit")
+def clear_memo(session: sqlalchemy.orm.Session) -> None:
+    session.info.pop("memo", None)
+
+
+def record_write(user_id: int | None = None) -> None:
+    """Keeps the user, or everyone if no user is given, from reading the read snapshot until it is refreshed."""
+    if read_snapshot is not None:
+        read_snapshot.record_write(user_id)
+# </editor-fold>
+
+
+# <editor-fold desc="Warmup">
+warmed_up = threading.Event()
+
+
+def warm_up() -> None:
+    """Loads the post, tag and bot indexes, so the first requests do not pay for it and forked workers share them."""
+    start = time.perf_counter()
+
+    db = database.SessionLocal()
+    try:
+        post_filter_index.load(db)
+        post_weights.ensure_loaded(db)
+        token_extractor.load(db)
+        bot_prefix_index.load(db)
+        tag_prefix_index.load(db)
+        mention_graph.ensure_loaded(db)
+        tag_cooccurrence.load(db)
+    finally:
+        db.close()
+
+    similar_posts.load()
+
+    warmed_up.set()
+
+    print(f"Warmed up indexes in {time.perf_counter() - start:.2f}s")
+# </editor-fold>
+
+
+# <editor-fold desc="Response shaping">
+def select_fields(items: list[pydantic.BaseModel], fields: str | None,
+                  model: type[pydantic.BaseModel]) -> list[pydantic.BaseModel] | fastapi.Response:
+    """Returns the items unchanged if no fields are given, otherwise a JSON response of only the given fields.
+
+    `fields` is a comma separated list of field names of `model`, e.g. "id,owner_id".
+    """
+    if not fields:
+        return items
+
+    selected = {i.strip() for i in fields.split(",") if i.strip()}
+
+    if unknown := selected - model.model_fields.keys():
+        raise fastapi.HTTPException(status_code=400, detail=f"Unknown fields {', '.join(sorted(unknown))}, "
+                                                            f"must be any of {', '.join(model.model_fields)}")
+
+    return fastapi.Response(content=pydantic_core.to_json([i.model_dump(include=selected) for i in items]),
+                            media_type="application/json")
+# </editor-fold>
+
+
+# <editor-fold desc="Sampling">
+def sample_excluding(items: list, count: int, excluded: set[int]) -> list:
+    """Draws up to `count` distinct items uniformly, never one whose id is excluded, in O(count + len(excluded))."""
+    # Excluded items take at most len(excluded) places of the sample, which is in random order
+    sample = random.sample(items, min(count + len(excluded), len(items)))
+
+    return [i for i in sample if i.id not in excluded][:count]
 # </editor-fold>
 
 
@@ -81,6 +279,8 @@ async def update_user(user_id: int, updated_user: schemas.UserUpdate, db: sqlalc
     db.commit()
     db.refresh(user)
 
+    record_write(user.id)
+
     return {"message": "successfully updated user"}
 
 
@@ -90,6 +290,13 @@ async def delete_user(user_id: int, updated_user: schemas.UserUpdate, db: sqlalc
     if not verify_password(user, updated_user.password_hash, db):
         raise fastapi.HTTPException(401, "Wrong password")
 
+    if user.id in admin_user_ids:
+        raise fastapi.HTTPException(403, f"Admins can not delete their account, remove their id from "
+                                         f"{ADMIN_VARIABLE} first")
+
+    # Queued favourites and follows are written first, so they are deleted as well
+    await asyncio.to_thread(write_queue.flush)
+
     follows = db.query(models.FollowingMap).filter_by(follower_id=user.id).all()
 
     for follow in follows:
@@ -99,12 +306,17 @@ async def delete_user(user_id: int, updated_user: schemas.UserUpdate, db: sqlalc
     favorites = db.query(models.FavoriteMap).filter_by(user_id=user.id).all()
 
     for favorite in favorites:
+        post_weights.remove_favorite(favorite.post_id, favorite.id)
+
         db.delete(favorite)
         db.commit()
 
     db.delete(user)
     db.commit()
 
+    membership_cache.invalidate(user.id)
+    record_write(user.id)
+
     return {"message": "successfully deleted user"}
 # </editor-fold>
 
@@ -162,16 +374,65 @@ def get_current_user(token: str = fastapi.Depends(oauth2scheme),
                                     detail="Could not validate credentials")
 
 
-def require_authentication(token: str = fastapi.Depends(oauth2scheme),
-                           db: sqlalchemy.orm.Session = fastapi.Depends(get_db)) -> bool | None:
-    if get_current_user(token, db):
+def require_authentication(user: schemas.User = fastapi.Depends(get_current_user)) -> bool | None:
+    # Depending on get_current_user instead of calling it lets routes that use both resolve the user only once
+    if user:
         return True
+
+
+def require_admin(user: schemas.User = fastapi.Depends(get_current_user)) -> schemas.User:
+    if user.id not in admin_user_ids:
+        raise fastapi.HTTPException(status_code=403, detail="Only admins may use this route")
+
+    return user
+
+
+def is_admin_request(scope: dict) -> bool:
+    """Checks the token of a request outside of dependency injection, e.g. in middleware."""
+    user_id = get_token_user_id(fastapi.Request(scope))
+
+    if user_id not in admin_user_ids:
+        return False
+
+    db = database.SessionLocal()
+    try:
+        user = db.get(models.User, user_id)
+    finally:
+        db.close()
+
+    return user is not None
 # </editor-fold>
 
 
 # <editor-fold desc="User associated data">
+def submit_membership(user_id: int, kind: str, item_id: int, added: bool) -> None:
+    """Queues a favourite or follow change, which the user sees right away through the membership cache."""
+    if added:
+        membership_cache.add(user_id, kind, item_id)
+    else:
+        membership_cache.remove(user_id, kind, item_id)
+
+    write_queue.submit(kind, user_id, item_id, added)
+    record_write(user_id)
+
+
+def on_memberships_written(changes: list[tuple[str, int, int, bool, int]]) -> None:
+    for kind, user_id, item_id, added, row_id in changes:
+        if kind == memberships.FAVORITE_POSTS:
+            if added:
+                post_weights.add_favorite(item_id, row_id)
+            else:
+                post_weights.remove_favorite(item_id, row_id)
+
+        # Recorded again once committed, as a snapshot taken in between does not contain the change
+        record_write(user_id)
+
+
+write_queue.add_listener(on_memberships_written)
+
+
 async def get_favorite_posts_count(user: models.User, db: sqlalchemy.orm.Session) -> schemas.FavoriteCount:
-    favorite_count = db.query(func.count(models.FavoriteMap.id)).filter_by(user_id=user.id).scalar()
+    favorite_count = len(membership_cache.get(user.id, memberships.FAVORITE_POSTS, db))
     return schemas.FavoriteCount(
         id=user.id,
 
@@ -180,10 +441,7 @@ async def get_favorite_posts_count(user: models.User, db: sqlalchemy.orm.Session
 
 
 async def get_followed_bot_count(user: models.User, db: sqlalchemy.orm.Session) -> schemas.FollowingCount:
-    following_count = (db.query(func.count(models.FollowingMap.id)).
-                       filter_by(follower_id=user.id).
-                       filter(models.FollowingMap.bot_id != None).
-                       scalar())
+    following_count = len(membership_cache.get(user.id, memberships.FOLLOWED_BOTS, db))
     return schemas.FollowingCount(
         id=user.id,
 
@@ -192,10 +450,7 @@ async def get_followed_bot_count(user: models.User, db: sqlalchemy.orm.Session)
 
 
 async def get_followed_tag_count(user: models.User, db: sqlalchemy.orm.Session) -> schemas.FollowingCount:
-    following_count = (db.query(func.count(models.FollowingMap.id)).
-                       filter_by(follower_id=user.id).
-                       filter(models.FollowingMap.tag_id != None).
-                       scalar())
+    following_count = len(membership_cache.get(user.id, memberships.FOLLOWED_TAGS, db))
     return schemas.FollowingCount(
         id=user.id,
 
@@ -205,13 +460,14 @@ async def get_followed_tag_count(user: models.User, db: sqlalchemy.orm.Session)
 
 
 # <editor-fold desc="Posts">
+@memoized("post")
 async def get_post(post_id: int, db: sqlalchemy.orm.Session) -> schemas.Post:
-    post = db.query(models.Post).get(post_id)
+    post = await loaders.get_loader(db, loaders.fetch_posts).load(post_id)
 
     if post is None:
         raise fastapi.HTTPException(status_code=404, detail=f"There is no post with id {post_id}")
 
-    return schemas.Post.model_validate(post)
+    return post
 
 
 async def get_random_posts(
@@ -229,79 +485,87 @@ async def get_random_posts(
 
         use_filter: str = None,
 
-        exclude: list[int] = None
+        exclude: list[int] = None,
+
+        strategy: str = None,
+
+        any_tag: list[int] = None,
+        exclude_tag: list[int] = None,
+        exclude_bot: list[int] = None,
+        exclude_filter: str = None,
+
+        expand_tag: bool = None,
 ) -> list[schemas.Post]:
-    remaining_posts_count = db.query(func.count(models.Post.id))
+    if exclude is None:
+        exclude = []
+
+    if strategy is not None and strategy not in sampling.STRATEGIES:
+        raise fastapi.HTTPException(status_code=400,
+                                    detail=f"Strategy must be one of {', '.join(sampling.STRATEGIES)}")
+
+    favorite_posts = membership_cache.get(user.id, memberships.FAVORITE_POSTS, db) if favorites_only else None
+
+    if expand_tag and by_tag:
+        related_tags = [tag.id for tag, _, _ in tag_cooccurrence.get_related(
+            db, by_tag, cooccurrence.EXPANSION_SIZE, min_score=cooccurrence.MIN_EXPANSION_SCORE)]
+    else:
+        related_tags = None
+
+    matches = post_filter_index.evaluate(
+        db, by_tag=by_tag, related_tags=related_tags, by_bot=by_bot, by_or_mentioned=by_or_mentioned,
+        favorite_posts=favorite_posts, use_filter=use_filter, any_tag=any_tag, exclude_tag=exclude_tag,
+        exclude_bot=exclude_bot, exclude_filter=exclude_filter,
+    )
 
-    if by_tag:
-        remaining_posts_count = remaining_posts_count.filter(models.Post.id.in_(
-            [i.post_id for i in db.query(models.TagMap).filter(models.TagMap.tag_id.is_(by_tag)).all()]
-        ))
+    if strategy in ("weighted", "trending"):
+        candidates = None if matches is None else matches.tolist()
+        post_ids = post_weights.draw(db, count, strategy, candidates=candidates, exclude=exclude)
+    else:
+        post_ids = post_filter_index.sample(matches, count, exclude)
 
-    if by_bot:
-        remaining_posts_count = remaining_posts_count.filter_by(owner_id=by_bot)
+    posts = await loaders.get_loader(db, loaders.fetch_posts).load_many(post_ids)
 
-    if by_or_mentioned:
-        remaining_posts_count = remaining_posts_count.filter(
-            or_(models.Post.owner_id.is_(by_or_mentioned),
-                (models.Post.id.in_([i.post_id for i in db.query(models.MentionMap).
-                                     filter_by(mention_id=by_or_mentioned).all()])))
-        )
+    return [i for i in posts if i is not None]
 
-    if favorites_only:
-        remaining_posts_count = remaining_posts_count.filter(models.Post.id.in_(
-            [i.post_id for i in db.query(models.FavoriteMap).filter_by(user_id=user.id).all()]
-        ))
 
-    if use_filter:
-        remaining_posts_count = remaining_posts_count.filter(and_(
-            models.Post.content.contains(i, autoescape=True) for i in use_filter.split(" ")
-        ))
+async def get_similar_posts(post_id: int, count: int, db: sqlalchemy.orm.Session) -> list[schemas.Post]:
+    post = await get_post(post_id, db)
 
-    remaining_posts_count = remaining_posts_count.scalar()
+    if not 0 < count <= similarity.MAX_SIMILAR:
+        raise fastapi.HTTPException(status_code=400, detail=f"count must be between 1 and {similarity.MAX_SIMILAR}")
 
-    posts = []
+    if not similar_posts.is_built():
+        raise fastapi.HTTPException(status_code=503, detail="The index of similar posts has not been built yet")
 
-    if len(exclude) >= remaining_posts_count:
-        return posts
-    elif len(exclude) + count > remaining_posts_count:
-        count = remaining_posts_count - len(exclude)
+    post_ids = similar_posts.find_similar(post.id, count)
 
-    for i in range(count):
-        post_pos = random.randint(0, remaining_posts_count - len(exclude) - 1)
+    if post_ids is None:
+        raise fastapi.HTTPException(status_code=404, detail=f"Post with id {post_id} has not been indexed yet")
 
-        post = db.query(models.Post).filter(models.Post.id.not_in(exclude))
+    posts = await loaders.get_loader(db, loaders.fetch_posts).load_many(post_ids)
 
-        if by_tag:
-            post = post.filter(models.Post.id.in_(
-                [i.post_id for i in db.query(models.TagMap).filter(models.TagMap.tag_id.is_(by_tag)).all()]
-            ))
+    return [i for i in posts if i is not None]
 
-        if by_bot:
-            post = post.filter_by(owner_id=by_bot)
 
-        if by_or_mentioned:
-            post = post.filter(
-                or_(models.Post.owner_id.is_(by_or_mentioned),
-                    (models.Post.id.in_([i.post_id for i in db.query(models.MentionMap).
-                                        filter_by(mention_id=by_or_mentioned).all()])))
-            )
+def create_posts(posts: list[models.Post], db: sqlalchemy.orm.Session) -> None:
+    """Inserts the posts together with the TagMap and MentionMap rows extracted from their contents."""
+    db.add_all(posts)
+    db.flush()
 
-        if favorites_only:
-            post = post.filter(models.Post.id.in_(
-                [i.post_id for i in db.query(models.FavoriteMap).filter_by(user_id=user.id).all()]
-            ))
+    tag_rows, _ = token_extractor.extract([(post.id, post.content) for post in posts], db)
 
-        if use_filter:
-            post = post.filter(and_(
-                models.Post.content.contains(i, autoescape=True) for i in use_filter.split(" ")
-            ))
+    db.commit()
+
+    tag_cooccurrence.add(tag_rows, db)
+
+    similar_posts.add([(post.id, post.content) for post in posts])
 
-        post = post.offset(post_pos).first()
-        exclude.append(post.id)
-        posts.append(schemas.Post.model_validate(post))
+    post_filter_index.invalidate()
+    post_weights.invalidate()
+    tag_prefix_index.invalidate()
+    mention_graph.invalidate()
 
-    return posts
+    record_write()
 
 
 async def get_post_info(post_id: int, db: sqlalchemy.orm.Session, user: models.User = None) -> schemas.PostInfo:
@@ -310,17 +574,15 @@ async def get_post_info(post_id: int, db: sqlalchemy.orm.Session, user: models.U
     if user is None:
         favorite = None
     else:
-        # noinspection PyComparisonWithNone
-        favorite = (db.query(models.FavoriteMap).
-                    filter_by(post_id=post.id).
-                    filter_by(user_id=user.id).first() != None)
+        favorite = membership_cache.contains(user.id, memberships.FAVORITE_POSTS, post.id, db)
 
     post_info = schemas.PostInfo(
         id=post.id,
 
         favorite=favorite,
 
-        favorite_count=db.query(func.count(models.FavoriteMap.id)).filter_by(post_id=post.id).scalar(),
+        favorite_count=db.query(func.count(models.FavoriteMap.id)).filter_by(post_id=post.id).scalar()
+        + write_queue.get_count_delta(memberships.FAVORITE_POSTS, post.id),
     )
 
     return schemas.PostInfo.model_validate(post_info)
@@ -329,51 +591,33 @@ async def get_post_info(post_id: int, db: sqlalchemy.orm.Session, user: models.U
 
 # <editor-fold desc="Posts / favorite">
 async def favorite_post(post_id: int, user: models.User, db: sqlalchemy.orm.Session) -> schemas.PostInfo:
-    post = db.query(models.Post).get(post_id)
-
-    if post is None:
-        raise fastapi.HTTPException(status_code=404, detail=f"There is no post with id {post_id}")
-
-    post = schemas.Post.model_validate(post)
-
-    favorite = db.query(models.FavoriteMap).filter_by(user_id=user.id).filter_by(post_id=post.id).first()
+    post = await get_post(post_id, db)
 
-    if favorite is not None:
+    if membership_cache.contains(user.id, memberships.FAVORITE_POSTS, post.id, db):
         raise fastapi.HTTPException(status_code=404, detail=f"Post with id {post_id} already is in your favorites")
 
-    favorite = models.FavoriteMap(post_id=post.id, user_id=user.id)
-
-    db.add(favorite)
-    db.commit()
-    db.refresh(favorite)
+    submit_membership(user.id, memberships.FAVORITE_POSTS, post.id, True)
 
     return await get_post_info(post_id, db, user=user)
 
 
 async def unfavorite_post(post_id: int, user: models.User, db: sqlalchemy.orm.Session) -> schemas.PostInfo:
-    post = db.query(models.Post).get(post_id)
-
-    if post is None:
-        raise fastapi.HTTPException(status_code=404, detail=f"There is no post with id {post_id}")
-
-    post = schemas.Post.model_validate(post)
-
-    favorite = db.query(models.FavoriteMap).filter_by(user_id=user.id).filter_by(post_id=post.id).first()
+    post = await get_post(post_id, db)
 
-    if favorite is None:
+    if not membership_cache.contains(user.id, memberships.FAVORITE_POSTS, post.id, db):
         raise fastapi.HTTPException(status_code=404, detail=f"Post with id {post_id} is not in your favorites")
 
-    db.delete(favorite)
-    db.commit()
+    submit_membership(user.id, memberships.FAVORITE_POSTS, post.id, False)
 
     return await get_post_info(post_id, db, user=user)
 # </editor-fold>
 
 
 # <editor-fold desc="Bots">
+@memoized("bot")
 async def get_bot(bot_id_or_username: int | str, db: sqlalchemy.orm.Session) -> schemas.Bot:
     if bot_id_or_username.isdigit():
-        bot = db.query(models.Bot).get(bot_id_or_username)
+        bot = await loaders.get_loader(db, loaders.fetch_bots).load(int(bot_id_or_username))
 
         if bot is None:
             raise fastapi.HTTPException(status_code=404,
@@ -382,82 +626,104 @@ async def get_bot(bot_id_or_username: int | str, db: sqlalchemy.orm.Session) ->
     else:
         bot_id_or_username = bot_id_or_username.lstrip("@")
 
-        bot = db.query(models.Bot).filter_by(username=bot_id_or_username).first()
+        bot = await loaders.get_loader(db, loaders.fetch_bots_by_username).load(bot_id_or_username)
 
         if bot is None:
             raise fastapi.HTTPException(status_code=404,
                                         detail=f"Bot with username {bot_id_or_username} does not exist")
 
-    return schemas.Bot.model_validate(bot)
+    return bot
 
 
 async def get_random_bots(count: int, user: models.User, db: sqlalchemy.orm.Session,
                           following_only: bool = None, exclude: list[int] = None) -> list[schemas.Bot]:
-    if exclude is None:
-        exclude = []
-
-    remaining_bots_count = db.query(func.count(models.Bot.id))
-
-    if following_only:
-        remaining_bots_count = remaining_bots_count.filter(models.Bot.id.in_(
-            [i.bot_id for i in db.query(models.FollowingMap).filter_by(follower_id=user.id).all()]
-        ))
-
-    remaining_bots_count = remaining_bots_count.scalar()
-
-    bots = []
+    excluded = set(exclude or [])
 
-    if len(exclude) >= remaining_bots_count:
-        return bots
-    elif len(exclude) + count > remaining_bots_count:
-        count = remaining_bots_count - len(exclude)
+    if not following_only:
+        # The prefix index keeps all bots in memory already, invalidated when bots are created
+        return sample_excluding(bot_prefix_index.get_items(db), count, excluded)
 
-    for i in range(count):
-        bot_pos = random.randint(0, remaining_bots_count - len(exclude) - 1)
+    candidates = [i for i in membership_cache.get(user.id, memberships.FOLLOWED_BOTS, db) if i not in excluded]
+    bot_ids = random.sample(candidates, min(count, len(candidates)))
 
-        bot = db.query(models.Bot).filter(models.Bot.id.not_in(exclude))
+    bots = await loaders.get_loader(db, loaders.fetch_bots).load_many(bot_ids)
 
-        if following_only:
-            bot = bot.filter(models.Bot.id.in_(
-                [i.bot_id for i in db.query(models.FollowingMap).filter_by(follower_id=user.id).all()]
-            ))
+    return [i for i in bots if i is not None]
 
-        bot = bot.offset(bot_pos).first()
 
-        exclude.append(bot.id)
-        bots.append(schemas.Bot.model_validate(bot))
-
-    return bots
+async def suggest_bots(prefix: str, count: int, db: sqlalchemy.orm.Session) -> list[schemas.Bot]:
+    return bot_prefix_index.suggest(prefix.lstrip("@"), min(count, prefixes.MAX_SUGGESTIONS), db)
 
 
 async def get_bot_info(bot_id_or_name: int | str,
                        db: sqlalchemy.orm.Session, user: models.User = None) -> schemas.BotInfo:
     bot = await get_bot(bot_id_or_name, db)
 
+    return build_bot_info(bot, db, user=user)
+
+
+def build_bot_info(bot: schemas.Bot, db: sqlalchemy.orm.Session, user: models.User = None) -> schemas.BotInfo:
+    """Returns the info of a resolved bot, with its posts taken from the post filter index shared with the feeds."""
+    post_ids = post_filter_index.evaluate(db, by_bot=bot.id).tolist()
+
     if user is None:
         following = None
     else:
-        # noinspection PyComparisonWithNone
-        following = (db.query(models.FollowingMap).
-                     filter_by(bot_id=bot.id).
-                     filter_by(follower_id=user.id).first() != None)
+        following = membership_cache.contains(user.id, memberships.FOLLOWED_BOTS, bot.id, db)
 
     bot_info = schemas.BotInfo(
         id=bot.id,
 
         following=following,
 
-        post_count=db.query(func.count(models.Post.id)).filter_by(owner_id=bot.id).scalar(),
-        favorites_count=db.query(func.count(models.FavoriteMap.id)).filter(models.FavoriteMap.post_id.in_(
-            [i.id for i in db.query(models.Post).filter_by(owner_id=bot.id).all()]
-        )).scalar(),
-        followers_count=db.query(func.count(models.FollowingMap.id)).filter_by(bot_id=bot.id).scalar(),
-        mentioned_count=db.query(func.count(models.MentionMap.id)).filter_by(mention_id=bot.id).filter(
-            not_(models.MentionMap.post_id.in_([i.id for i in db.query(models.Post).filter_by(owner_id=bot.id).all()]))
-        ).scalar(),
+        post_count=len(post_ids),
+        favorites_count=db.query(func.count(models.FavoriteMap.id)).filter(
+            models.FavoriteMap.post_id.in_(post_ids)).scalar(),
+        followers_count=db.query(func.count(models.FollowingMap.id)).filter_by(bot_id=bot.id).scalar()
+        + write_queue.get_count_delta(memberships.FOLLOWED_BOTS, bot.id),
+        mentioned_count=mention_graph.get_mention_count(db, bot.id),
     )
 
     return schemas.BotInfo.model_validate(bot_info)
+
+
+async def get_bot_page(bot_id_or_name: int | str, count: int,
+                       user: models.User, db: sqlalchemy.orm.Session) -> schemas.BotPage:
+    """Returns the bot, its info and a first page of its posts, resolving the bot once."""
+    bot = await get_bot(bot_id_or_name, db)
+
+    return schemas.BotPage(
+        bot=bot,
+        info=build_bot_info(bot, db, user=user),
+        posts=await get_random_posts(count, user, db, by_bot=bot.id),
+    )
+
+
+async def get_bot_connections(bot_id_or_name: int | str, count: int,
+                              db: sqlalchemy.orm.Session) -> schemas.BotConnections:
+    bot = await get_bot(bot_id_or_name, db)
+
+    if not 0 <= count <= bot_graph.MAX_CONNECTIONS:
+        raise fastapi.HTTPException(status_code=400,
+                                    detail=f"count must be between 0 and {bot_graph.MAX_CONNECTIONS}")
+
+    connections = mention_graph.get_connections(db, bot.id, count)
+
+    if connections is None:
+        # Bots created since the graph was loaded have not been mentioned yet
+        connections = dict(mentions_count=0, mentioned_count=0, mentions_degree=0, mentioned_degree=0,
+                           centrality=0.0, rank=0, interactions=[])
+
+    interactions = connections.pop("interactions")
+    bots = await loaders.get_loader(db, loaders.fetch_bots).load_many([i for i, _, _ in interactions])
+
+    return schemas.BotConnections(
+        id=bot.id,
+        **connections,
+        connections=[schemas.BotConnection(bot=connected_bot, mentions_count=mentions, mentioned_count=mentioned)
+                     for connected_bot, (_, mentions, mentioned) in zip(bots, interactions)
+                     if connected_bot is not None],
+    )
 # </editor-fold>
 
 
@@ -466,19 +732,13 @@ async def follow_bot(bot_id_or_name: int | str,
                      user: models.User, db: sqlalchemy.orm.Session) -> schemas.BotInfo:
     bot = await get_bot(bot_id_or_name, db)
 
-    follow = db.query(models.FollowingMap).filter_by(bot_id=bot.id).filter_by(follower_id=user.id).first()
-
-    if follow is not None:
+    if membership_cache.contains(user.id, memberships.FOLLOWED_BOTS, bot.id, db):
         raise fastapi.HTTPException(status_code=409,
                                     detail=f"You are already following the bot "
                                            f"{'with the id ' if bot_id_or_name.isdigit() else ''}"
                                            f"{bot_id_or_name}")
 
-    follow = models.FollowingMap(bot_id=bot.id, follower_id=user.id)
-
-    db.add(follow)
-    db.commit()
-    db.refresh(follow)
+    submit_membership(user.id, memberships.FOLLOWED_BOTS, bot.id, True)
 
     return await get_bot_info(bot_id_or_name, db, user=user)
 
@@ -487,86 +747,77 @@ async def unfollow_bot(bot_id_or_name: int | str,
                        user: models.User, db: sqlalchemy.orm.Session) -> schemas.BotInfo:
     bot = await get_bot(bot_id_or_name, db)
 
-    follow = db.query(models.FollowingMap).filter_by(bot_id=bot.id).filter_by(follower_id=user.id).first()
-
-    if follow is None:
+    if not membership_cache.contains(user.id, memberships.FOLLOWED_BOTS, bot.id, db):
         raise fastapi.HTTPException(status_code=409, detail=f"You are not following the bot "
                                                             f"{'with the id ' if bot_id_or_name.isdigit() else ''}"
                                                             f"{bot_id_or_name}")
 
-    db.delete(follow)
-    db.commit()
+    submit_membership(user.id, memberships.FOLLOWED_BOTS, bot.id, False)
 
     return await get_bot_info(bot_id_or_name, db, user=user)
 # </editor-fold>
 
 
 # <editor-fold desc="Tags">
+@memoized("tag")
 async def get_tag(tag_id_or_name: int | str, db: sqlalchemy.orm.Session) -> schemas.Tag:
     if tag_id_or_name.isdigit():
-        tag = db.query(models.Tag).get(tag_id_or_name)
+        tag = await loaders.get_loader(db, loaders.fetch_tags).load(int(tag_id_or_name))
 
     else:
         tag_id_or_name = tag_id_or_name.lstrip("#")
 
-        tag = db.query(models.Tag).filter_by(name=tag_id_or_name).first()
+        tag = await loaders.get_loader(db, loaders.fetch_tags_by_name).load(tag_id_or_name)
 
     if tag is None:
         raise fastapi.HTTPException(status_code=404, detail=f"Tag with name {tag_id_or_name} does not exist")
 
-    return schemas.Tag.model_validate(tag)
+    return tag
 
 
 async def get_random_tags(count: int, user: models.User, db: sqlalchemy.orm.Session,
                           following_only: bool = None, exclude: list[int] = None) -> list[schemas.Tag]:
-    if exclude is None:
-        exclude = []
-
-    remaining_tags_count = db.query(func.count(models.Tag.id))
+    excluded = set(exclude or [])
 
-    if following_only:
-        remaining_tags_count = remaining_tags_count.filter(models.Tag.id.in_(
-            [i.tag_id for i in db.query(models.FollowingMap).filter_by(follower_id=user.id).all()]
-        ))
+    if not following_only:
+        # The prefix index keeps all tags in memory already, invalidated when tags are created
+        return sample_excluding(tag_prefix_index.get_items(db), count, excluded)
 
-    remaining_tags_count = remaining_tags_count.scalar()
+    candidates = [i for i in membership_cache.get(user.id, memberships.FOLLOWED_TAGS, db) if i not in excluded]
+    tag_ids = random.sample(candidates, min(count, len(candidates)))
 
-    tags = []
+    tags = await loaders.get_loader(db, loaders.fetch_tags).load_many(tag_ids)
 
-    if len(exclude) >= remaining_tags_count:
-        return tags
-    elif len(exclude) + count > remaining_tags_count:
-        count = remaining_tags_count - len(exclude)
+    return [i for i in tags if i is not None]
 
-    for i in range(count):
-        tag_pos = random.randint(0, remaining_tags_count - len(exclude) - 1)
 
-        tag = db.query(models.Tag).filter(models.Tag.id.not_in(exclude))
+async def suggest_tags(prefix: str, count: int, db: sqlalchemy.orm.Session) -> list[schemas.Tag]:
+    return tag_prefix_index.suggest(prefix.lstrip("#"), min(count, prefixes.MAX_SUGGESTIONS), db)
 
-        if following_only:
-            tag = tag.filter(models.Tag.id.in_(
-                [i.tag_id for i in db.query(models.FollowingMap).filter_by(follower_id=user.id).all()]
-            ))
 
-        tag = tag.offset(tag_pos).first()
+async def get_related_tags(tag_id_or_name: int | str, count: int,
+                           db: sqlalchemy.orm.Session) -> list[schemas.RelatedTag]:
+    tag = await get_tag(tag_id_or_name, db)
 
-        exclude.append(tag.id)
-        tags.append(schemas.Tag.model_validate(tag))
+    if not 0 < count <= cooccurrence.MAX_RELATED:
+        raise fastapi.HTTPException(status_code=400, detail=f"count must be between 1 and {cooccurrence.MAX_RELATED}")
 
-    return tags
+    return [schemas.RelatedTag(tag=related, shared_post_count=shared, score=score)
+            for related, shared, score in tag_cooccurrence.get_related(db, tag.id, count)]
 
 
 async def get_tag_info(tag_id_or_name: int | str,
                        db: sqlalchemy.orm.Session, user: models.User = None) -> schemas.TagInfo:
     tag = await get_tag(tag_id_or_name, db)
 
+    return build_tag_info(tag, db, user=user)
+
+
+def build_tag_info(tag: schemas.Tag, db: sqlalchemy.orm.Session, user: models.User = None) -> schemas.TagInfo:
     if user is None:
         following = None
     else:
-        # noinspection PyComparisonWithNone
-        following = (db.query(models.FollowingMap).
-                     filter_by(tag_id=tag.id).
-                     filter_by(follower_id=user.id).first() != None)
+        following = membership_cache.contains(user.id, memberships.FOLLOWED_TAGS, tag.id, db)
 
     tag_info = schemas.TagInfo(
         id=tag.id,
@@ -574,10 +825,23 @@ async def get_tag_info(tag_id_or_name: int | str,
         following=following,
 
         post_count=db.query(func.count(models.TagMap.id)).filter_by(tag_id=tag.id).scalar(),
-        follower_count=db.query(func.count(models.FollowingMap.id)).filter_by(tag_id=tag.id).scalar(),
+        follower_count=db.query(func.count(models.FollowingMap.id)).filter_by(tag_id=tag.id).scalar()
+        + write_queue.get_count_delta(memberships.FOLLOWED_TAGS, tag.id),
     )
 
     return schemas.TagInfo.model_validate(tag_info)
+
+
+async def get_tag_page(tag_id_or_name: int | str, count: int,
+                       user: models.User, db: sqlalchemy.orm.Session) -> schemas.TagPage:
+    """Returns the tag, its info and a first page of its posts, resolving the tag once."""
+    tag = await get_tag(tag_id_or_name, db)
+
+    return schemas.TagPage(
+        tag=tag,
+        info=build_tag_info(tag, db, user=user),
+        posts=await get_random_posts(count, user, db, by_tag=tag.id),
+    )
 # </editor-fold>
 
 
@@ -586,18 +850,12 @@ async def follow_tag(tag_id_or_name: int | str,
                      user: models.User, db: sqlalchemy.orm.Session) -> schemas.TagInfo:
     tag = await get_tag(tag_id_or_name, db)
 
-    following_map = db.query(models.FollowingMap).filter_by(tag_id=tag.id).filter_by(follower_id=user.id).first()
-
-    if following_map is not None:
+    if membership_cache.contains(user.id, memberships.FOLLOWED_TAGS, tag.id, db):
         raise fastapi.HTTPException(status_code=409, detail=f"You are already following the tag "
                                                             f"{'with the id ' if tag_id_or_name.isdigit() else ''}"
                                                             f"{tag_id_or_name}")
 
-    following_map = models.FollowingMap(tag_id=tag.id, follower_id=user.id)
-
-    db.add(following_map)
-    db.commit()
-    db.refresh(following_map)
+    submit_membership(user.id, memberships.FOLLOWED_TAGS, tag.id, True)
 
     return await get_tag_info(tag_id_or_name, db, user=user)
 
@@ -606,22 +864,22 @@ async def unfollow_tag(tag_id_or_name: int | str,
                        user: models.User, db: sqlalchemy.orm.Session) -> schemas.TagInfo:
     tag = await get_tag(tag_id_or_name, db)
 
-    follow = db.query(models.FollowingMap).filter_by(tag_id=tag.id).filter_by(follower_id=user.id).first()
-
-    if follow is None:
+    if not membership_cache.contains(user.id, memberships.FOLLOWED_TAGS, tag.id, db):
         raise fastapi.HTTPException(status_code=409, detail=f"You are not following the tag "
                                                             f"{'with the id ' if tag_id_or_name.isdigit() else ''}"
                                                             f"{tag_id_or_name}")
 
-    db.delete(follow)
-    db.commit()
+    submit_membership(user.id, memberships.FOLLOWED_TAGS, tag.id, False)
 
     return await get_tag_info(tag_id_or_name, db, user=user)
 # </editor-fold>
 
 
 # <editor-fold desc="ComicVine Import">
+# The ComicVine modules open their own database on import, so they are only imported when importing its data
 def get_comicvine_db() -> Generator[sqlalchemy.orm.Session]:
+    from organisations.comicvine import database as comicvine_database
+
     db = comicvine_database.SessionLocal()
     try:
         yield db
@@ -630,6 +888,8 @@ def get_comicvine_db() -> Generator[sqlalchemy.orm.Session]:
 
 
 def import_comicvine_data(db: sqlalchemy.orm.Session) -> None:
+    from organisations.comicvine import models as comicvine_models
+
     comicvine_name = "ComicVine"
 
     comicvine_organisation = models.Organisation(
@@ -661,8 +921,17 @@ def import_comicvine_data(db: sqlalchemy.orm.Session) -> None:
         db.commit()
         db.refresh(bot)
 
+    bot_prefix_index.invalidate()
+    token_extractor.invalidate()
+
     original_character_list = comicvine_db.query(comicvine_models.Character).all()
 
+    usernames = {}
+    for bot in db.query(models.Bot).order_by(models.Bot.id):
+        usernames.setdefault(bot.image, bot.username)
+
+    posts = []
+
     for i in range(1, comicvine_db.query(func.count(comicvine_models.Post.id)).scalar(), 1):
         original_post = comicvine_db.query(comicvine_models.Post).get(i)
 
@@ -676,42 +945,57 @@ def import_comicvine_data(db: sqlalchemy.orm.Session) -> None:
 
         post.content = original_post.content
 
-        db.add(post)
-        db.commit()
-        db.refresh(post)
+        for bot in original_character_list:
+            post.content = re.sub(fr"\w*(?<![a-zA-Z#]){bot.username}", f"@{usernames[bot.image]}", post.content)
+
+        posts.append(post)
 
-        for p, bot in enumerate(original_character_list):
-            post.content = re.sub(fr"\w*(?<![a-zA-Z#]){bot.username}",
-                                  f"@{db.query(models.Bot).filter_by(image=bot.image).first().username}", post.content)
+    create_posts(posts, db)
+# </editor-fold>
 
-        for j in re.findall(r"\w*(?<![a-zA-Z])[@#]\w+", post.content):
-            if j[0] == "#":
-                tag = db.query(models.Tag).filter_by(name=j[1:].lower()).first()
 
-                if tag is None:
-                    tag = models.Tag(name=j[1:].lower())
-                    db.add(tag)
-                    db.commit()
-                    db.refresh(tag)
+# <editor-fold desc="Diagnostics">
+def get_blocking_report() -> schemas.BlockingReport:
+    if blocking_detector is None:
+        return schemas.BlockingReport(threshold=None, loop_lag=load_monitor.loop_lag, offenders=[], records=[])
 
-                tag_map = models.TagMap(tag_id=tag.id, post_id=post.id)
+    return schemas.BlockingReport(
+        threshold=blocking_detector.threshold,
+        loop_lag=load_monitor.loop_lag,
+        offenders=[schemas.BlockingOffender(route=route, service=service, count=count, total_duration=total)
+                   for route, service, count, total in blocking_detector.get_offenders()],
+        records=[schemas.BlockingRecord.model_validate(i) for i in blocking_detector.get_records()],
+    )
 
-                db.add(tag_map)
-                db.commit()
-                db.refresh(tag_map)
 
-            else:
-                bot: models.Bot | None = db.query(models.Bot).filter_by(username=j[1:]).first()
+async def get_profile(duration: float) -> str:
+    """Samples all threads for `duration` seconds, returning collapsed stacks for a flamegraph."""
+    if not profile_lock.acquire(blocking=False):
+        raise fastapi.HTTPException(status_code=409, detail="A profile is running already")
 
-                if bot is None:
-                    continue
+    try:
+        profiler = diagnostics.SamplingProfiler()
+        profiler.start()
 
-                mention_map = models.MentionMap(post_id=post.id, mention_id=bot.id)
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            profiler.stop()
 
-                db.add(mention_map)
-                db.commit()
-                db.refresh(mention_map)
+    finally:
+        profile_lock.release()
 
-            continue
-    return
+    return profiler.to_collapsed()
+
+
+def get_query_report() -> schemas.QueryReport:
+    if slow_query_log is None:
+        return schemas.QueryReport(threshold=None, window=query_log.WINDOW, statistics=[], slow=[])
+
+    return schemas.QueryReport(
+        threshold=slow_query_log.threshold,
+        window=query_log.WINDOW,
+        statistics=[schemas.QueryStatistics.model_validate(i) for i in slow_query_log.get_statistics()],
+        slow=[schemas.SlowQuery.model_validate(i) for i in slow_query_log.get_slow()],
+    )
 # </editor-fold>
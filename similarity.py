@@ -0,0 +1,323 @@
+"""Finds posts with similar contents by the cosine similarity of their TF-IDF vectors.
+
+    python similarity.py                       # builds the index of all posts in database.db into ./similarity/
+    python similarity.py --batch-size 50000
+
+Words are hashed into DIMENSIONS features with random signs, so vectors have a fixed size without storing a
+projection. The vectors are kept L2-normalised in a raw float32 file which every worker memory-maps, a query is one
+dot product with all of them. Posts imported after the build are appended with the document frequencies of the build.
+"""
+import argparse
+import collections
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import threading
+import time
+
+import numpy as np
+import sqlalchemy as sql
+import sqlalchemy.orm
+
+import database
+import models
+
+
+DIRECTORY = "./similarity"
+
+DIMENSIONS = 256
+FEATURES_PER_WORD = 8
+
+# Words are runs of at least two letters, digits and underscores never carry much meaning in posts
+WORD_PATTERN = re.compile(r"[^\W\d_]{2,}")
+
+BATCH_SIZE = 10_000
+
+MAX_SIMILAR = 50
+
+# Hashing adds noise of about 1 / sqrt(DIMENSIONS) to the similarity of unrelated posts
+MIN_SIMILARITY = 0.2
+
+# From this many posts on, the build clusters the vectors, and only the posts of the PROBES clusters closest to a
+#  post are compared with it instead of all posts
+APPROXIMATE_THRESHOLD = 200_000
+PROBES = 8
+CLUSTER_ITERATIONS = 10
+CLUSTER_SAMPLE_SIZE = 50_000
+
+
+def tokenize(content: str) -> list[str]:
+    return WORD_PATTERN.findall((content or "").lower())
+
+
+def get_features(word: str) -> list[tuple[int, float]]:
+    """Returns the feature positions and signs of a word, derived from its hash so every process agrees on them."""
+    digest = hashlib.blake2b(word.encode(), digest_size=2 * FEATURES_PER_WORD).digest()
+    return [(digest[i], 1.0 if digest[i + 1] & 1 else -1.0) for i in range(0, len(digest), 2)]
+
+
+def get_idf(frequency: int, documents: int) -> float:
+    return math.log((1 + documents) / (1 + frequency)) + 1
+
+
+def vectorize(documents: list[list[str]], frequencies: dict[str, int], document_count: int) -> np.ndarray:
+    """Returns the L2-normalised TF-IDF vectors of the tokenized documents, one row per document."""
+    rows, columns, values = [], [], []
+    features = {}
+
+    for row, words in enumerate(documents):
+        for word, count in collections.Counter(words).items():
+            if word not in features:
+                features[word] = get_features(word)
+
+            weight = (1 + math.log(count)) * get_idf(frequencies.get(word, 0), document_count)
+
+            for column, sign in features[word]:
+                rows.append(row)
+                columns.append(column)
+                values.append(sign * weight)
+
+    vectors = np.zeros((len(documents), DIMENSIONS), dtype=np.float32)
+    np.add.at(vectors, (np.array(rows, dtype=np.int64), np.array(columns, dtype=np.int64)),
+              np.array(values, dtype=np.float32))
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def get_clusters(vectors: np.ndarray, count: int) -> np.ndarray:
+    """Returns `count` normalised centroids of the vectors by spherical k-means over a sample of them."""
+    rng = np.random.default_rng(0)
+
+    sample = vectors[np.sort(rng.choice(len(vectors), min(len(vectors), CLUSTER_SAMPLE_SIZE), replace=False))]
+    centroids = sample[rng.choice(len(sample), count, replace=False)].copy()
+
+    for _ in range(CLUSTER_ITERATIONS):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+
+        # Empty clusters keep their centroid
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+
+    return centroids.astype(np.float32)
+
+
+def assign(vectors: np.ndarray, centroids: np.ndarray, batch_size: int = BATCH_SIZE) -> np.ndarray:
+    return np.concatenate([np.argmax(vectors[i:i + batch_size] @ centroids.T, axis=1).astype(np.int32)
+                           for i in range(0, len(vectors), batch_size)] or [np.empty(0, dtype=np.int32)])
+
+
+class PostSimilarityIndex:
+    """Memory-mapped post vectors, reopened whenever the files were rebuilt or appended to by any process.
+
+    Post ids are stored in ascending order, so positions are found by binary search instead of a dictionary of
+    all posts in every worker.
+    """
+
+    def __init__(self, directory: str = DIRECTORY):
+        self.directory = directory
+
+        self.lock = threading.Lock()
+
+        # Inode and size of the post id file the arrays were opened from
+        self.signature = None
+
+        self.post_ids = np.empty(0, dtype=np.int64)
+        self.vectors = np.empty((0, DIMENSIONS), dtype=np.float32)
+
+        self.centroids: np.ndarray | None = None
+        self.cluster_rows: np.ndarray | None = None
+        self.cluster_offsets: np.ndarray | None = None
+
+    def get_path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def is_built(self) -> bool:
+        return os.path.exists(self.get_path("post_ids.i64"))
+
+    def refresh(self) -> None:
+        """Reopens the files if they changed, must be called holding the lock."""
+        try:
+            stat = os.stat(self.get_path("post_ids.i64"))
+        except FileNotFoundError:
+            # Another process is swapping in a rebuilt index, the mapped files stay readable until then
+            return
+
+        if self.signature == (stat.st_ino, stat.st_size):
+            return
+
+        # Rows are appended to the vectors first, so only rows whose id was written completely are used
+        count = min(stat.st_size // 8, os.path.getsize(self.get_path("vectors.f32")) // (4 * DIMENSIONS))
+
+        if count:
+            self.post_ids = np.memmap(self.get_path("post_ids.i64"), dtype=np.int64, mode="r", shape=(count,))
+            self.vectors = np.memmap(self.get_path("vectors.f32"), dtype=np.float32, mode="r",
+                                     shape=(count, DIMENSIONS))
+        else:
+            self.post_ids = np.empty(0, dtype=np.int64)
+            self.vectors = np.empty((0, DIMENSIONS), dtype=np.float32)
+
+        self.centroids, self.cluster_rows, self.cluster_offsets = None, None, None
+
+        if count and os.path.exists(self.get_path("centroids.f32")):
+            self.centroids = np.fromfile(self.get_path("centroids.f32"), dtype=np.float32).reshape(-1, DIMENSIONS)
+
+            assignments = np.fromfile(self.get_path("assignments.i32"), dtype=np.int32)[:count]
+
+            # Rows grouped by cluster, the rows of cluster c are cluster_rows[cluster_offsets[c]:cluster_offsets[c + 1]]
+            self.cluster_rows = np.argsort(assignments, kind="stable")
+            self.cluster_offsets = np.searchsorted(assignments[self.cluster_rows], np.arange(len(self.centroids) + 1))
+
+        self.signature = (stat.st_ino, stat.st_size)
+
+    def load(self) -> None:
+        with self.lock:
+            if self.is_built():
+                self.refresh()
+
+    def find_similar(self, post_id: int, count: int) -> list[int] | None:
+        """Returns the ids of up to `count` posts most similar to the post, or None if the post is not indexed."""
+        if count < 1:
+            return []
+
+        with self.lock:
+            self.refresh()
+            post_ids, vectors = self.post_ids, self.vectors
+            centroids, cluster_rows, cluster_offsets = self.centroids, self.cluster_rows, self.cluster_offsets
+
+        position = int(np.searchsorted(post_ids, post_id))
+
+        if position == len(post_ids) or post_ids[position] != post_id:
+            return None
+
+        query = np.asarray(vectors[position])
+
+        if centroids is None:
+            rows, scores = None, vectors @ query
+        else:
+            probes = np.argsort(centroids @ query)[-PROBES:]
+
+            # Sorted, so the memory-mapped pages are read in file order
+            rows = np.sort(np.concatenate([cluster_rows[cluster_offsets[i]:cluster_offsets[i + 1]] for i in probes]))
+            scores = vectors[rows] @ query
+
+        # One more than needed, as the post itself is among the best matches
+        best = np.argpartition(-scores, min(count, len(scores) - 1))[:count + 1]
+        best = best[np.argsort(-scores[best], kind="stable")]
+
+        scores = scores[best]
+        if rows is not None:
+            best = rows[best]
+
+        return [int(post_ids[i]) for i, score in zip(best, scores)
+                if i != position and score >= MIN_SIMILARITY][:count]
+
+    def add(self, posts: list[tuple[int, str]]) -> None:
+        """Appends the vectors of `(post_id, content)` pairs of new posts, if the index has been built."""
+        with self.lock:
+            if not self.is_built():
+                return
+
+            self.refresh()
+
+            # Ids must stay ascending, posts already indexed are skipped
+            last_id = int(self.post_ids[-1]) if len(self.post_ids) else -1
+            posts = sorted(i for i in posts if i[0] > last_id)
+
+            if not posts:
+                return
+
+            with open(self.get_path("vocabulary.json")) as file:
+                vocabulary = json.load(file)
+
+            vectors = vectorize([tokenize(content) for _, content in posts],
+                                vocabulary["frequencies"], vocabulary["documents"])
+
+            with open(self.get_path("vectors.f32"), "ab") as file:
+                file.write(vectors.tobytes())
+
+            if self.centroids is not None:
+                with open(self.get_path("assignments.i32"), "ab") as file:
+                    file.write(assign(vectors, self.centroids).tobytes())
+
+            with open(self.get_path("post_ids.i64"), "ab") as file:
+                file.write(np.array([post_id for post_id, _ in posts], dtype=np.int64).tobytes())
+
+    def build(self, db: sqlalchemy.orm.Session, batch_size: int = BATCH_SIZE) -> int:
+        """Replaces the index with one of all posts, built in a temporary directory. Returns the number of posts."""
+        temporary = f"{self.directory}.tmp"
+        shutil.rmtree(temporary, ignore_errors=True)
+        os.makedirs(temporary)
+
+        def get_batches():
+            posts = db.execute(sql.select(models.Post.id, models.Post.content).order_by(models.Post.id)
+                               .execution_options(yield_per=batch_size))
+            return posts.partitions()
+
+        frequencies, documents = collections.Counter(), 0
+
+        for batch in get_batches():
+            for _, content in batch:
+                frequencies.update(set(tokenize(content)))
+                documents += 1
+
+        with (open(os.path.join(temporary, "vectors.f32"), "wb") as vector_file,
+              open(os.path.join(temporary, "post_ids.i64"), "wb") as id_file):
+            for batch in get_batches():
+                vector_file.write(vectorize([tokenize(content) for _, content in batch],
+                                            frequencies, documents).tobytes())
+                id_file.write(np.array([post_id for post_id, _ in batch], dtype=np.int64).tobytes())
+
+        if documents >= APPROXIMATE_THRESHOLD:
+            vectors = np.memmap(os.path.join(temporary, "vectors.f32"), dtype=np.float32, mode="r",
+                                shape=(documents, DIMENSIONS))
+
+            centroids = get_clusters(vectors, int(math.sqrt(documents)))
+
+            centroids.tofile(os.path.join(temporary, "centroids.f32"))
+            assign(vectors, centroids, batch_size).tofile(os.path.join(temporary, "assignments.i32"))
+
+            del vectors
+
+        with open(os.path.join(temporary, "vocabulary.json"), "w") as file:
+            json.dump({"documents": documents, "frequencies": frequencies}, file)
+
+        # Moved aside instead of deleted first, so readers in other processes miss the directory for a moment at most
+        previous = f"{self.directory}.old"
+        shutil.rmtree(previous, ignore_errors=True)
+
+        with self.lock:
+            if os.path.exists(self.directory):
+                os.replace(self.directory, previous)
+
+            os.replace(temporary, self.directory)
+
+        shutil.rmtree(previous, ignore_errors=True)
+
+        return documents
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Builds the index of similar posts from the contents of all posts")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="posts read and vectorised at once")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+
+    db = database.SessionLocal()
+    try:
+        count = PostSimilarityIndex().build(db, args.batch_size)
+    finally:
+        db.close()
+
+    print(f"Indexed {count} posts in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
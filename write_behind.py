@@ -0,0 +1,187 @@
+import asyncio
+import threading
+import time
+from collections.abc import Callable
+
+import sqlalchemy as sql
+import sqlalchemy.orm
+
+import memberships
+import models
+
+
+# Pending changes are committed together this many seconds after the first of them was submitted
+FLUSH_INTERVAL = 0.005
+
+# Changes which could not be committed are retried after this many seconds
+RETRY_DELAY = 1
+
+# Table, user column and item column of every membership kind
+COLUMNS = {
+    memberships.FAVORITE_POSTS: (models.FavoriteMap, models.FavoriteMap.user_id, models.FavoriteMap.post_id),
+    memberships.FOLLOWED_BOTS: (models.FollowingMap, models.FollowingMap.follower_id, models.FollowingMap.bot_id),
+    memberships.FOLLOWED_TAGS: (models.FollowingMap, models.FollowingMap.follower_id, models.FollowingMap.tag_id),
+}
+
+
+class WriteQueue:
+    """Collects favourite and follow changes in memory and commits them in groups, one transaction per flush.
+
+    Changes are keyed by `(kind, user_id, item_id)` with True for added and False for removed memberships, together
+    with the time they were submitted. A change is only submitted if it differs from the current state including
+    everything still queued, so a change reversing a queued one cancels out and never reaches the database.
+
+    With several worker processes, queued changes only count towards the favourite and follower counts of the process
+    holding them, so changes older than `count_ttl` seconds, i.e. failing to be committed, no longer count.
+
+    While the background task is not running (e.g. in scripts), every submit is flushed right away.
+    """
+
+    def __init__(self, session_factory: Callable[[], sqlalchemy.orm.Session], count_ttl: float | None = None):
+        self.session_factory = session_factory
+        self.count_ttl = count_ttl
+
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+        self.pending = {}
+        self.in_flight = {}
+
+        self.listeners = []
+
+        self.wakeup: asyncio.Event | None = None
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.task: asyncio.Task | None = None
+
+    def add_listener(self, listener: Callable[[list[tuple[str, int, int, bool, int]]], None]) -> None:
+        """Calls `listener` after every flush with `(kind, user_id, item_id, added, row_id)` of the applied changes."""
+        self.listeners.append(listener)
+
+    def submit(self, kind: str, user_id: int, item_id: int, added: bool) -> None:
+        key = (kind, user_id, item_id)
+
+        with self.lock:
+            if key in self.pending:
+                # The queued change is the reverse of this one, as changes always differ from the queued state
+                del self.pending[key]
+            else:
+                self.pending[key] = (added, time.monotonic())
+
+        if self.task is None:
+            self.flush()
+        else:
+            self.wakeup.set()
+
+    def get_overlay(self, user_id: int) -> list[tuple[str, int, bool]]:
+        """Returns `(kind, item_id, added)` of the user's changes not yet visible in the database, oldest first."""
+        with self.lock:
+            return [(kind, item_id, added) for changes in (self.in_flight, self.pending)
+                    for (kind, change_user_id, item_id), (added, _) in changes.items() if change_user_id == user_id]
+
+    def get_count_delta(self, kind: str, item_id: int) -> int:
+        """Returns by how much the number of memberships of the item will change once everything is flushed."""
+        oldest = time.monotonic() - self.count_ttl if self.count_ttl is not None else None
+
+        with self.lock:
+            return sum(1 if added else -1 for changes in (self.in_flight, self.pending)
+                       for (change_kind, _, change_item_id), (added, submitted_at) in changes.items()
+                       if change_kind == kind and change_item_id == item_id
+                       and (oldest is None or submitted_at >= oldest))
+
+    def flush(self) -> None:
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    return
+
+                self.in_flight, self.pending = self.pending, {}
+
+            try:
+                applied = self.apply(self.in_flight)
+            except sql.exc.SQLAlchemyError as error:
+                print(f"Could not flush {len(self.in_flight)} queued changes, retrying: {error}")
+
+                with self.lock:
+                    # Newer changes of the same keys reverse the failed ones, so both are dropped
+                    for key, change in self.in_flight.items():
+                        if key in self.pending:
+                            del self.pending[key]
+                        else:
+                            self.pending[key] = change
+
+                    self.in_flight = {}
+
+                # Flushes run in a worker thread, the event is only set from the loop
+                if self.task is not None:
+                    self.loop.call_soon_threadsafe(self.loop.call_later, RETRY_DELAY, self.wakeup.set)
+                return
+
+            with self.lock:
+                self.in_flight = {}
+
+        for listener in self.listeners:
+            listener(applied)
+
+    def apply(self, changes: dict) -> list[tuple[str, int, int, bool, int]]:
+        applied = []
+
+        db = self.session_factory()
+        try:
+            for kind, (table, user_column, item_column) in COLUMNS.items():
+                keys = [(user_id, item_id) for change_kind, user_id, item_id in changes if change_kind == kind]
+
+                if not keys:
+                    continue
+
+                existing = {(user_id, item_id): row_id for row_id, user_id, item_id in db.query(
+                    table.id, user_column, item_column).filter(sql.tuple_(user_column, item_column).in_(keys))}
+
+                added_rows = []
+
+                for user_id, item_id in keys:
+                    added, _ = changes[(kind, user_id, item_id)]
+
+                    if added and (user_id, item_id) not in existing:
+                        row = table(**{user_column.key: user_id, item_column.key: item_id})
+                        added_rows.append((user_id, item_id, row))
+
+                    elif not added and (user_id, item_id) in existing:
+                        db.query(table).filter_by(id=existing[(user_id, item_id)]).delete()
+                        applied.append((kind, user_id, item_id, False, existing[(user_id, item_id)]))
+
+                db.add_all([row for _, _, row in added_rows])
+                db.flush()
+
+                applied += [(kind, user_id, item_id, True, row.id) for user_id, item_id, row in added_rows]
+
+            db.commit()
+        finally:
+            db.close()
+
+        return applied
+
+    async def flush_periodically(self) -> None:
+        while True:
+            await self.wakeup.wait()
+            await asyncio.sleep(FLUSH_INTERVAL)
+
+            self.wakeup.clear()
+
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as error:
+                # E.g. raised by a listener, the task must keep running or queued changes would never be committed
+                print(f"Error while flushing queued changes: {error!r}")
+
+    def start(self) -> None:
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.loop = asyncio.get_running_loop()
+            self.task = self.loop.create_task(self.flush_periodically())
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+        self.flush()